@@ -2,7 +2,7 @@
 """Chess program that either accepts human player's input moves or 
 randomly selects moves"""
 
-import random, copy, time, cProfile, functools
+import random, time, cProfile, functools, multiprocessing, ctypes, sys, threading, mmap, struct, re, os, tempfile, itertools, json, math, pstats
 
 def decorator(d):
     "Make function d a decorator: d wraps a function fn."
@@ -31,20 +31,173 @@ def memo(f):
 
 not_on_board = [10*i for i in range(2,10)] + [10*i+9 for i in range(2,10)]
 on_board = [square for square in range(20,100) if square not in not_on_board]
+on_board_set = frozenset(on_board) #for constant time membership tests
+#maps squares of the 120-square board to indices 0-63 of the zobrist table and of bitboards
+square_index = dict((square,i) for i,square in enumerate(on_board))
+
+bishop_directions = (11,-11,9,-9) #11 is topright direction, -11 is bottomleft, 9 is topleft, -9 is bottomright
+rook_directions = (10,-10,1,-1) #10 is up, -10 is down, 1 is right, -1 is left
+piece_directions = {3: bishop_directions, 4: rook_directions, 5: bishop_directions + rook_directions}
+#line types checked by is_attacked: (name, direction, piece other than the queen moving along it)
+line_types = (("d1",9,3),("d2",11,3),("d3",1,4),("d4",10,4))
+
+#attack tables, built once: for each square of the 120-square board, the squares a knight or king
+#there can move to, the squares a pawn of either colour there attacks and, for each direction, 
+#the squares along the ray from it to the edge of the board, nearest first
+knight_targets = [()]*120
+king_targets = [()]*120
+pawn_attacks = {1: [()]*120, -1: [()]*120}
+rays = [{}]*120
+for square in on_board:
+    knight_targets[square] = tuple(square + offset for offset in (21,19,12,8,-8,-12,-19,-21)\
+                                   if square + offset in on_board_set)
+    king_targets[square] = tuple(square + offset for offset in (11,10,9,1,-1,-9,-10,-11)\
+                                 if square + offset in on_board_set)
+    for sgn in (1,-1):
+        pawn_attacks[sgn][square] = tuple(square + offset for offset in (sgn*9,sgn*11) if square + offset in on_board_set)
+    rays[square] = {}
+    for direction in bishop_directions + rook_directions:
+        ray = []
+        new_sq = square + direction
+        while new_sq in on_board_set:
+            ray.append(new_sq)
+            new_sq += direction
+        rays[square][direction] = tuple(ray)
 
 col_dict = {1: "a", 2: "b", 3: "c", 4: "d", 5: "e", 6: "f", 7: "g", 8: "h"}
 col_dict_ = {"a": 1, "b": 2, "c": 3, "d": 4, "e": 5, "f": 6, "g": 7, "h": 8}
 piece_dict = {1: "P", 2: "N", 3: "B", 4: "R", 5: "Q", 6: "K"}
 piece_dict_ = {"P": 1, "N": 2, "B": 3, "R": 4, "Q": 5, "K": 6}
+#maps FEN piece letters to piece representations and back
+fen_pieces = {"P": 1, "N": 2, "B": 3, "R": 4, "Q": 5, "K": 6, "p": -1, "n": -2, "b": -3, "r": -4, "q": -5, "k": -6}
+fen_letters = dict((piece,letter) for letter,piece in fen_pieces.items())
 
 #maps piece representations to values
 value_dict = {1: 1, 2: 3, 3: 3, 4: 5, 5: 9, 6: 99999}
 
+#material and piece-square values in centipawns for middlegame and endgame (PeSTO tables), 
+#for white pieces with the 8th row first, as the board is printed
+piece_values_mg = {1: 82, 2: 337, 3: 365, 4: 477, 5: 1025, 6: 0}
+piece_values_eg = {1: 94, 2: 281, 3: 297, 4: 512, 5: 936, 6: 0}
+pst_mg = {
+1: [  0,   0,   0,   0,   0,   0,   0,   0,
+     98, 134,  61,  95,  68, 126,  34, -11,
+     -6,   7,  26,  31,  65,  56,  25, -20,
+    -14,  13,   6,  21,  23,  12,  17, -23,
+    -27,  -2,  -5,  12,  17,   6,  10, -25,
+    -26,  -4,  -4, -10,   3,   3,  33, -12,
+    -35,  -1, -20, -23, -15,  24,  38, -22,
+      0,   0,   0,   0,   0,   0,   0,   0],
+2: [-167, -89, -34, -49,  61, -97, -15,-107,
+     -73, -41,  72,  36,  23,  62,   7, -17,
+     -47,  60,  37,  65,  84, 129,  73,  44,
+      -9,  17,  19,  53,  37,  69,  18,  22,
+     -13,   4,  16,  13,  28,  19,  21,  -8,
+     -23,  -9,  12,  10,  19,  17,  25, -16,
+     -29, -53, -12,  -3,  -1,  18, -14, -19,
+    -105, -21, -58, -33, -17, -28, -19, -23],
+3: [-29,   4, -82, -37, -25, -42,   7,  -8,
+    -26,  16, -18, -13,  30,  59,  18, -47,
+    -16,  37,  43,  40,  35,  50,  37,  -2,
+     -4,   5,  19,  50,  37,  37,   7,  -2,
+     -6,  13,  13,  26,  34,  12,  10,   4,
+      0,  15,  15,  15,  14,  27,  18,  10,
+      4,  15,  16,   0,   7,  21,  33,   1,
+    -33,  -3, -14, -21, -13, -12, -39, -21],
+4: [ 32,  42,  32,  51,  63,   9,  31,  43,
+     27,  32,  58,  62,  80,  67,  26,  44,
+     -5,  19,  26,  36,  17,  45,  61,  16,
+    -24, -11,   7,  26,  24,  35,  -8, -20,
+    -36, -26, -12,  -1,   9,  -7,   6, -23,
+    -45, -25, -16, -17,   3,   0,  -5, -33,
+    -44, -16, -20,  -9,  -1,  11,  -6, -71,
+    -19, -13,   1,  17,  16,   7, -37, -26],
+5: [-28,   0,  29,  12,  59,  44,  43,  45,
+    -24, -39,  -5,   1, -16,  57,  28,  54,
+    -13, -17,   7,   8,  29,  56,  47,  57,
+    -27, -27, -16, -16,  -1,  17,  -2,   1,
+     -9, -26,  -9, -10,  -2,  -4,   3,  -3,
+    -14,   2, -11,  -2,  -5,   2,  14,   5,
+    -35,  -8,  11,   2,   8,  15,  -3,   1,
+     -1, -18,  -9,  10, -15, -25, -31, -50],
+6: [-65,  23,  16, -15, -56, -34,   2,  13,
+     29,  -1, -20,  -7,  -8,  -4, -38, -29,
+     -9,  24,   2, -16, -20,   6,  22, -22,
+    -17, -20, -12, -27, -30, -25, -14, -36,
+    -49,  -1, -27, -39, -46, -44, -33, -51,
+    -14, -14, -22, -46, -44, -30, -15, -27,
+      1,   7,  -8, -64, -43, -16,   9,   8,
+    -15,  36,  12, -54,   8, -28,  24,  14]}
+pst_eg = {
+1: [  0,   0,   0,   0,   0,   0,   0,   0,
+    178, 173, 158, 134, 147, 132, 165, 187,
+     94, 100,  85,  67,  56,  53,  82,  84,
+     32,  24,  13,   5,  -2,   4,  17,  17,
+     13,   9,  -3,  -7,  -7,  -8,   3,  -1,
+      4,   7,  -6,   1,   0,  -5,  -1,  -8,
+     13,   8,   8,  10,  13,   0,   2,  -7,
+      0,   0,   0,   0,   0,   0,   0,   0],
+2: [-58, -38, -13, -28, -31, -27, -63, -99,
+    -25,  -8, -25,  -2,  -9, -25, -24, -52,
+    -24, -20,  10,   9,  -1,  -9, -19, -41,
+    -17,   3,  22,  22,  22,  11,   8, -18,
+    -18,  -6,  16,  25,  16,  17,   4, -18,
+    -23,  -3,  -1,  15,  10,  -3, -20, -22,
+    -42, -20, -10,  -5,  -2, -20, -23, -44,
+    -29, -51, -23, -15, -22, -18, -50, -64],
+3: [-14, -21, -11,  -8,  -7,  -9, -17, -24,
+     -8,  -4,   7, -12,  -3, -13,  -4, -14,
+      2,  -8,   0,  -1,  -2,   6,   0,   4,
+     -3,   9,  12,   9,  14,  10,   3,   2,
+     -6,   3,  13,  19,   7,  10,  -3,  -9,
+    -12,  -3,   8,  10,  13,   3,  -7, -15,
+    -14, -18,  -7,  -1,   4,  -9, -15, -27,
+    -23,  -9, -23,  -5,  -9, -16,  -5, -17],
+4: [ 13,  10,  18,  15,  12,  12,   8,   5,
+     11,  13,  13,  11,  -3,   3,   8,   3,
+      7,   7,   7,   5,   4,  -3,  -5,  -3,
+      4,   3,  13,   1,   2,   1,  -1,   2,
+      3,   5,   8,   4,  -5,  -6,  -8, -11,
+     -4,   0,  -5,  -1,  -7, -12,  -8, -16,
+     -6,  -6,   0,   2,  -9,  -9, -11,  -3,
+     -9,   2,   3,  -1,  -5, -13,   4, -20],
+5: [ -9,  22,  22,  27,  27,  19,  10,  20,
+    -17,  20,  32,  41,  58,  25,  30,   0,
+    -20,   6,   9,  49,  47,  35,  19,   9,
+      3,  22,  24,  45,  57,  40,  57,  36,
+    -18,  28,  19,  47,  31,  34,  39,  23,
+    -16, -27,  15,   6,   9,  17,  10,   5,
+    -22, -23, -30, -16, -16, -23, -36, -32,
+    -33, -28, -22, -43,  -5, -32, -20, -41],
+6: [-74, -35, -18, -18, -11,  15,   4, -17,
+    -12,  17,  14,  17,  17,  38,  23,  11,
+     10,  17,  23,  15,  20,  45,  44,  13,
+     -8,  22,  24,  27,  26,  33,  26,   3,
+    -18,  -4,  21,  24,  27,  23,   9, -11,
+    -19,  -3,  11,  21,  23,  16,   7,  -9,
+    -27, -11,   4,  13,  14,   4,  -5, -17,
+    -53, -34, -21, -11, -28, -14, -24, -43]}
+#contribution of pieces to the game phase, which is 24 with all pieces on the board and 0 with only kings and pawns
+phase_dict = {1: 0, 2: 1, 3: 1, 4: 2, 5: 4, 6: 0}
+max_phase = 24
+
+#eval_mg[piece + 6][square] is the middlegame value (material plus piece-square) of piece on a square of the 
+#120-square board, positive for white and negative for black pieces. likewise eval_eg for the endgame
+eval_mg = [[0]*120 for i in range(13)]
+eval_eg = [[0]*120 for i in range(13)]
+for square in on_board:
+    row = square / 10 - 2 #0 for 1st row
+    col = square % 10 - 1
+    for piece in range(1,7):
+        eval_mg[6 + piece][square] = piece_values_mg[piece] + pst_mg[piece][(7 - row)*8 + col]
+        eval_eg[6 + piece][square] = piece_values_eg[piece] + pst_eg[piece][(7 - row)*8 + col]
+        #black pieces use the tables mirrored vertically
+        eval_mg[6 - piece][square] = -piece_values_mg[piece] - pst_mg[piece][row*8 + col]
+        eval_eg[6 - piece][square] = -piece_values_eg[piece] - pst_eg[piece][row*8 + col]
+
 uni_pieces = {'bR':'♜', 'bN':'♞', 'bB':'♝', 'bQ':'♛', 'bK':'♚', 'bP':'♟',
                   'wR':'♖', 'wN':'♘', 'wB':'♗', 'wQ':'♕', 'wK':'♔', 'wP':'♙', '  ':'  '}
                   
-table = None
-
 def initialise_board():
     """creates initial chess position"""
     board = [0]*120 #empty chess board
@@ -84,6 +237,7 @@ def initialise_board():
     return board
 
 initial_board = tuple(initialise_board())
+empty_board = tuple(0 if square in on_board_set else 100 for square in range(120))
 
 def print_board3(board):
     """prints board using letters and without the edges"""
@@ -113,92 +267,221 @@ def print_board3(board):
 class Position(object):
     """A chess position complete with history"""
     def __init__(self,board = initial_board,sgn = 1,move_seq = (),\
-                num_pieces = 32,old_num_pieces = None,pawn_moved = None,fifty_move_counter = 0,\
-                in_check = None,castling = False,num = 1, wc = (False,False), bc = (True,True), ep = None):
-        global ht
+                num_pieces = None,old_num_pieces = None,pawn_moved = None,fifty_move_counter = 0,\
+                in_check = None,castling = False,num = 1, wc = (False,False), bc = (True,True), ep = None,\
+                moved = frozenset()):
         
         self.board = list(board)
         self.sgn = sgn
         self.move_seq = list(move_seq)
         self.num = num
-        self.num_pieces = num_pieces
         self.old_num_pieces = old_num_pieces
         self.pawn_moved = pawn_moved #was the last move a pawn move?
         self.fifty_move_counter = fifty_move_counter
         self.in_check = in_check #is current player in check?
         self.castling = castling #was last move castling move?
-        self.history = [self.board[:]]
-        self.fmh = [self.fifty_move_counter]
-        
         self.wc = wc #default args wc and bc need to be immutable
         self.bc = bc
-        self.wch = [self.wc]
-        self.bch = [self.bc]
         self.ep = ep
-        self.eph = [self.ep]
-        
-        ht = dict()
-        zobrist_init()
-        h = zobrist_hash(self)
-        ht["ordered"] = [h]
-        ht[h] = {"moves": [0]}
+        #squares kings or rooks moved from before move_seq, which update_rights takes into account like the moves in move_seq
+        self.moved = moved
+        #set by from_fen until settle_castling has checked the castling rights of the player to move against attacks
+        self.castling_pending = False
+        #one record per move made: (move, captured piece, wc, bc, ep, fifty_move_counter, hash,
+        #in_check, castling, pawn_moved, old_num_pieces, num_pieces, mg, eg, phase) as they were before the move
+        self.undo = []
+        #squares occupied by either side and king squares, kept up to date by make_move and unmake_move
+        self.piece_squares = {1: set(), -1: set()}
+        self.kings = {}
+        #middlegame and endgame scores and game phase for evaluate, kept up to date by make_move and unmake_move.
+        #they are computed along with the hash in the same pass as the piece squares, as in eval_terms and zobrist_hash
+        mg = eg = phase = 0
+        h = table[64] if sgn == -1 else 0
+        for square in on_board:
+            piece = self.board[square]
+            if piece != 0:
+                self.piece_squares[1 if piece > 0 else -1].add(square)
+                if piece == 6 or piece == -6:
+                    self.kings[1 if piece > 0 else -1] = square
+                mg += eval_mg[piece + 6][square]
+                eg += eval_eg[piece + 6][square]
+                phase += phase_dict[abs(piece)]
+                h ^= piece_keys[piece + 6][square]
+        self.num_pieces = len(self.piece_squares[1]) + len(self.piece_squares[-1]) if num_pieces is None else num_pieces
+        self.mg, self.eg, self.phase = mg, eg, phase
         
+        self.hash = h ^ rights_hash(wc,bc,ep)
+        #hashes of the positions of the game so far and how often each occurred, for threefold repetition, 
+        #and legal move lists by hash, cached by make_move_list
+        self.hash_history = [self.hash]
+        self.repetitions = {self.hash: 1}
+        self.move_lists = {}
+        self.move_list_calls = 0 #calls of make_move_list for legal moves and how many were answered from move_lists
+        self.move_list_hits = 0
     
-    #make rollback method: just keep track of past board positions, infer other attributes from there
-    
-    def rollback(self,depth):
-        """reverts to previous board position. depth = 1 corresponds to directly previous one"""
+    def __getstate__(self):
+        """pickles the position without its cached move lists, e.g. to send it to another process"""
+        state = dict(self.__dict__)
+        state["move_lists"] = {}
+        return state
         
-        #print "rollback depth=",depth
-        #print "before rollback:"
-        #self.print_board2()
-        #print "move_seq=",self.move_seq
-        #print "before rollback board history"
-        #for b in self.history:
-        #    print_board3(b)
-        #    print "\n"
-        #print "self.fmh=",self.fmh
-        self.board = self.history[-1-depth]
-        self.sgn *= (-1)**depth 
-        self.move_seq = self.move_seq[:-depth]
-        #print "updated move_seq=",self.move_seq
-        self.num -= depth
-        
-        ht["ordered"] = ht["ordered"][:-depth]
+    
+    @classmethod
+    def from_fen(cls,fen):
+        """creates a Position from a FEN string. a missing castling right with king and rook on their squares 
+        is recorded in moved, an e.p. square as the double step in move_seq. as for positions reached by moves, 
+        the castling rights of the player to move say whether castling is legal now"""
+        fields = fen.split()
+        board = list(empty_board)
+        square = 91
+        for letter in fields[0]:
+            if letter == "/":
+                square -= 18
+            elif letter.isdigit():
+                square += int(letter)
+            else:
+                board[square] = fen_pieces[letter]
+                square += 1
+        sgn = 1 if fields[1] == "w" else -1
+        rights = fields[2] if len(fields) > 2 else "-"
+        moved = frozenset(sq for letter,sq in (("K",28),("Q",21),("k",98),("q",91)) if letter not in rights)
+        wc = ("K" in rights and board[25] == 6 and board[28] == 4,"Q" in rights and board[25] == 6 and board[21] == 4)
+        bc = ("k" in rights and board[95] == -6 and board[98] == -4,"q" in rights and board[95] == -6 and board[91] == -4)
+        move_seq = ()
+        ep = None
+        if len(fields) > 3 and fields[3] != "-":
+            target = (int(fields[3][1]) + 1) * 10 + col_dict_[fields[3][0]]
+            move_seq = ((target + 10*sgn,target - 10*sgn),)
+            #as in update_rights, the e.p. column is only set if a pawn can take e.p.
+            if sgn in (board[target - 10*sgn - 1],board[target - 10*sgn + 1]):
+                ep = target % 10
+        fifty_move_counter = int(fields[4]) if len(fields) > 4 else 0
+        num = 2 * int(fields[5]) - (1 if sgn == 1 else 0) if len(fields) > 5 else (1 if sgn == 1 else 2)
+        pos = cls(board,sgn,move_seq,fifty_move_counter = fifty_move_counter,num = num,wc = wc,bc = bc,ep = ep,moved = moved)
         
-        self.num_pieces = sum(1 if self.board[square] != 0 else 0 for square in on_board)
-        self.old_num_pieces = sum(1 if self.history[-1-depth][square] != 0 else 0 for square in on_board)
-        self.pawn_moved = abs(self.move_seq[-depth][0]) == 1 if len(self.move_seq) > 0 else False    
-        self.fifty_move_counter = self.fmh[-1 - depth]
-        self.in_check = None #maybe change
-        if len(self.move_seq) > 0:
-            self.castling = abs(self.board[self.move_seq[-depth][0]]) == 6 and abs(self.move_seq[-depth][1]-self.move_seq[-depth][0]) == 2
+        #is the player to move in check? whether it can castle now is left to settle_castling
+        pos.sgn = -sgn
+        pos.in_check = pos.is_attacked(pos.kings[sgn])
+        pos.sgn = sgn
+        pos.castling_pending = (wc if sgn == 1 else bc) != (False,False)
+        return pos
+    
+    def settle_castling(self):
+        """restricts the castling rights of the player to move of a position from from_fen to castling that is legal 
+        now (not out of, through or into check) and updates the hash. called before the moves, the hash history or 
+        the FEN of the position are first needed, as until then its rights and hash are those of the FEN"""
+        self.castling_pending = False
+        sgn = self.sgn
+        board = self.board
+        king_sq = 60 - 35*sgn
+        c = self.wc if sgn == 1 else self.bc
+        self.sgn = -sgn
+        now = (c[0] and board[king_sq + 1] == board[king_sq + 2] == 0\
+                   and not any(self.is_attacked(sq) for sq in (king_sq,king_sq + 1,king_sq + 2)),
+               c[1] and board[king_sq - 1] == board[king_sq - 2] == board[king_sq - 3] == 0\
+                   and not any(self.is_attacked(sq) for sq in (king_sq,king_sq - 1,king_sq - 2)))
+        self.sgn = sgn
+        if now != c:
+            self.hash ^= rights_hash(self.wc,self.bc,self.ep)
+            if sgn == 1:
+                self.wc = now
+            else:
+                self.bc = now
+            self.hash ^= rights_hash(self.wc,self.bc,self.ep)
+            self.hash_history = [self.hash]
+            self.repetitions = {self.hash: 1}
+    
+    def to_fen(self):
+        """returns the FEN string of the position. the castling rights of the player to move are worked out 
+        from the board and the history as in update_rights, since its wc or bc only say whether castling is legal now. 
+        the e.p. square is only given if a pawn can take e.p."""
+        if self.castling_pending:
+            self.settle_castling()
+        board = self.board
+        rows = []
+        for rank in range(9,1,-1):
+            row = ""
+            empty = 0
+            for square in range(10*rank + 1,10*rank + 9):
+                if board[square] == 0:
+                    empty += 1
+                else:
+                    if empty:
+                        row += str(empty)
+                        empty = 0
+                    row += fen_letters[board[square]]
+            rows.append(row + (str(empty) if empty else ""))
+        starts = self.moved.union(m[0] for m in self.move_seq)
+        rights = {1: self.wc, -1: self.bc}
+        king_sq = 60 - 35*self.sgn
+        if board[king_sq] == 6*self.sgn and king_sq not in starts:
+            rights[self.sgn] = tuple(board[rook_sq] == 4*self.sgn and rook_sq not in starts for rook_sq in (king_sq + 3,king_sq - 4))
         else:
-            self.castling = False
-        #just need to keep track of history from tree search onwards -> speedup?
-        new = []
-        for i in range(len(self.history)-1):
-            new.append(self.history[i][:])
-            #for i in range(depth):
-            #    del self.history[-1]
-        self.history = new 
-        self.fmh = self.fmh[:-depth]
-        self.wc = self.wch[-1-depth]
-        self.bc = self.bch[-1-depth]
+            rights[self.sgn] = (False,False)
+        castling = "".join(letter for letter,right in zip("KQkq",rights[1] + rights[-1]) if right) or "-"
+        ep = "-"
+        if self.move_seq:
+            start, finish = self.move_seq[-1][:2]
+            if board[finish] == -self.sgn and abs(finish - start) == 20 and self.sgn in (board[finish - 1],board[finish + 1]):
+                ep = col_dict[finish % 10] + str((start + finish) / 20 - 1)
+        return " ".join(["/".join(rows),"w" if self.sgn == 1 else "b",castling,ep,str(self.fifty_move_counter),\
+                         str((self.num + 1) / 2)])
+    
+    def record_hash(self):
+        """adds the hash of the position just reached to the history"""
+        self.hash_history.append(self.hash)
+        self.repetitions[self.hash] = self.repetitions.get(self.hash,0) + 1
+    
+    def forget_hash(self):
+        """removes the hash of the position being taken back from the history"""
+        self.hash_history.pop()
+        count = self.repetitions[self.hash] - 1
+        if count:
+            self.repetitions[self.hash] = count
+        else:
+            del self.repetitions[self.hash]
+    
+    def unmake_move(self):
+        """takes back the last move made with make_move in constant time, using its undo record"""
+        (move,captured,self.wc,self.bc,self.ep,self.fifty_move_counter,h,self.in_check,self.castling,\
+            self.pawn_moved,self.old_num_pieces,self.num_pieces,self.mg,self.eg,self.phase) = self.undo.pop()
+        self.forget_hash()
+        self.hash = h
+        self.sgn = 1 if self.sgn == -1 else -1
+        self.num -= 1
+        self.move_seq.pop()
         
-        self.wch = self.wch[:-depth]
-        self.bch = self.bch[:-depth]
-
-        self.ep = self.eph[-1-depth]
-        self.eph = self.eph[:-depth]
+        start = move[0]
+        finish = move[1]
+        board = self.board
+        own = self.piece_squares[self.sgn]
+        opp = self.piece_squares[-self.sgn]
+        board[start] = self.sgn if len(move) > 2 else board[finish] #promoted pieces turn back into pawns
+        board[finish] = captured
+        own.remove(finish)
+        own.add(start)
+        if captured != 0:
+            opp.add(finish)
+        piece = board[start]
+        #pawn moved diagonally to an empty square: e.p. capture, so put back the pawn behind finish
+        if piece == self.sgn and abs(finish - start) in (9,11) and captured == 0:
+            board[finish - 10*self.sgn] = -self.sgn
+            opp.add(finish - 10*self.sgn)
+        elif abs(piece) == 6:
+            self.kings[self.sgn] = start
+            #castling: put back the rook
+            if abs(finish - start) == 2:
+                rook_start, rook_finish = (start + 3,start + 1) if finish > start else (start - 4,start - 1)
+                board[rook_start] = board[rook_finish]
+                board[rook_finish] = 0
+                own.remove(rook_finish)
+                own.add(rook_start)
+    
+    def rollback(self,depth):
+        """reverts to previous board position. depth = 1 corresponds to directly previous one"""
+        for i in range(depth):
+            self.unmake_move()
         
-        #print "after_rollback"
-        #self.print_board2()
-        #print "after rollback board history"
-        #for b in self.history:
-        #    print_board3(b)
-        #    print "\n"
-                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                 
     def print_board(self):
         """prints board using numbers"""
         for i in range(12):
@@ -233,11 +516,20 @@ class Position(object):
         
     def make_move(self,move,verbose = False, update_in_check = True, just_board = False):
         """execute a move on the board"""
-        global ht
+        if self.castling_pending:
+            self.settle_castling()
         if move is not None:          
             castling = True if abs(self.board[move[0]]) == 6 and abs(move[1]-move[0]) == 2 else False           
             if not just_board:
-                update_hash(self,ht["ordered"][-1],move)
+                self.undo.append((move,self.board[move[1]],self.wc,self.bc,self.ep,self.fifty_move_counter,self.hash,\
+                                  self.in_check,self.castling,self.pawn_moved,self.old_num_pieces,self.num_pieces,\
+                                  self.mg,self.eg,self.phase))
+                self.mg, self.eg, self.phase = update_eval(self,move)
+                #castling rights and e.p. column are xored out before and back in after update_rights 
+                h = update_hash(self,self.hash,move) ^ rights_hash(self.wc,self.bc,self.ep)
+                update_rights(self,move)
+                self.hash = h ^ rights_hash(self.wc,self.bc,self.ep)
+                self.record_hash()
                 
                 #will other player be in check?                
                 if update_in_check:
@@ -253,6 +545,23 @@ class Position(object):
                 #50 move rule: updating counter if no pawn has moved and a piece has not been captured 
                 self.pawn_moved = abs(self.board[move[0]]) == 1
                 self.old_num_pieces = self.num_pieces
+                
+                #piece squares, king squares and piece count
+                own = self.piece_squares[self.sgn]
+                opp = self.piece_squares[-self.sgn]
+                own.remove(move[0])
+                own.add(move[1])
+                if self.board[move[1]] != 0:
+                    opp.remove(move[1])
+                    self.num_pieces -= 1
+                elif self.pawn_moved and abs(move[1]-move[0]) in (9,11): #e.p.
+                    opp.remove(move[1] - 10*self.sgn)
+                    self.num_pieces -= 1
+                if abs(self.board[move[0]]) == 6:
+                    self.kings[self.sgn] = move[1]
+                    if castling:
+                        own.remove(move[0] + 3 if move[1] > move[0] else move[0] - 4)
+                        own.add(move[0] + 1 if move[1] > move[0] else move[0] - 1)
  
             #if pawn promotes
             if len(move) > 2:
@@ -288,13 +597,10 @@ class Position(object):
             self.board[move[0]] = 0
         
         if not just_board:    
-            self.num_pieces = sum(1 if self.board[square] != 0 else 0 for square in on_board)
-            
             if self.num_pieces == self.old_num_pieces and not self.pawn_moved:
                 self.fifty_move_counter += 1
             else:
                 self.fifty_move_counter = 0
-            self.fmh.append(self.fifty_move_counter)
                       
             if verbose:
                 #print board
@@ -302,7 +608,6 @@ class Position(object):
             self.num += 1
             if verbose:
                 print "\n"
-            self.history.append(self.board[:])
                                
         self.sgn = 1 if self.sgn == -1 else -1
         #if not just_board:
@@ -310,110 +615,114 @@ class Position(object):
         #    print "wc =",self.wc
         #    print "bc =",self.bc
 
-    def calc_offsets(self,piece,pos,with_castling = True,in_check = None):
-        """determine potential offsets for a given piece type on a certain position on the board"""
-        #print "calc offsets"
-        #print "piece=", piece
-        #print "pos=",pos
-        piece_sgn = 1 if self.board[pos] > 0 else -1
-        
+    def make_null_move(self):
+        """passes the turn for null move pruning. the hash toggles the side to move and drops the e.p. column.
+        the other side's castling rights are withdrawn, since only in-principle rights are known for it. 
+        must not be made in check, and is taken back with unmake_null_move"""
+        if self.castling_pending:
+            self.settle_castling()
+        self.undo.append((None,0,self.wc,self.bc,self.ep,self.fifty_move_counter,self.hash,\
+                          self.in_check,self.castling,self.pawn_moved,self.old_num_pieces,self.num_pieces,\
+                          self.mg,self.eg,self.phase))
+        h = self.hash ^ table[64] ^ rights_hash(self.wc,self.bc,self.ep)
+        if self.sgn == 1:
+            self.bc = (False,False)
+        else:
+            self.wc = (False,False)
+        self.ep = None
+        self.hash = h ^ rights_hash(self.wc,self.bc,self.ep)
+        self.record_hash()
+        self.in_check = False
+        self.castling = False
+        self.pawn_moved = False
+        self.old_num_pieces = self.num_pieces
+        self.fifty_move_counter += 1
+        self.num += 1
+        self.sgn = 1 if self.sgn == -1 else -1
+    
+    def unmake_null_move(self):
+        """takes back make_null_move"""
+        (move,captured,self.wc,self.bc,self.ep,self.fifty_move_counter,h,self.in_check,self.castling,\
+            self.pawn_moved,self.old_num_pieces,self.num_pieces,self.mg,self.eg,self.phase) = self.undo.pop()
+        self.forget_hash()
+        self.hash = h
+        self.num -= 1
+        self.sgn = 1 if self.sgn == -1 else -1
+
+    def calc_targets(self,piece,pos,with_castling = True):
+        """determine potential target squares for a given piece type on a certain position on the board.
+        knight and king targets may still hold own pieces"""
+        board = self.board
         #knight
         if piece == 2:
-            if pos % 10 == 1: #knight on a file
-                offsets = [21,19,12,-21,-19,-8]
-            elif pos % 10 == 8: #knight on h file
-                offsets = [21,19,8,-21,-19,-12]
-            else:
-                offsets = [21,19,8,12,-21,-19,-8,-12] #knight somewhere else
+            return knight_targets[pos]
         #king
-        elif piece == 6: 
-            offsets = [-11,-10,-9,-1,1,9,10,11]
-            #print "calc_offsets with king"
-            #print "with_castling =",with_castling
-            #print "sgn =",self.sgn, "wc =",self.wc,"bc =",self.bc
-            if with_castling:               
+        if piece == 6: 
+            targets = list(king_targets[pos])
+            #castling rights passed to Position are only trusted if king and rook are on their squares
+            if with_castling and pos == 60 - 35*self.sgn:               
                 if self.sgn == 1:
-                    if self.wc[0] == True:
-                        offsets.append(2)
-                    if self.wc[1] == True:
-                        offsets.append(-2)
+                    if self.wc[0] == True and board[28] == 4:
+                        targets.append(27)
+                    if self.wc[1] == True and board[21] == 4:
+                        targets.append(23)
                 else:
-                    if self.bc[0] == True:
-                        offsets.append(2)
-                    if self.bc[1] == True:
-                        offsets.append(-2) 
-            #print "offsets =",offsets             
+                    if self.bc[0] == True and board[98] == -4:
+                        targets.append(97)
+                    if self.bc[1] == True and board[91] == -4:
+                        targets.append(93) 
+            return targets
+        piece_sgn = 1 if board[pos] > 0 else -1
+        targets = []
         #pawn
-        elif piece == 1:
-            a = 56 - piece_sgn*25
-            b = 64 - piece_sgn*25
-            offsets = []
-            if self.board[pos + piece_sgn*10] == 0:
-                offsets.append(piece_sgn*10)
-                if pos in range(a,b) and self.board[pos + piece_sgn*20] == 0:
-                    offsets.append(piece_sgn*20)
-            #if can capture diagonally or en passant, add offset
-            c = 56 + 5*piece_sgn
-            d = 64 + 5*piece_sgn
-            #topleft or bottomright
-            if piece_sgn * self.board[pos + piece_sgn*9] < 0:
-                offsets.append(self.sgn*9)
-            elif len(self.move_seq) > 0:
-                if (pos in range(c,d) and self.move_seq[-1] == (pos+piece_sgn*19,pos-piece_sgn) and self.board[pos-piece_sgn] == -1*piece_sgn): #pawn to the left
-                    offsets.append(piece_sgn*9)
-            #topright or bottomleft
-            if piece_sgn * self.board[pos + piece_sgn*11] < 0:
-                offsets.append(piece_sgn*11) 
-            elif len(self.move_seq) > 0:
-                if (pos in range(c,d) and self.move_seq[-1] == (pos+piece_sgn*21,pos+piece_sgn) and self.board[pos+piece_sgn] == -1*piece_sgn): #pawn to the right
-                    offsets.append(piece_sgn*11)
-        else:
-            #bishop
-            if piece == 3:
-                directions = [11,-11,9,-9]
-                #11 is topright direction, -11 is bottomleft, 9 is topleft, -9 is bottomright
-            #rook
-            elif piece == 4:
-                directions = [10,-10,1,-1] #10 is up, -10 is down, 1 is right, -1 is left
-            #queen
-            elif piece == 5: 
-                directions = [11,-11,9,-9, 10,-10,1,-1] #bishop and rook directions            
-            offsets = []
-            for d in directions:
-                i = 1
-                while piece_sgn * self.board[pos + d*i] <= 0:
-                    offsets.append(d*i)
-                    if piece_sgn * self.board[pos + d*i] < 0:
-                        break
-                    else:
-                        i += 1
-        return offsets  
+        if piece == 1:
+            ahead = pos + piece_sgn*10
+            if board[ahead] == 0:
+                targets.append(ahead)
+                #double step from 2nd (7th) row
+                if 56 - piece_sgn*25 <= pos < 64 - piece_sgn*25 and board[ahead + piece_sgn*10] == 0:
+                    targets.append(ahead + piece_sgn*10)
+            #if can capture diagonally or en passant (opponent pawn has just double-stepped next to it), add target
+            for target in pawn_attacks[piece_sgn][pos]:
+                if piece_sgn * board[target] < 0:
+                    targets.append(target)
+                elif len(self.move_seq) > 0 and self.move_seq[-1] == (target + piece_sgn*10,target - piece_sgn*10)\
+                    and board[target - piece_sgn*10] == -piece_sgn:
+                    targets.append(target)
+            return targets
+        #bishop, rook, queen
+        for d in piece_directions[piece]:
+            for target in rays[pos][d]:
+                target_piece = board[target]
+                if piece_sgn * target_piece > 0:
+                    break
+                targets.append(target)
+                if target_piece != 0:
+                    break
+        return targets
 
     def attacks(self,a,b):
         """returns True if there is a piece on square a attacking square b"""    
         piece = self.board[a]
         if piece == 0:
-            #print "piece is 0"
             return False
         sgn = 1 if piece > 0 else -1
         if abs(piece) != 1:
-            #print "b=",b
-            #print "a=",a
-            return b-a in self.calc_offsets(sgn*piece,a,with_castling = False) 
+            return b in self.calc_targets(sgn*piece,a,with_castling = False) 
         else:
-            return b-a in (sgn*9,sgn*11)    
+            return b in pawn_attacks[sgn][a]
 
     def is_attacked(self,square,di = None,smallest = False,p = None):
         """returns True if square is attacked by player whose turn it is"""
         #check whether there are pawns diagonally opposite or knights an L-offset away or king adjacent
         #then check along rows/columns (rooks, queens) and diagonals (bishops, queens) until hit a piece
-        #print "calling is_attacked with square =",square
+        board = self.board
+        sgn = self.sgn
         if smallest: 
             attacking_pieces = []
             
-        for offset in [-9*self.sgn,-11*self.sgn]: #check pawns
-            new_sq = square+offset
-            if self.board[new_sq] == self.sgn:
+        for new_sq in pawn_attacks[-sgn][square]: #check pawns
+            if board[new_sq] == sgn:
                 if not smallest:
                     return True
                 if smallest and ((new_sq,square) in p or (new_sq,square,2) in p\
@@ -421,47 +730,35 @@ class Position(object):
                     return True, (1,new_sq)
                 
         #check knights    
-        if square % 10 == 1: #square on a file
-            offsets = [21,19,12,-21,-19,-8]
-        elif square % 10 == 8: #square on h file
-            offsets = [21,19,8,-21,-19,-12]
-        else:
-            offsets = [21,19,8,12,-21,-19,-8,-12] #square somewhere else
-        for offset in offsets:
-            new_sq = square + offset
-            if self.board[new_sq] == 2*self.sgn:
+        for new_sq in knight_targets[square]:
+            if board[new_sq] == 2*sgn:
                 if not smallest:
                     return True 
                 if smallest and (new_sq,square) in p:
                     return True, (2,new_sq)
                 
         #check rows (rooks and queens) and diagonals (bishops and queens)
-        for a,b,c in [("d1",9,3),("d2",11,3),("d3",1,4),("d4",10,4)]:
+        for a,b,c in line_types:
             if di is None or di == "d0" or di == a:
-                for direction in [b,-b]: 
-                    new_sq = square + direction
-                    while new_sq in on_board:
-                        if self.board[new_sq] in (c*self.sgn,5*self.sgn):
+                for direction in (b,-b): 
+                    for new_sq in rays[square][direction]:
+                        piece = board[new_sq]
+                        if piece == c*sgn or piece == 5*sgn:
                             if not smallest:
                                 return True
-                            if smallest and (new_sq,square) in p:
-                                attacking_pieces.append((abs(self.board[new_sq]),new_sq))
+                            if (new_sq,square) in p:
+                                attacking_pieces.append((abs(piece),new_sq))
                                 break
-                            else:
-                                new_sq += direction
-                        elif self.board[new_sq] != 0:
+                        elif piece != 0:
                             break
-                        else:
-                            new_sq += direction
                 if di == a: return False
      
-        for offset in [-11,-10,-9,-1,1,9,10,11]: #check king
-            new_sq = square + offset
-            if self.board[new_sq] == 6*self.sgn:
+        for new_sq in king_targets[square]: #check king
+            if board[new_sq] == 6*sgn:
                 if not smallest:
                     return True
                 if smallest and (new_sq,square) in p:
-                    attacking_pieces.append((abs(self.board[new_sq]),new_sq))
+                    attacking_pieces.append((6,new_sq))
                     break
                 
         if smallest:
@@ -477,15 +774,15 @@ class Position(object):
         if move == None and self.in_check == True:
             return True
         if move == None or self.in_check != False: #in_check might be unknown
+            kings_square = self.kings[self.sgn] if move is None or abs(self.board[move[0]]) != 6 else move[1]
             old_board = self.board[:]
             self.make_move(move,update_in_check = False,just_board = True) #avoid infinite recursion
-            kings_square = self.board.index(self.sgn* -6)
             a = self.is_attacked(kings_square)
             self.board = old_board[:]
             self.sgn = 1 if self.sgn == -1 else -1
             #print "1st case", a
             return a
-        kings_square = self.board.index(self.sgn*6)
+        kings_square = self.kings[self.sgn]
         col_diff = move[0] % 10 - kings_square % 10
         row_diff = move[0]/10 - kings_square/10
         
@@ -501,9 +798,10 @@ class Position(object):
         elif move[0]/10 == kings_square/10:
             di="d3"    
         if di is not None: #piece might have been pinned
+            if di == "d0":
+                kings_square = move[1]
             old_board = self.board[:]
             self.make_move(move,update_in_check = False,just_board = True) #avoid infinite recursion
-            kings_square = self.board.index(self.sgn* -6)
             #print kings_square
             a = self.is_attacked(kings_square,di)
             self.board = old_board[:]
@@ -517,7 +815,7 @@ class Position(object):
     def check_check(self,move,castling):
         """determines whether move puts other player in check. castling indicates whether move is a castling move"""
      
-        opp_king_sq = self.board.index(-6*self.sgn)
+        opp_king_sq = self.kings[-self.sgn]
         #self.print_board2()
         #print "examining", printable_moves(move)
         #print printable_moves(self.move_seq)
@@ -553,15 +851,17 @@ class Position(object):
             if a:
                 check_castling = False
                 direction = -c if b else c
-                new_sq = move[0] + direction
-                while new_sq in on_board:
-                    if self.board[new_sq] in (-d*self.sgn,-5*self.sgn):
-                        rollback()
-                        return True
-                    elif self.board[new_sq] != 0:
+                #a piece behind move[0] only gives check if nothing stands between move[0] and the king
+                for new_sq in rays[move[0]][-direction]:
+                    if new_sq == opp_king_sq or self.board[new_sq] != 0:
                         break
-                    else:
-                        new_sq += direction
+                if new_sq == opp_king_sq:
+                    for new_sq in rays[move[0]][direction]:
+                        if self.board[new_sq] in (-d*self.sgn,-5*self.sgn):
+                            rollback()
+                            return True
+                        elif self.board[new_sq] != 0:
+                            break
                 break                                                                        
 
         if check_castling:
@@ -586,6 +886,208 @@ class Position(object):
         rollback()
         return False
         
+    def checks_and_pins(self):
+        """returns the squares of the opponent's pieces giving check to the king of the player whose turn it is,
+        the squares a move has to go to in order to stop a check (None if not in check) and a dict mapping 
+        squares of pinned own pieces to the squares on the line of the pin"""
+        board = self.board
+        sgn = self.sgn
+        king_sq = self.kings[sgn]
+        checkers = [sq for sq in pawn_attacks[sgn][king_sq] if board[sq] == -sgn]
+        checkers += [sq for sq in knight_targets[king_sq] if board[sq] == -2*sgn]
+        blocks = list(checkers)
+        pins = {}
+        for direction in bishop_directions + rook_directions:
+            slider = 3 if direction in bishop_directions else 4
+            pinned = None
+            for i,sq in enumerate(rays[king_sq][direction]):
+                piece = board[sq]
+                if piece == 0:
+                    continue
+                if sgn*piece > 0:
+                    if pinned is not None:
+                        break
+                    pinned = sq
+                    continue
+                if piece in (-slider*sgn,-5*sgn):
+                    line = rays[king_sq][direction][:i + 1]
+                    if pinned is None:
+                        checkers.append(sq)
+                        blocks += line
+                    else:
+                        pins[pinned] = frozenset(line)
+                break
+        return checkers,(frozenset(blocks) if checkers else None),pins
+
+    def legal_moves(self,with_castling = True):
+        """list legal moves in the form of make_move_list, using the checking and pinned pieces: 
+        in double check only the king moves, in check other moves have to capture the checking piece or block the check,
+        pinned pieces stay on the line of the pin. king moves and e.p. captures are tested by making them on the board"""
+        if self.castling_pending:
+            self.settle_castling()
+        board = self.board
+        sgn = self.sgn
+        king_sq = self.kings[sgn]
+        checkers,blocks,pins = self.checks_and_pins()
+        move_list = []
+        
+        #king moves: target square must not be attacked once the king has left its square
+        board[king_sq] = 0
+        self.sgn = -sgn
+        for target in king_targets[king_sq]:
+            if sgn*board[target] <= 0 and not self.is_attacked(target):
+                move_list.append((king_sq,target))
+        #castling: king not in check, squares inbetween empty and king not passing or landing on an attacked square
+        if with_castling and not checkers and king_sq == 60 - 35*sgn:
+            c = self.wc if sgn == 1 else self.bc
+            if c[0] and board[king_sq + 3] == 4*sgn and board[king_sq + 1] == board[king_sq + 2] == 0\
+                and not self.is_attacked(king_sq + 1) and not self.is_attacked(king_sq + 2):
+                move_list.append((king_sq,king_sq + 2))
+            if c[1] and board[king_sq - 4] == 4*sgn and board[king_sq - 1] == board[king_sq - 2] == board[king_sq - 3] == 0\
+                and not self.is_attacked(king_sq - 1) and not self.is_attacked(king_sq - 2):
+                move_list.append((king_sq,king_sq - 2))
+        self.sgn = sgn
+        board[king_sq] = 6*sgn
+        if len(checkers) > 1:
+            return move_list
+        
+        for pos in self.piece_squares[sgn]:
+            piece = sgn*board[pos]
+            pin = pins.get(pos)
+            if piece == 1:
+                for target in self.calc_targets(1,pos):
+                    if board[target] == 0 and (target - pos) % 10 != 0: #e.p.
+                        if self.ep_exposes_king(pos,target):
+                            continue
+                    elif (pin is not None and target not in pin) or (blocks is not None and target not in blocks):
+                        continue
+                    #if pawn moves to last row (8th or 1st), promote to N/B/R/Q
+                    if 28 < target < 91:
+                        move_list.append((pos,target))
+                    else:
+                        for promoted_to in (2,3,4,5):
+                            move_list.append((pos,target,promoted_to))
+            elif piece == 2:
+                if pin is None: #a pinned knight can't move
+                    for target in knight_targets[pos]:
+                        if sgn*board[target] <= 0 and (blocks is None or target in blocks):
+                            move_list.append((pos,target))
+            elif piece != 6:
+                for d in piece_directions[piece]:
+                    ray = rays[pos][d]
+                    #a pinned piece can only move along the line of the pin
+                    if not ray or (pin is not None and ray[0] not in pin):
+                        continue
+                    for target in ray:
+                        target_piece = board[target]
+                        if sgn*target_piece > 0:
+                            break
+                        if blocks is None or target in blocks:
+                            move_list.append((pos,target))
+                        if target_piece != 0:
+                            break
+        return move_list
+
+    def pseudo_moves(self,captures = True,with_castling = True):
+        """yields pseudo-legal moves of the player whose turn it is, in the form of make_move_list: 
+        captures (including e.p.) and promotions if captures is True, all other moves including castling if it is False
+        and all moves if it is None"""
+        board = self.board
+        sgn = self.sgn
+        for pos in self.piece_squares[sgn]:
+            piece = sgn*board[pos]
+            for target in self.calc_targets(piece,pos,with_castling = False):
+                target_piece = sgn*board[target]
+                if target_piece > 0:
+                    continue
+                if piece == 1:
+                    if not 28 < target < 91:
+                        if captures is not False:
+                            for promoted_to in (5,4,3,2):
+                                yield (pos,target,promoted_to)
+                    elif captures is None or ((target - pos) % 10 != 0) == captures:
+                        yield (pos,target)
+                elif captures is None or (target_piece < 0) == captures:
+                    yield (pos,target)
+        if with_castling and captures is not True and self.kings[sgn] == 60 - 35*sgn:
+            king_sq = 60 - 35*sgn
+            c = self.wc if sgn == 1 else self.bc
+            if c[0]:
+                yield (king_sq,king_sq + 2)
+            if c[1]:
+                yield (king_sq,king_sq - 2)
+
+    def is_pseudo_legal(self,move):
+        """returns True if move, e.g. a hash move or killer move from another position, could be made 
+        by the player whose turn it is, not considering whether it leaves the own king in check"""
+        sgn = self.sgn
+        piece = sgn*self.board[move[0]]
+        if piece <= 0 or sgn*self.board[move[1]] > 0:
+            return False
+        if piece == 6 and abs(move[1] - move[0]) == 2:
+            return move[0] == 60 - 35*sgn and len(move) == 2
+        if move[1] not in self.calc_targets(piece,move[0],with_castling = False):
+            return False
+        return (len(move) > 2) == (piece == 1 and not 28 < move[1] < 91)
+
+    def is_legal(self,move,checks = None):
+        """returns True if pseudo-legal move doesn't leave the own king in check. 
+        checks is the result of checks_and_pins for the position, computed if not given"""
+        checkers,blocks,pins = checks if checks is not None else self.checks_and_pins()
+        board = self.board
+        sgn = self.sgn
+        start = move[0]
+        target = move[1]
+        if board[start] == 6*sgn:
+            squares = [target]
+            if abs(target - start) == 2:
+                #castling: king not in check, squares inbetween empty and not passing an attacked square
+                step = 1 if target > start else -1
+                rook_sq = start + 3 if step == 1 else start - 4
+                c = self.wc if sgn == 1 else self.bc
+                if checkers or not c[0 if step == 1 else 1] or board[rook_sq] != 4*sgn\
+                    or any(board[sq] != 0 for sq in range(start + step,rook_sq,step)):
+                    return False
+                squares.append(start + step)
+            #target square must not be attacked once the king has left its square
+            board[start] = 0
+            self.sgn = -sgn
+            attacked = any(self.is_attacked(sq) for sq in squares)
+            self.sgn = sgn
+            board[start] = 6*sgn
+            return not attacked
+        if len(checkers) > 1:
+            return False
+        if board[start] == sgn and board[target] == 0 and (target - start) % 10 != 0: #e.p.
+            return not self.ep_exposes_king(start,target)
+        pin = pins.get(start)
+        return (pin is None or target in pin) and (blocks is None or target in blocks)
+
+    def any_legal_move(self):
+        """returns a legal move of the player whose turn it is, or None in case of checkmate or stalemate"""
+        checks = self.checks_and_pins()
+        for move in self.pseudo_moves(None):
+            if self.is_legal(move,checks):
+                return move
+        return None
+
+    def ep_exposes_king(self,start,target):
+        """returns True if taking e.p. from start to target would leave the own king attacked.
+        both pawns leave their squares, so this can uncover an attack along a row"""
+        board = self.board
+        sgn = self.sgn
+        captured_on = target - 10*sgn
+        board[start] = 0
+        board[captured_on] = 0
+        board[target] = sgn
+        self.sgn = -sgn
+        exposed = self.is_attacked(self.kings[sgn])
+        self.sgn = sgn
+        board[target] = 0
+        board[captured_on] = -sgn
+        board[start] = sgn
+        return exposed
+
     def make_move_list(self,check_for_king_hanging = True, with_castling = True):
         """list legal moves in a given position in the form: (old field,new field)
         for white: colour = "white", for black: colour = "black"
@@ -593,59 +1095,279 @@ class Position(object):
         infinite recursion when checking whether castling puts the king in check 
         (opponent's castling needn't be considered as a response to determine 
         whether king is in check after castling)"""
-        global mml_calls, mml_hash_returns
+        if self.castling_pending:
+            self.settle_castling()
         if check_for_king_hanging and with_castling:
-            mml_calls += 1
-        if check_for_king_hanging and with_castling and "move_list" in ht[ht["ordered"][-1]]:
-            #print "looked up move_list"
-            mml_hash_returns += 1
-            return ht[ht["ordered"][-1]]["move_list"] 
+            self.move_list_calls += 1
+            if self.hash in self.move_lists:
+                self.move_list_hits += 1
+                return self.move_lists[self.hash]
        
-        move_list = []
-        #print "calling make_move_list, colour=",colour,"check_for_king_hanging=",check_for_king_hanging
+        if check_for_king_hanging:
+            move_list = self.legal_moves(with_castling)
+            if with_castling:
+                self.move_lists[self.hash] = move_list
+            return move_list
         
-        pairs = ((pair[0],abs(pair[1])) for pair in enumerate(self.board) if pair[0] in on_board and self.sgn*pair[1] > 0)
-        for pos, piece in pairs:
-            offsets = self.calc_offsets(piece,pos,with_castling = with_castling)
-            potential_targets = [pos + offset for offset in offsets]
-            potential_targets = [target for target in potential_targets if target in on_board]
-            targets = (target for target in potential_targets if self.sgn*self.board[target] <= 0) if piece != 1 else potential_targets # pawns already checked
+        #pseudo-legal moves, which may leave the own king in check
+        move_list = []
+        board = self.board
+        sgn = self.sgn
+        for pos in self.piece_squares[sgn]:
+            piece = sgn*board[pos]
+            targets = self.calc_targets(piece,pos,with_castling = with_castling)
             #if pawn moves to last row (8th or 1st), promote to N/B/R/Q
             if piece == 1:
                 for target in targets:
-                    if target not in range(21,29)+range(91,99):
+                    if 28 < target < 91:
                         move_list.append((pos,target))
                     else:
                         for promoted_to in (2,3,4,5):
                             move_list.append((pos,target,promoted_to))
             else:
                 for target in targets:
+                    if sgn*board[target] <= 0: # pawns already checked
+                        move_list.append((pos,target))
+        return move_list
+
+#bitboard backend: bit i of a bitboard stands for square on_board[i], so a1 is bit 0, h1 bit 7 and h8 bit 63
+knight_bb = [sum(1 << square_index[t] for t in knight_targets[square]) for square in on_board]
+king_bb = [sum(1 << square_index[t] for t in king_targets[square]) for square in on_board]
+pawn_bb = dict((sgn,[sum(1 << square_index[t] for t in pawn_attacks[sgn][square]) for square in on_board]) for sgn in (1,-1))
+#ray_bb[i][direction] holds the squares from bit i to the edge of the board in a direction of the 120-square board.
+#positive directions run towards higher bits, so the nearest blocker on them is the lowest set bit
+ray_bb = [dict((d,sum(1 << square_index[t] for t in rays[square][d])) for d in bishop_directions + rook_directions)\
+          for square in on_board]
+
+def slider_attacks(i,occ,directions):
+    """returns the squares attacked from bit i along directions, given occupied squares occ, as a bitboard.
+    every ray is cut off behind its first blocker by removing the ray of the blocker itself"""
+    attacks = 0
+    for d in directions:
+        ray = ray_bb[i][d]
+        blockers = ray & occ
+        if blockers:
+            if d > 0:
+                j = (blockers & -blockers).bit_length() - 1
+            else:
+                j = blockers.bit_length() - 1
+            ray ^= ray_bb[j][d]
+        attacks |= ray
+    return attacks
+
+class BitboardPosition(object):
+    """A chess position held as one bitboard (a Python int used as a set of 64 squares) per piece type, 
+    alternative to Position. board is kept alongside for looking up the piece on a square and for hashing.
+    moves are in the format of Position. wc and bc are the standard castling rights of both sides, (kingside, queenside), 
+    which only count if king and rook are on their initial squares"""
+    def __init__(self,board = initial_board,sgn = 1,move_seq = (),fifty_move_counter = 0,\
+                num = 1, wc = (True,True), bc = (True,True), ep = None):
+        self.board = list(board)
+        self.sgn = sgn
+        self.move_seq = list(move_seq)
+        self.num = num
+        self.fifty_move_counter = fifty_move_counter
+        self.bb = [0]*13 #indexed by piece + 6
+        self.occ = {1: 0, -1: 0}
+        for i,square in enumerate(on_board):
+            piece = self.board[square]
+            if piece:
+                self.bb[piece + 6] |= 1 << i
+                self.occ[1 if piece > 0 else -1] |= 1 << i
+        self.wc = (wc[0] and self.board[25] == 6 and self.board[28] == 4, wc[1] and self.board[25] == 6 and self.board[21] == 4)
+        self.bc = (bc[0] and self.board[95] == -6 and self.board[98] == -4, bc[1] and self.board[95] == -6 and self.board[91] == -4)
+        self.ep = ep
+        #one record per move made: (move, captured piece, wc, bc, ep, fifty_move_counter, hash, in_check) as they were before the move
+        self.undo = []
+        self.in_check = self.attacked(self.king(self.sgn),-self.sgn)
+        self.hash = zobrist_hash(self)
+
+    def king(self,sgn):
+        """returns the bit index of the king of colour sgn"""
+        return self.bb[6 + 6*sgn].bit_length() - 1
+
+    def attacked(self,i,by):
+        """returns True if the square with bit index i is attacked by the pieces of colour by"""
+        bb = self.bb
+        if knight_bb[i] & bb[6 + 2*by] or king_bb[i] & bb[6 + 6*by] or pawn_bb[-by][i] & bb[6 + by]:
+            return True
+        occ = self.occ[1] | self.occ[-1]
+        queens = bb[6 + 5*by]
+        return bool(slider_attacks(i,occ,bishop_directions) & (bb[6 + 3*by] | queens)\
+                    or slider_attacks(i,occ,rook_directions) & (bb[6 + 4*by] | queens))
+
+    def is_attacked(self,square):
+        """returns True if square is attacked by player whose turn it is"""
+        return self.attacked(square_index[square],self.sgn)
+
+    def move_piece(self,piece,start,finish):
+        """moves piece from square start to square finish on board and bitboards"""
+        bits = (1 << square_index[start]) | (1 << square_index[finish])
+        self.bb[piece + 6] ^= bits
+        self.occ[1 if piece > 0 else -1] ^= bits
+        self.board[start] = 0
+        self.board[finish] = piece
+
+    def toggle_piece(self,piece,square):
+        """puts piece on square if it is empty, or removes it from there"""
+        bit = 1 << square_index[square]
+        self.bb[piece + 6] ^= bit
+        self.occ[1 if piece > 0 else -1] ^= bit
+        self.board[square] = 0 if self.board[square] else piece
+
+    def make_move(self,move,update_in_check = True):
+        """execute a move on the board"""
+        start = move[0]
+        finish = move[1]
+        sgn = self.sgn
+        board = self.board
+        piece = board[start]
+        captured = board[finish]
+        self.undo.append((move,captured,self.wc,self.bc,self.ep,self.fifty_move_counter,self.hash,self.in_check))
+        h = update_hash(self,self.hash,move) ^ rights_hash(self.wc,self.bc,self.ep)
+        
+        if captured:
+            self.toggle_piece(captured,finish)
+        self.move_piece(piece,start,finish)
+        if len(move) > 2: #promotion
+            self.toggle_piece(piece,finish)
+            self.toggle_piece(sgn*move[2],finish)
+        elif piece == sgn and not captured and abs(finish - start) in (9,11): #e.p.
+            self.toggle_piece(-sgn,finish - 10*sgn)
+        elif piece == 6*sgn and abs(finish - start) == 2: #castling
+            if finish > start:
+                self.move_piece(4*sgn,start + 3,start + 1)
+            else:
+                self.move_piece(4*sgn,start - 4,start - 1)
+        
+        #castling rights are lost when king or rook move or the rook is captured
+        if self.wc != (False,False):
+            self.wc = (self.wc[0] and start not in (25,28) and finish != 28, self.wc[1] and start not in (25,21) and finish != 21)
+        if self.bc != (False,False):
+            self.bc = (self.bc[0] and start not in (95,98) and finish != 98, self.bc[1] and start not in (95,91) and finish != 91)
+        #ep column, only set if a pawn could take e.p. as in update_rights
+        if piece == sgn and abs(finish - start) == 20 and -sgn in (board[finish - 1],board[finish + 1]):
+            self.ep = start % 10
+        else:
+            self.ep = None
+        self.fifty_move_counter = 0 if captured or piece == sgn else self.fifty_move_counter + 1
+        self.hash = h ^ rights_hash(self.wc,self.bc,self.ep)
+        self.move_seq.append(move)
+        self.num += 1
+        self.sgn = -sgn
+        if update_in_check:
+            self.in_check = self.attacked(self.king(-sgn),sgn)
+
+    def unmake_move(self):
+        """takes back the last move made with make_move, using its undo record"""
+        (move,captured,self.wc,self.bc,self.ep,self.fifty_move_counter,self.hash,self.in_check) = self.undo.pop()
+        self.move_seq.pop()
+        self.num -= 1
+        self.sgn = sgn = -self.sgn
+        start = move[0]
+        finish = move[1]
+        piece = sgn if len(move) > 2 else self.board[finish]
+        if len(move) > 2:
+            self.toggle_piece(sgn*move[2],finish)
+            self.toggle_piece(piece,finish)
+        self.move_piece(piece,finish,start)
+        if captured:
+            self.toggle_piece(captured,finish)
+        elif piece == sgn and abs(finish - start) in (9,11):
+            self.toggle_piece(-sgn,finish - 10*sgn)
+        elif piece == 6*sgn and abs(finish - start) == 2:
+            if finish > start:
+                self.move_piece(4*sgn,start + 1,start + 3)
+            else:
+                self.move_piece(4*sgn,start - 1,start - 4)
+
+    def rollback(self,depth):
+        """reverts to previous board position. depth = 1 corresponds to directly previous one"""
+        for i in range(depth):
+            self.unmake_move()
+
+    def make_move_list(self,check_for_king_hanging = True):
+        """list moves in the form of Position.make_move_list. pseudo-legal moves are generated from the bitboards, 
+        then those leaving the own king attacked are removed"""
+        sgn = self.sgn
+        bb = self.bb
+        own = self.occ[sgn]
+        opp = self.occ[-sgn]
+        occ = own | opp
+        move_list = []
+        
+        #pawns
+        pawns = bb[6 + sgn]
+        while pawns:
+            low = pawns & -pawns
+            pawns ^= low
+            i = low.bit_length() - 1
+            pos = on_board[i]
+            targets = pawn_bb[sgn][i] & opp
+            if self.ep is not None:
+                ep_square = self.ep + (70 if sgn == 1 else 40)
+                if ep_square - pos in (9*sgn,11*sgn):
+                    targets |= 1 << square_index[ep_square]
+            one = pos + 10*sgn
+            if not occ & (1 << square_index[one]):
+                targets |= 1 << square_index[one]
+                if 56 - sgn*25 <= pos < 64 - sgn*25 and not occ & (1 << square_index[one + 10*sgn]):
+                    targets |= 1 << square_index[one + 10*sgn]
+            while targets:
+                low = targets & -targets
+                targets ^= low
+                target = on_board[low.bit_length() - 1]
+                if 28 < target < 91:
                     move_list.append((pos,target))
-        #print "move_list =",printable_moves(move_list)        
+                else:
+                    for promoted_to in (2,3,4,5):
+                        move_list.append((pos,target,promoted_to))
+        
+        #pieces
+        for piece in (2,3,4,5,6):
+            pieces = bb[6 + sgn*piece]
+            while pieces:
+                low = pieces & -pieces
+                pieces ^= low
+                i = low.bit_length() - 1
+                if piece == 2:
+                    targets = knight_bb[i]
+                elif piece == 6:
+                    targets = king_bb[i]
+                else:
+                    targets = slider_attacks(i,occ,piece_directions[piece])
+                targets &= ~own
+                pos = on_board[i]
+                while targets:
+                    low = targets & -targets
+                    targets ^= low
+                    move_list.append((pos,on_board[low.bit_length() - 1]))
+        
+        #castling: squares between king and rook empty, king not in check and not passing an attacked square 
+        c = self.wc if sgn == 1 else self.bc
+        if c != (False,False) and not self.in_check:
+            k = 60 - 35*sgn
+            board = self.board
+            if c[0] and board[k + 1] == board[k + 2] == 0 and not self.attacked(square_index[k + 1],-sgn)\
+                and not self.attacked(square_index[k + 2],-sgn):
+                move_list.append((k,k + 2))
+            if c[1] and board[k - 1] == board[k - 2] == board[k - 3] == 0 and not self.attacked(square_index[k - 1],-sgn)\
+                and not self.attacked(square_index[k - 2],-sgn):
+                move_list.append((k,k - 2))
+        
         if check_for_king_hanging:
-            for move in copy.copy(move_list):
-                #if after move own king is in check, remove this move from the move list
-                #print "checking whether king hanging after move=",move
-                if self.king_hanging(move):
-                    #print "\nremoved ",printable_moves(move)
-                    move_list.remove(move)
-        #if "move_list" in ht[ht["ordered"][-1]] and with_castling and check_for_king_hanging:
-        #    try:
-        #        assert set(ht[ht["ordered"][-1]]["move_list"]) == set(move_list)
-        #    except:
-        #        self.print_board2()                
-        #        print "move_seq =",printable_moves(self.move_seq)
-        #        print "self.wc =", self.wc
-        #        #print "self.wch =",self.wch
-        #        print "self.bc =", self.bc
-        #        #print "self.bch =",self.bch
-        #        print "move_list from make_move_list =",printable_moves(move_list)
-        #        print "from ht ",printable_moves(ht[ht["ordered"][-1]]["move_list"])
-        #        assert set(ht[ht["ordered"][-1]]["move_list"]) == set(move_list)
-        if check_for_king_hanging and with_castling and "move_list" not in ht[ht["ordered"][-1]]:  
-            ht[ht["ordered"][-1]]["move_list"] = move_list
+            legal = []
+            for move in move_list:
+                self.make_move(move,update_in_check = False)
+                if not self.attacked(self.king(sgn),-sgn):
+                    legal.append(move)
+                self.unmake_move()
+            move_list = legal
         return move_list
 
+#position classes that perft and benchmark_perft can be run on
+backends = {"mailbox": Position, "bitboard": BitboardPosition}
+
 def printable_moves(moves):
     """prints either a single move or a list of moves by converting internal 
     square representation to comon chess notation"""
@@ -695,12 +1417,19 @@ def evaluate_pos(pos,in_check = None):
         else:
             reason = "stalemate"
             outcome = 0.5
-        
+    else:
+        outcome, reason = evaluate_draw(pos)
+    return outcome, reason, possible_moves        
+
+def evaluate_draw(pos):
+    """checks for threefold repetition/insufficient material/fifty-move rule, which don't need the list of moves"""
+    reason = None
+    outcome = None
     #threefold repetition"
     #ignores possible hash collision. to deal with this, store list of historic
     #board positions and in the case of triple occurence of a hash value,
     #do another check of the full board positions
-    elif len(ht[ht["ordered"][-1]]) == 3:
+    if pos.repetitions[pos.hash] >= 3:
         reason = "threefold repetition"
         outcome = 0.5
         
@@ -709,7 +1438,7 @@ def evaluate_pos(pos,in_check = None):
         reason = "insufficient material"
         outcome = 0.5
     elif pos.num_pieces == 3:
-        pieces = [abs(pos.board[square]) for square in on_board if pos.board[square] != 0]
+        pieces = [abs(pos.board[square]) for square in pos.piece_squares[1] | pos.piece_squares[-1]]
         if 2 in pieces or 3 in pieces:
             reason = "insufficient material"
             outcome = 0.5
@@ -720,79 +1449,410 @@ def evaluate_pos(pos,in_check = None):
         reason = "50 move rule"
         outcome = 0.5
 
-    return outcome, reason, possible_moves        
+    return outcome, reason
 
-def see(pos,square,poss = None):
-    #print "calling see"
-    #pos.print_board2()
-    #print "square=",square
-    value = 0
-    if poss is None:
-        poss = pos.make_move_list()
-     
-    piece = pos.is_attacked(square,smallest = True,p = poss)[1]
-    #print "piece=",piece
-    #print "key=",abs(pos.board[square])
-    if piece: 
-        captured_value = value_dict[abs(pos.board[square])]
-        #print "making move =",printable_moves((piece[1],square))
-        pos.make_move((piece[1],square)) 
-        #only if allowed to take! not if piece is king and sq is defended or if piece is moving out of pin
-        value = max(0,captured_value - see(pos,square))
-        #print "len(pos.history) =",len(pos.history)
-        #print "move_seq =",pos.move_seq
-        pos.rollback(1)
-    return value
-
-def quiesce(pos,alpha,beta,p = None,total_depth = 0,testing = False):
-    global quiesce_calls
-    if testing:
-        quiesce_calls += 1      
+def slider_attacks_square(piece,sq,square,direction):
+    """returns True if piece on sq, the nearest piece to square in direction, attacks square"""
+    p = abs(piece)
+    if p == 5 or p == (3 if direction in bishop_directions else 4):
+        return True
+    if sq != square + direction: #only adjacent kings and pawns attack
+        return False
+    return p == 6 or (p == 1 and direction*piece in (-9,-11))
+
+def see(pos,square,first = None):
+    """static exchange evaluation: returns the material (in value_dict units) the player whose turn it is wins by 
+    capturing on square, where either side may stop capturing. if first is given, the exchange starts with the piece 
+    on square first, so the result can be negative; otherwise the least valuable attacker starts. attackers and 
+    defenders are collected once, pieces behind a slider or pawn join once it has captured (x-rays), and the exchange 
+    is resolved with a swap list without making moves. pins are not considered"""
+    board = pos.board
+    if board[square] == 0:
+        return 0
+    knights = [(sq,board[sq]) for sq in knight_targets[square] if abs(board[sq]) == 2]
+    #pieces along each ray from square, nearest first
+    lines = []
+    for direction in bishop_directions + rook_directions:
+        line = [(sq,board[sq]) for sq in rays[square][direction] if board[sq] != 0]
+        if line:
+            lines.append((direction,line))
+    
+    #values[0] is the value of the piece on square, values[i] that of the piece making the i-th capture
+    values = [value_dict[abs(board[square])]]
+    side = pos.sgn
+    attacker = first
+    while True:
+        best = None #(value, list holding the least valuable attacker)
+        for i,(sq,piece) in enumerate(knights):
+            if side*piece > 0 and (attacker is None or sq == attacker):
+                best = (value_dict[2],knights,i)
+                break
+        for direction,line in lines:
+            if line:
+                sq,piece = line[0]
+                if side*piece > 0 and (attacker is None or sq == attacker) and (best is None or value_dict[abs(piece)] < best[0])\
+                    and slider_attacks_square(piece,sq,square,direction):
+                    best = (value_dict[abs(piece)],line,0)
+        if best is None:
+            break
+        del best[1][best[2]]
+        values.append(best[0])
+        side = -side
+        attacker = None
+    
+    #swap list: going back from the last capture, each side only captures if it gains material
+    score = 0
+    for i in range(len(values) - 1,1,-1):
+        score = max(0,values[i - 1] - score)
+    if len(values) == 1:
+        return 0
+    return values[0] - score if first is not None else max(0,values[0] - score)
+
+def quiesce(pos,alpha,beta,p = None,total_depth = 0,testing = False,search = None):
+    if search is not None:
+        search.stats.qnodes += 1
+        if search.check():
+            return alpha
     #print "sgn=",pos.sgn
     #print "alpha=",alpha
     #print "beta=",beta
     #print "total depth=",total_depth
     #pos.print_board2()
-    val = pos.sgn*count_material(pos.board)
+    val = pos.sgn*evaluate(pos)
     #print "val=",val
     if val >= beta:
         return beta 
     alpha = max(alpha,val)
-    #more practical to have is_capture, is_check,... attributes for each move
-    moves = pos.make_move_list(with_castling = False) if p is None else p #really just need to list captures
-    #print "possible moves =",printable_moves(moves)
-    #list all possible captures that are not bad
-    captures = []
+    #captures and promotions only
+    if p is None:
+        #the picker already leaves out captures that lose material
+        moves = pick_moves(pos,captures_only = True)
+    else:
+        #skip captures that lose material (but allow for promotions)
+        moves = (move for move in p if len(move) > 2 or (is_capture(pos.board,move) and see(pos,move[1],move[0]) >= 0))
     for move in moves:
-        capture_value = abs(pos.board[move[1]])
-        if capture_value > 0:
-            #print printable_moves(move)
-            pos.make_move(move)
-            if capture_value >= see(pos,move[1]) or len(move) > 2: #ensure no bad capture (but allow for promotions)
-                captures.append(move)
-            pos.rollback(1)
-    #print "captures =",printable_moves(captures)
-    while len(captures) > 0:
-        pos.make_move(captures[-1])
-        score = -quiesce(pos,-beta,-alpha,total_depth = total_depth + 1,testing = testing)
-        pos.rollback(1)
-        del captures[-1]
+        pos.make_move(move)
+        score = -quiesce(pos,-beta,-alpha,total_depth = total_depth + 1,testing = testing,search = search)
+        pos.unmake_move()
+        if search is not None and search.stopped:
+            return alpha
         if score >= beta:
             return beta
         alpha = max(alpha,score)
     return alpha 
 
+#rough number of bytes taken up by one stored entry (tuple, long hash, list slot)
+tt_entry_bytes = 160
+
+class TranspositionTable(object):
+    """Fixed-size table of search results keyed by zobrist hash. Each bucket has a depth-preferred 
+    slot and an always-replace slot, both holding (hash, depth, score, bound, best move) tuples,
+    where bound is "exact", "lower" or "upper"."""
+    def __init__(self,mb = 16):
+        buckets = max(1,mb * 2**20 / (2 * tt_entry_bytes))
+        size = 1
+        while size * 2 <= buckets:
+            size *= 2
+        self.mask = size - 1
+        self.deep = [None]*size
+        self.recent = [None]*size
+        
+    def probe(self,h):
+        """returns the entry stored for hash h, or None"""
+        i = h & self.mask
+        entry = self.deep[i]
+        if entry is not None and entry[0] == h:
+            return entry
+        entry = self.recent[i]
+        if entry is not None and entry[0] == h:
+            return entry
+        return None
+    
+    def store(self,h,depth,score,bound,move):
+        """stores a search result, in the depth-preferred slot if it is at least as deep as 
+        what is there (or the same position), otherwise in the always-replace slot"""
+        i = h & self.mask
+        entry = (h,depth,score,bound,move)
+        old = self.deep[i]
+        if old is None or old[0] == h or depth >= old[1]:
+            self.deep[i] = entry
+        else:
+            self.recent[i] = entry
+    
+    def clear(self):
+        self.deep = [None]*len(self.deep)
+        self.recent = [None]*len(self.recent)
+
+bound_codes = {"exact": 0,"lower": 1,"upper": 2}
+bound_names = ("exact","lower","upper")
+
+class SharedTranspositionTable(object):
+    """TranspositionTable kept in shared memory, so that processes forked after its creation all use it.
+    entries are packed into two 64-bit words: the data (score, depth, bound and move) and the hash xored 
+    with the data. a probe only accepts an entry if the words xor back to the hash, so entries torn by 
+    concurrent writes are dropped instead of being locked against. buckets have a depth-preferred and an
+    always-replace slot like in TranspositionTable"""
+    def __init__(self,mb = 16):
+        buckets = max(1,mb * 2**20 / 32)
+        size = 1
+        while size * 2 <= buckets:
+            size *= 2
+        self.mask = size - 1
+        #bucket i holds the depth-preferred slot in words 4i, 4i+1 and the always-replace slot in 4i+2, 4i+3
+        self.words = multiprocessing.RawArray(ctypes.c_uint64,4 * size)
+    
+    def probe(self,h):
+        """returns the entry stored for hash h as (hash, depth, score, bound, best move), or None"""
+        words = self.words
+        i = 4 * (h & self.mask)
+        for j in (i,i + 2):
+            data = words[j + 1]
+            if words[j] ^ data == h and data:
+                return (h,) + unpack_entry(data)
+        return None
+    
+    def store(self,h,depth,score,bound,move):
+        """stores a search result, in the depth-preferred slot if it is at least as deep as 
+        what is there (or the same position), otherwise in the always-replace slot. scores that 
+        don't fit into 32 bits aren't stored"""
+        if not -2**31 < score < 2**31:
+            return
+        words = self.words
+        data = pack_entry(depth,score,bound,move)
+        i = 4 * (h & self.mask)
+        old = words[i + 1]
+        if not old or words[i] ^ old == h or depth >= (old >> 32) & 0xff:
+            words[i], words[i + 1] = h ^ data, data
+        else:
+            words[i + 2], words[i + 3] = h ^ data, data
+    
+    def clear(self):
+        ctypes.memset(self.words,0,ctypes.sizeof(self.words))
+
+def pack_entry(depth,score,bound,move):
+    """packs a transposition table entry into 64 bits: bits 0-31 score + 2**31, 32-39 depth, 40-41 bound, 
+    42-48 start square, 49-55 target square, 56-58 promotion piece. the start square is 0 for no move,
+    and bit 63 is set so that no entry packs to 0, which marks an empty slot"""
+    data = (int(score) + 2**31) | depth << 32 | bound_codes[bound] << 40 | 1 << 63
+    if move is not None:
+        data |= move[0] << 42 | move[1] << 49
+        if len(move) > 2:
+            data |= move[2] << 56
+    return data
+
+def unpack_entry(data):
+    """inverse of pack_entry: returns (depth, score, bound, move)"""
+    start = int((data >> 42) & 0x7f)
+    move = None
+    if start:
+        move = (start,int((data >> 49) & 0x7f))
+        if (data >> 56) & 0x7:
+            move += (int((data >> 56) & 0x7),)
+    return int((data >> 32) & 0xff), int(data & 0xffffffff) - 2**31, bound_names[(data >> 40) & 0x3], move
+
+null_move_reduction = 2 #null move searches are this many plies shallower than a real move's
+lmr_moves = 3 #number of moves of a node searched without late move reductions
+
+class SearchStats(object):
+    """Counters of one search: nodes of tree_search and of quiesce, transposition table probes, hits and cutoffs, 
+    beta cutoffs and how many of them the first move searched caused, null move cutoffs and tablebase hits. 
+    iterations holds a record (see iteration) for each iteration completed by iterative_deepening"""
+    counters = ("nodes","qnodes","tt_probes","tt_hits","tt_cutoffs","beta_cutoffs","first_move_cutoffs",\
+                "null_move_cutoffs","tablebase_hits")
+    
+    def __init__(self):
+        self.time0 = time.time()
+        for name in self.counters:
+            setattr(self,name,0)
+        self.iterations = []
+    
+    def add(self,other):
+        """adds the counters of other, e.g. of a search in another process"""
+        for name in self.counters:
+            setattr(self,name,getattr(self,name) + getattr(other,name))
+    
+    def first_move_cutoff_rate(self):
+        return float(self.first_move_cutoffs) / self.beta_cutoffs if self.beta_cutoffs else None
+    
+    def iteration(self,depth,score,pv):
+        """records a completed iteration and returns its record: depth, score, principal variation, the counters 
+        so far, the time so far and of the iteration in seconds, nodes per second (with quiesce nodes), and the 
+        branching factor, the ratio of the nodes of the iteration to those of the previous one"""
+        elapsed = time.time() - self.time0
+        total = self.nodes + self.qnodes
+        previous = self.iterations[-1] if self.iterations else {"time": 0.0,"total_nodes": 0,"iteration_nodes": 0}
+        record = dict((name,getattr(self,name)) for name in self.counters)
+        record.update({"depth": depth,"score": score,"pv": [uci_move(move) for move in pv],"total_nodes": total,\
+                       "iteration_nodes": total - previous["total_nodes"],"time": round(elapsed,4),\
+                       "iteration_time": round(elapsed - previous["time"],4),"nps": int(total / max(elapsed,0.0001)),\
+                       "first_move_cutoff_rate": self.first_move_cutoff_rate()})
+        record["branching_factor"] = float(record["iteration_nodes"]) / previous["iteration_nodes"]\
+                                     if previous["iteration_nodes"] else None
+        self.iterations.append(record)
+        return record
+
+class Search(object):
+    """State shared by all nodes of one search: the node count, the budgets, the move ordering 
+    heuristics, options and the principal variation. movetime is in milliseconds. Once a budget is 
+    used up, stopped is set and tree_search and quiesce unwind. with pvs, all moves but the first of 
+    a node are searched with a null window first (principal variation search). null_move and lmr turn 
+    on null move pruning and late move reductions. nodes below the root that tablebases (if given) can 
+    answer get their scores from them. stats collects the SearchStats of the search"""
+    def __init__(self,movetime = None,max_nodes = None,pvs = True,null_move = True,lmr = True,tablebases = None):
+        self.deadline = time.time() + movetime / 1000.0 if movetime is not None else None
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        self.stopped = False
+        self.depth = 0 #last completed iteration
+        self.killers = {} #maps ply to the last two quiet moves that caused a beta cutoff there
+        self.history = {} #maps (sgn, start, finish) to the sum of depth**2 over its beta cutoffs
+        self.pvs = pvs
+        self.null_move = null_move
+        self.lmr = lmr
+        self.pv = {} #triangular pv table: maps ply to the best line found from the node last searched there
+        self.pv_line = [] #principal variation of the last completed iteration
+        self.tablebases = tablebases
+        self.stats = SearchStats()
+    
+    def add_cutoff(self,pos,move,depth,ply):
+        """records a quiet move that caused a beta cutoff for the killer and history heuristics"""
+        killers = self.killers.get(ply,[])
+        if move not in killers:
+            self.killers[ply] = [move] + killers[:1]
+        key = (pos.sgn,move[0],move[1])
+        self.history[key] = self.history.get(key,0) + depth * depth
+    
+    def check(self):
+        """counts a node and returns True if the search has to stop"""
+        self.nodes += 1
+        if (self.max_nodes is not None and self.nodes > self.max_nodes)\
+            or (self.deadline is not None and time.time() > self.deadline):
+            self.stopped = True
+        return self.stopped
+
+def is_capture(board,move):
+    """returns True if move captures a piece, including e.p. captures"""
+    return board[move[1]] != 0 or (abs(board[move[0]]) == 1 and (move[1] - move[0]) % 10 != 0)
+
+def order_moves(pos,moves,hash_move = None,ply = 0,search = None):
+    """returns moves sorted for search: hash move, captures by most valuable victim/least valuable 
+    attacker, promotions, killer moves of this ply, then the rest by history score. ties are broken 
+    randomly, which helps to avoid threefold repetition"""
+    board = pos.board
+    killers = search.killers.get(ply,()) if search is not None else ()
+    history = search.history if search is not None else {}
+    def key(move):
+        if move == hash_move:
+            return (5,)
+        if is_capture(board,move):
+            victim = abs(board[move[1]]) or 1 #e.p. captures a pawn
+            return (4,value_dict[victim],-value_dict[abs(board[move[0]])],random.random())
+        if len(move) > 2:
+            return (3,value_dict[move[2]],random.random())
+        if move in killers:
+            return (2,-killers.index(move),random.random())
+        return (1,history.get((pos.sgn,move[0],move[1]),0),random.random())
+    return sorted(moves,key = key,reverse = True)
+
+def mate_or_stalemate_score(pos):
+    """returns the score for the player whose turn it is if they have no legal moves"""
+    return -99999 if pos.checks_and_pins()[0] else 0
+
+def pick_moves(pos,hash_move = None,ply = 0,search = None,captures_only = False):
+    """yields the legal moves of pos in stages: the hash move, captures that don't lose material (most valuable 
+    victim/least valuable attacker first) and promotions, killer moves of this ply, the other quiet moves by history 
+    score and finally captures of defended pieces by more valuable ones. the moves of a stage are only generated when 
+    it is reached and checked for legality just before being yielded, so a node failing high early skips the rest. 
+    if captures_only, quiet moves and captures that lose material are left out"""
+    checks = pos.checks_and_pins()
+    if hash_move is not None:
+        if pos.is_pseudo_legal(hash_move) and pos.is_legal(hash_move,checks):
+            yield hash_move
+        
+    #captures and promotions
+    good = []
+    bad = []
+    board = pos.board
+    for move in pos.pseudo_moves(captures = True):
+        if move == hash_move:
+            continue
+        if not is_capture(board,move):
+            good.append(((3,value_dict[move[2]],random.random()),move))
+            continue
+        victim = value_dict[abs(board[move[1]]) or 1] #e.p. captures a pawn
+        attacker = value_dict[abs(board[move[0]])]
+        key = (4,victim,-attacker,random.random())
+        if victim >= attacker or len(move) > 2:
+            good.append((key,move))
+        else:
+            #capturing a less valuable piece is only good if the exchange doesn't lose material
+            (bad if see(pos,move[1],move[0]) < 0 else good).append((key,move))
+    good.sort(reverse = True)
+    for key,move in good:
+        if pos.is_legal(move,checks):
+            yield move
+    
+    if not captures_only:
+        #killers, which have to be quiet moves in this position
+        killers = search.killers.get(ply,()) if search is not None else ()
+        for move in killers:
+            if move != hash_move and pos.is_pseudo_legal(move) and not is_capture(pos.board,move)\
+                and pos.is_legal(move,checks):
+                yield move
+        #quiet moves
+        history = search.history if search is not None else {}
+        sgn = pos.sgn
+        quiets = [((history.get((sgn,move[0],move[1]),0),random.random()),move) for move in pos.pseudo_moves(captures = False)\
+                  if move != hash_move and move not in killers]
+        quiets.sort(reverse = True)
+        for key,move in quiets:
+            if pos.is_legal(move,checks):
+                yield move
+            
+        bad.sort(reverse = True)
+        for key,move in bad:
+            if pos.is_legal(move,checks):
+                yield move
+
 def tree_search(pos,depth,outcome = None, poss_moves = None, alpha = float("-inf"),beta = float("inf"),\
-                total_depth = 0, testing = False, q = True):
-    """evaluates all possible moves up to the depth and returns best one along with position evaluation"""
-    global beta_cutoffs,ts_calls, quiesce_calls
+                total_depth = 0, testing = False, q = True, tt = None, search = None):
+    """evaluates all possible moves up to the depth and returns best one along with position evaluation.
+    if a TranspositionTable tt is given, it is probed for cutoffs and the hash move and updated with the result.
+    if search runs out of budget, (None, 0) is returned and nothing is stored"""
     #pos.print_board2()
     #print "total_depth =",total_depth
-    if testing:
-        ts_calls += 1  
+    if search is None:
+        search = Search()
+    stats = search.stats
+    stats.nodes += 1
+    search.pv[total_depth] = []
+    if search.check():
+        return None, 0
     
     if poss_moves == None:
-        outcome, reason, poss_moves = evaluate_pos(pos)
+        if total_depth == 0:
+            outcome, reason, poss_moves = evaluate_pos(pos)
+        else:
+            #moves below the root are generated in stages by pick_moves
+            outcome, reason = evaluate_draw(pos)
+            #checkmate takes precedence over the 50 move rule
+            if reason == "50 move rule" and pos.any_legal_move() is None:
+                outcome = None
+    
+    hash_move = None
+    #a drawn position is scored before the table is probed, as its entry may come from another path
+    if tt is not None and depth > 0 and outcome is None:
+        entry = tt.probe(pos.hash)
+        stats.tt_probes += 1
+        if entry is not None:
+            stats.tt_hits += 1
+            hash_move = entry[4]
+            #no cutoff at the root, which has to return a move
+            if total_depth > 0 and entry[1] >= depth:
+                if entry[3] == "exact" or (entry[3] == "lower" and entry[2] >= beta)\
+                    or (entry[3] == "upper" and entry[2] <= alpha):
+                    stats.tt_cutoffs += 1
+                    return hash_move, entry[2]
     
     if testing:           
         if total_depth == 0:
@@ -805,7 +1865,7 @@ def tree_search(pos,depth,outcome = None, poss_moves = None, alpha = float("-inf
                 for move in poss_moves:
                     pos.make_move(move)
                     num_positions += enumerate_pos(pos,depth-1)
-                    pos.rollback(1)
+                    pos.unmake_move()
                 return num_positions
             
             print "total number of nodes =",enumerate_pos(pos,depth),"depth =",depth
@@ -827,61 +1887,289 @@ def tree_search(pos,depth,outcome = None, poss_moves = None, alpha = float("-inf
         score = pos.sgn * -99999
     else:
         #print "number of moves =", len(pos.move_seq), "dept =", depth
+        if search.tablebases is not None and total_depth > 0 and pos.num_pieces <= search.tablebases.max_pieces:
+            score = search.tablebases.score(pos)
+            if score is not None:
+                stats.tablebase_hits += 1
+                return None, score
         if depth == 0:
+            best_move = random.choice(poss_moves) if poss_moves is not None else pos.any_legal_move()
+            if best_move is None:
+                return None, mate_or_stalemate_score(pos)
             if q:
-                score = quiesce(pos,alpha,beta,poss_moves,testing = True)
+                score = quiesce(pos,alpha,beta,poss_moves,testing = True,search = search)
             else:
-                score = pos.sgn * count_material(pos.board)
-                                  
-            best_move = random.choice(poss_moves)
+                score = pos.sgn * evaluate(pos)
         else:
+            alpha_orig = alpha
+            #null move pruning: if passing the turn and searching null_move_reduction plies shallower still fails high, 
+            #so will a real move. not in check, after another null move, or with only king and pawns (zugzwang)
+            if search.null_move and total_depth > 0 and depth > null_move_reduction and beta < float("inf")\
+                and not pos.in_check and pos.undo[-1][0] is not None\
+                and any(abs(pos.board[sq]) not in (1,6) for sq in pos.piece_squares[pos.sgn]):
+                pos.make_null_move()
+                t = -1 * tree_search(pos,depth - 1 - null_move_reduction,alpha = -1*beta,beta = -1*beta + 1,\
+                                    total_depth = total_depth + 1,testing = testing,q = q,tt = tt,search = search)[1]
+                pos.unmake_null_move()
+                if search.stopped:
+                    return None, 0
+                if t >= beta:
+                    stats.null_move_cutoffs += 1
+                    return None, beta if t >= 99999 else t #a mate found after passing is not proven
             score = float("-inf") #want to maximise score
-            random.shuffle(poss_moves) #o avoid threefold repetition
-            for move in poss_moves:
-                #print printable_moves(move)
-                #pos.print_board2()
-                #old_wc = pos.wc
-                #print "old_wc =",old_wc,"at depth =",depth
-                #old_bc = pos.bc
-                #print "old_bc =",old_bc
+            if poss_moves is not None:
+                moves = order_moves(pos,poss_moves,hash_move,total_depth,search)
+            else:
+                moves = pick_moves(pos,hash_move,total_depth,search)
+            for i, move in enumerate(moves):
+                quiet = len(move) == 2 and not is_capture(pos.board,move)
+                in_check = pos.in_check
                 pos.make_move(move)
-                #print "after make_move","at depth =",depth
-                #amm_wc = pos.wc
-                #print "wc =",amm_wc
-                #amm_bc = pos.bc
-                #print "bc =",amm_bc                            
-                t = -1 * tree_search(pos,depth-1,alpha = -1*beta,beta = -1*alpha,\
-                                    total_depth = total_depth + 1,testing = testing,q = q)[1]
+                t = None
+                #late move reductions: late quiet moves that don't give check are searched one ply shallower 
+                #with a null window, and again at full depth only if they beat alpha
+                if search.lmr and quiet and i >= lmr_moves and depth > 2 and not in_check and not pos.in_check:
+                    t = -1 * tree_search(pos,depth-2,alpha = -1*alpha - 1,beta = -1*alpha,\
+                                        total_depth = total_depth + 1,testing = testing,q = q,tt = tt,search = search)[1]
+                if t is None or (t > alpha and not search.stopped):
+                    if search.pvs and best_move is not None:
+                        #null window search to show the move is no better than alpha, re-searched if it is
+                        t = -1 * tree_search(pos,depth-1,alpha = -1*alpha - 1,beta = -1*alpha,\
+                                            total_depth = total_depth + 1,testing = testing,q = q,tt = tt,search = search)[1]
+                        if alpha < t < beta and not search.stopped:
+                            t = -1 * tree_search(pos,depth-1,alpha = -1*beta,beta = -1*alpha,\
+                                                total_depth = total_depth + 1,testing = testing,q = q,tt = tt,search = search)[1]
+                    else:
+                        t = -1 * tree_search(pos,depth-1,alpha = -1*beta,beta = -1*alpha,\
+                                            total_depth = total_depth + 1,testing = testing,q = q,tt = tt,search = search)[1]
+                pos.unmake_move()
+                if search.stopped:
+                    return None, 0
                 if t > score:
                     score = t
                     best_move = move
-                pos.rollback(1)
-                #print "after rollback","at depth =",depth
-                #print "wc =",pos.wc
-                #print "bc =",pos.bc
-                #assert old_wc == pos.wc
-                #assert old_bc == pos.bc
+                    search.pv[total_depth] = [move] + search.pv.get(total_depth + 1,[])
                 if score >= beta: #previous opponent's move is refuted
-                    beta_cutoffs += 1
+                    stats.beta_cutoffs += 1
+                    if i == 0:
+                        stats.first_move_cutoffs += 1
+                    if quiet:
+                        search.add_cutoff(pos,move,depth,total_depth)
                     #print "beta-cutoff"
+                    if tt is not None:
+                        tt.store(pos.hash,depth,score,"lower",best_move)
                     return best_move,score
                 alpha = max(alpha,score)
+            if best_move is None: #no legal moves
+                return None, mate_or_stalemate_score(pos)
+            if tt is not None:
+                if score <= alpha_orig:
+                    tt.store(pos.hash,depth,score,"upper",None)
+                else:
+                    tt.store(pos.hash,depth,score,"exact",best_move)
     #print "best_move=",best_move
     #print "score=",score
     #print "\n"
     #pos.rollback(0)
     return best_move, score
 
-def play_game(num_moves,white,black,verbose = True,depth1 = None,depth2 = None, testing = False):
+def init_worker(shared_alpha):
+    """runs in each process of the pool of a parallel search: keeps the shared alpha bound and creates 
+    the worker's own transposition table, which persists across its root moves and iterations"""
+    global worker_alpha, worker_tt
+    worker_alpha = shared_alpha
+    worker_tt = TranspositionTable()
+
+def search_root_move(task):
+    """searches one root move in a worker process, on a pickled copy of the position. the search window starts 
+    at the best score found by any worker so far, and a better score is published back to the others. returns 
+    the move, its score, the SearchStats, whether the deadline stopped the search and the principal variation"""
+    pos, move, depth, q, options, deadline = task
+    search = Search((deadline - time.time()) * 1000 if deadline is not None else None,**options)
+    alpha = worker_alpha.value
+    pos.make_move(move)
+    score = -1 * tree_search(pos,depth - 1,alpha = float("-inf"),beta = -1*alpha,total_depth = 1,\
+                            q = q,tt = worker_tt,search = search)[1]
+    pos.unmake_move()
+    if not search.stopped:
+        with worker_alpha.get_lock():
+            if score > worker_alpha.value:
+                worker_alpha.value = score
+    return move, score, search.stats, search.stopped, [move] + search.pv.get(1,[])
+
+def root_split(pool,shared_alpha,pos,depth,moves,q,search):
+    """searches the root moves of pos to depth in parallel, one task per move. the first move is searched 
+    alone so that the others start with its score as alpha. returns the best move, its score and the 
+    principal variation, and adds the workers' nodes and statistics to search. the results are waited for in 
+    short steps, so that once search.stopped is set from another thread (e.g. by the UCI stop command), the 
+    iteration is given up at once and (None, 0, []) is returned. the caller then terminates the pool"""
+    shared_alpha.value = float("-inf")
+    options = {"pvs": search.pvs,"null_move": search.null_move,"lmr": search.lmr}
+    tasks = [(pos,move,depth,q,options,search.deadline) for move in moves]
+    first = pool.apply_async(search_root_move,(tasks[0],))
+    while not first.ready():
+        first.wait(0.01)
+        if search.stopped:
+            return None, 0, []
+    results = [first.get()]
+    pending = pool.imap_unordered(search_root_move,tasks[1:])
+    while len(results) < len(tasks):
+        try:
+            results.append(pending.next(0.01))
+        except multiprocessing.TimeoutError:
+            if search.stopped:
+                return None, 0, []
+    best = None
+    for move, score, stats, stopped, pv in results:
+        search.nodes += stats.nodes + stats.qnodes
+        search.stats.add(stats)
+        search.stopped = search.stopped or stopped
+        #moves that failed low only have an upper bound, which can't exceed the score of the best move
+        if best is None or score > best[1]:
+            best = move, score, pv
+    return best
+
+def iterative_deepening(pos,max_depth = None,movetime = None,max_nodes = None,tt = None,q = True,\
+                        outcome = None,poss_moves = None,search = None,testing = False,verbose = False,report = None,\
+                        pvs = True,aspiration = 50,null_move = True,lmr = True,workers = 1,tablebases = None,log = None):
+    """runs tree_search at depth 1, 2, ... until max_depth is reached or the time (in milliseconds) or 
+    node budget is used up, and returns best move and score of the last completed iteration. its principal 
+    variation is left in search.pv_line. the transposition table carries each iteration's best moves over 
+    to the next one for move ordering. if not even depth 1 completes, some legal move is returned.
+    pvs, null_move and lmr turn on principal variation search, null move pruning and late move reductions. 
+    if aspiration (in centipawns) is given, iterations after the first search a window of that size around the 
+    previous score, widened fourfold on the failing side until the score falls inside it.
+    with workers > 1, each iteration splits the root moves across a pool of that many processes (see root_split), 
+    without aspiration windows. max_nodes then only limits the nodes counted in this process.
+    report, if given, is called with search and the score after each completed iteration. the statistics of each 
+    completed iteration are added to search.stats and, if log is a file, written to it as a line of JSON.
+    if tablebases can answer pos, their best move is returned without searching"""
+    if search is None:
+        search = Search(movetime,max_nodes,pvs,null_move,lmr,tablebases)
+    if tt is None:
+        tt = TranspositionTable()
+    if poss_moves is None:
+        outcome, reason, poss_moves = evaluate_pos(pos)
+    if outcome is not None:
+        #a root drawn by repetition, the fifty-move rule or material still needs a move if it has any
+        return (poss_moves[0] if poss_moves else None), tree_search(pos,0,outcome = outcome,poss_moves = poss_moves,q = q)[1]
+    if search.tablebases is not None and pos.num_pieces <= search.tablebases.max_pieces:
+        choice = search.tablebases.best_move(pos)
+        if choice is not None:
+            search.pv_line = [choice[0]]
+            return choice
+    best_move, score = poss_moves[0], None
+    pool = None
+    if workers > 1:
+        shared_alpha = multiprocessing.Value("d",float("-inf"))
+        pool = multiprocessing.Pool(workers,init_worker,(shared_alpha,))
+    depth = 1
+    while max_depth is None or depth <= max_depth:
+        if pool is not None:
+            moves = order_moves(pos,poss_moves,best_move if score is not None else None,0,search)
+            move, s, pv = root_split(pool,shared_alpha,pos,depth,moves,q,search)
+        else:
+            alpha, beta = float("-inf"), float("inf")
+            if aspiration is not None and score is not None and abs(score) < 99999:
+                alpha, beta = score - aspiration, score + aspiration
+            window = [aspiration,aspiration]
+            while True:
+                move, s = tree_search(pos,depth,poss_moves = poss_moves,alpha = alpha,beta = beta,q = q,tt = tt,\
+                                      search = search,testing = testing)
+                if search.stopped or alpha < s < beta:
+                    break
+                #score outside the aspiration window, so search again with a wider one 
+                if s <= alpha:
+                    window[0] *= 4
+                    alpha = score - window[0] if window[0] < 1000 else float("-inf")
+                else:
+                    window[1] *= 4
+                    beta = score + window[1] if window[1] < 1000 else float("inf")
+            pv = search.pv[0]
+        if search.stopped:
+            break
+        best_move, score = move, s
+        search.depth = depth
+        search.pv_line = pv
+        record = search.stats.iteration(depth,score,pv)
+        if log is not None:
+            log.write(json.dumps(record,sort_keys = True) + "\n")
+        if verbose:
+            print "depth =",depth,"score =",score,"nodes =",search.nodes,"pv =",printable_moves(search.pv_line)
+        if report is not None:
+            report(search,score)
+        if abs(score) >= 99999: #forced mate found, deeper iterations can't improve on it
+            break
+        depth += 1
+    if pool is not None:
+        pool.terminate()
+    return best_move, score
+
+def init_smp_worker(shared_tt):
+    """runs in each process of the pool of a lazy smp search and keeps the shared transposition table"""
+    global worker_tt
+    worker_tt = shared_tt
+
+def lazy_smp_worker(task):
+    """one search of lazy_smp: iterative deepening on its own copy of the position, sharing only the 
+    transposition table. returns the best move, score, principal variation, completed depth and SearchStats"""
+    pos, index, max_depth, deadline, q, options = task
+    random.seed(index) #ties in move order are broken differently by each worker
+    search = Search((deadline - time.time()) * 1000 if deadline is not None else None,**options)
+    move, score = iterative_deepening(pos,max_depth,q = q,tt = worker_tt,search = search)
+    return move, score, search.pv_line, search.depth, search.stats
+
+def lazy_smp(pos,max_depth = None,movetime = None,workers = 4,mb = 16,q = True,search = None):
+    """lazy smp search: workers processes run iterative deepening on the same root, sharing a 
+    SharedTranspositionTable, so that each one mostly finds the others' results in it. every second 
+    worker searches one ply deeper, and all break ties in move order differently. with max_depth, the 
+    result of the first worker is returned as soon as it is done, otherwise the deepest one at the deadline.
+    movetime is in milliseconds. search only passes the options and receives pv_line, depth, nodes and the 
+    workers' statistics"""
+    if search is None:
+        search = Search()
+    shared_tt = SharedTranspositionTable(mb)
+    deadline = time.time() + movetime / 1000.0 if movetime is not None else None
+    options = {"pvs": search.pvs,"null_move": search.null_move,"lmr": search.lmr}
+    pool = multiprocessing.Pool(workers,init_smp_worker,(shared_tt,))
+    try:
+        tasks = [(pos,i,max_depth + i % 2 if max_depth is not None else None,deadline,q,options)\
+                 for i in range(workers)]
+        pending = [pool.apply_async(lazy_smp_worker,(task,)) for task in tasks]
+        results = [pending[0].get()]
+        if max_depth is None:
+            results += [result.get() for result in pending[1:]]
+    finally:
+        pool.terminate()
+    move, score, search.pv_line, search.depth, stats = max(results,key = lambda result: result[3])
+    for result in results:
+        search.nodes += result[4].nodes + result[4].qnodes
+        search.stats.add(result[4])
+    return move, score
+
+def play_game(num_moves,white,black,verbose = True,depth1 = None,depth2 = None, testing = False, hash_mb = 16,\
+              time1 = None, time2 = None, book = None, tablebases = None, pgn = None):
     """if white/black = random, computer makes random choice
     if white/black = heuristic, computer uses heuristic
     if white/black = human, computer expects human player to make inputs
     maximum number of moves is num_moves. returns outcome of game as points for white
-    depth1 is the search depth of the first heuristic, depth 2 of the second (if present)"""
-    
-    global ts_calls, quiesce_calls, ht
+    depth1 is the search depth of the first heuristic, depth 2 of the second (if present)
+    time1 and time2 are their thinking times per move in milliseconds (if present)
+    hash_mb is the memory budget of each heuristic's transposition table.
+    heuristics play from the OpeningBook book (if present) as long as the position is in it, 
+    and search with the endgame Tablebases tablebases (if present).
+    the finished game is appended to the file pgn (if present) in PGN, and printed in PGN if verbose"""
     
     pos = Position()
+    tts = {1: TranspositionTable(hash_mb), -1: TranspositionTable(hash_mb)}
+    
+    def save(outcome,reason):
+        headers = {"Date": time.strftime("%Y.%m.%d"),"White": white,"Black": black,"Termination": reason}
+        text = pgn_text(headers,pos.move_seq,pgn_results.get(outcome,"*"))
+        if pgn is not None:
+            pgn.write(text + "\n")
+        if verbose:
+            print text
     
     while pos.num <= num_moves:
         if verbose:
@@ -899,25 +2187,30 @@ def play_game(num_moves,white,black,verbose = True,depth1 = None,depth2 = None,
                 print "Black wins due to",reason
             else:
                 print "Draw due to",reason
+            save(outcome,reason)
             return outcome        
                 
-        if (pos.sgn == 1 and white == "random") or (pos.sgn == -1 and black == "random"):
+        book_choice = None
+        if book is not None and (white if pos.sgn == 1 else black) == "heuristic":
+            book_choice = book.choose(pos)
+        
+        if book_choice is not None:
+            choice = book_choice
+        elif (pos.sgn == 1 and white == "random") or (pos.sgn == -1 and black == "random"):
             choice = random.choice(possible_moves)
         
         elif pos.sgn == 1 and white == "heuristic":     
-            choice, evaluation = tree_search(pos,depth1,outcome = outcome, poss_moves = possible_moves, testing = testing,q=True)
+            search = Search(time1,tablebases = tablebases)
+            choice, evaluation = iterative_deepening(pos,depth1,outcome = outcome,poss_moves = possible_moves,\
+                                                     testing = testing,q = True,tt = tts[1],search = search)
             if testing:
-                print "ts_calls =",ts_calls
-                print "quiesce_calls =",quiesce_calls
-                ts_calls = 0
-                quiesce_calls = 0
+                print "nodes =",search.stats.nodes,"quiesce nodes =",search.stats.qnodes
         elif pos.sgn == -1 and black == "heuristic":
-            choice, evaluation = tree_search(pos,depth2,outcome = outcome, poss_moves = possible_moves, testing = testing,q=False)
+            search = Search(time2,tablebases = tablebases)
+            choice, evaluation = iterative_deepening(pos,depth2,outcome = outcome,poss_moves = possible_moves,\
+                                                     testing = testing,q = False,tt = tts[-1],search = search)
             if testing:
-                print "ts_calls =",ts_calls
-                print "quiesce_calls =",quiesce_calls
-                ts_calls = 0
-                quiesce_calls = 0
+                print "nodes =",search.stats.nodes,"quiesce nodes =",search.stats.qnodes
             #print "choice = ",choice
             #print "evaluation = ", evaluation          
         else:
@@ -945,16 +2238,899 @@ def play_game(num_moves,white,black,verbose = True,depth1 = None,depth2 = None,
         pos.make_move(choice)
         if verbose:
             print "choice = ",printable_moves(choice)
-    if pos.num > num_moves:
-        print "move limit reached"
-        return None
+    print "move limit reached"
+    save(None,"move limit")
+    return None
+
+#piece, start file, start rank, target square and promotion of a move in standard algebraic notation other than castling
+san_pattern = re.compile(r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(=?[NBRQ])?$")
+pgn_results = {1: "1-0",0: "0-1",0.5: "1/2-1/2"}
+pgn_tags = ("Event","Site","Date","Round","White","Black","Result") #the seven tag roster, in its order
+pgn_tag_pattern = re.compile(r'\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]')
+
+def san_move(pos,move):
+    """returns a legal move of pos in standard algebraic notation, e.g. Nbd2, exd5, e8=Q+ or O-O#"""
+    start, finish = move[0], move[1]
+    piece = abs(pos.board[start])
+    if piece == 6 and abs(finish - start) == 2:
+        text = "O-O" if finish > start else "O-O-O"
+    else:
+        square = col_dict[finish % 10] + str(finish / 10 - 1)
+        capture = "x" if is_capture(pos.board,move) else ""
+        if piece == 1:
+            text = (col_dict[start % 10] + capture if capture else "") + square + ("=" + piece_dict[move[2]] if len(move) > 2 else "")
+        else:
+            #other pieces of the same kind that can move to the same square
+            rivals = [m[0] for m in pos.make_move_list() if m[1] == finish and m[0] != start and pos.board[m[0]] == pos.board[start]]
+            hint = ""
+            if rivals:
+                if all(rival % 10 != start % 10 for rival in rivals):
+                    hint = col_dict[start % 10]
+                elif all(rival / 10 != start / 10 for rival in rivals):
+                    hint = str(start / 10 - 1)
+                else:
+                    hint = col_dict[start % 10] + str(start / 10 - 1)
+            text = piece_dict[piece] + hint + capture + square
+    pos.make_move(move)
+    if pos.in_check:
+        text += "+" if pos.any_legal_move() is not None else "#"
+    pos.unmake_move()
+    return text
+
+def pgn_text(headers,moves,result = "*"):
+    """returns a game in PGN: the seven tag roster, with ? for missing tags, the other headers and the moves in standard 
+    algebraic notation, wrapped at 80 characters. moves are in the internal representation and start from the position 
+    of the FEN header, if there is one, otherwise from the initial position"""
+    headers = dict(headers,Result = result)
+    pos = Position.from_fen(headers["FEN"]) if "FEN" in headers else Position()
+    tags = list(pgn_tags) + sorted(tag for tag in headers if tag not in pgn_tags)
+    lines = ['[%s "%s"]' % (tag,str(headers.get(tag,"?")).replace("\\","\\\\").replace('"','\\"')) for tag in tags]
+    tokens = []
+    for move in moves:
+        if pos.sgn == 1 or not tokens:
+            tokens.append(str((pos.num + 1) / 2) + ("." if pos.sgn == 1 else "..."))
+        tokens.append(san_move(pos,move))
+        pos.make_move(move)
+    tokens.append(result)
+    lines.append("")
+    line = tokens[0]
+    for token in tokens[1:]:
+        if len(line) + 1 + len(token) > 80:
+            lines.append(line)
+            line = token
+        else:
+            line += " " + token
+    lines.append(line)
+    return "\n".join(lines) + "\n"
+
+def parse_san(pos,san):
+    """converts a move in standard algebraic notation, e.g. Nbd2, exd5, e8=Q+ or O-O, to the internal representation 
+    by matching it against the legal moves of pos. raises ValueError if no or more than one move matches"""
+    text = san.rstrip("+#!?")
+    if text in ("O-O","0-0","O-O-O","0-0-0"):
+        king_sq = 60 - 35*pos.sgn
+        matches = [(king_sq,king_sq + 2 if len(text) == 3 else king_sq - 2)]
+    else:
+        match = san_pattern.match(text)
+        if match is None:
+            raise ValueError("not a move in standard algebraic notation: " + san)
+        letter, column, row, square, promotion = match.groups()
+        piece = piece_dict_[letter] if letter else 1
+        finish = (int(square[1]) + 1) * 10 + col_dict_[square[0]]
+        promoted_to = piece_dict_[promotion[-1]] if promotion else None
+        matches = []
+        for move in pos.make_move_list():
+            start = move[0]
+            if move[1] == finish and pos.sgn*pos.board[start] == piece and (move[2] if len(move) > 2 else None) == promoted_to\
+                and (column is None or col_dict_[column] == start % 10) and (row is None or int(row) == start / 10 - 1):
+                matches.append(move)
+    if len(matches) != 1 or matches[0] not in pos.make_move_list():
+        raise ValueError("illegal or ambiguous move " + san)
+    return matches[0]
+
+def read_pgn(lines):
+    """yields (headers, moves, result) for each game in the lines of a PGN file, where headers is a dict of the 
+    tag pairs and moves the list of moves in standard algebraic notation. comments, variations, annotations 
+    and malformed tag pairs are skipped"""
+    headers = {}
+    text = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith("%"):
+            continue
+        if line.startswith("["):
+            if text:
+                yield pgn_game(headers,text)
+                headers = {}
+                text = []
+            match = pgn_tag_pattern.match(line)
+            if match is not None:
+                headers[match.group(1)] = re.sub(r"\\(.)",r"\1",match.group(2))
+        elif line:
+            text.append(line)
+    if text:
+        yield pgn_game(headers,text)
+
+def pgn_game(headers,text):
+    """splits the movetext of a game into moves and result, see read_pgn"""
+    movetext = re.sub(r"\{[^}]*\}|;[^\n]*"," ","\n".join(text)) #comments
+    depth = 0
+    tokens = []
+    for token in re.findall(r"[()]|[^\s()]+",movetext):
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0:
+            tokens.append(token)
+    result = headers.get("Result","*")
+    moves = []
+    for token in tokens:
+        if token in ("1-0","0-1","1/2-1/2","*"):
+            result = token
+            continue
+        token = re.sub(r"^\d+\.+","",token) #move number
+        if token and not token.startswith("$"):
+            moves.append(token)
+    return headers, moves, result
+
+def replay_pgn(lines,max_ply = None):
+    """yields (headers, pos, move, result) for each move of the games in the lines of a PGN file, e.g. an open file, 
+    which is read one game at a time. pos is the position before move, which is made when the generator resumes, 
+    so it has to be copied to be kept. a game is left at its first illegal move or after max_ply moves (if given), 
+    and skipped if its FEN header can't be read"""
+    for headers, moves, result in read_pgn(lines):
+        try:
+            pos = Position.from_fen(headers["FEN"]) if "FEN" in headers else Position()
+        except (ValueError,KeyError,IndexError):
+            continue
+        for text in moves[:max_ply]:
+            try:
+                move = parse_san(pos,text)
+            except ValueError:
+                break
+            yield headers, pos, move, result
+            pos.make_move(move)
+
+def book_move_code(pos,move):
+    """encodes a move of pos for the opening book: bits 0-5 target square, 6-11 start square (0-63 from a1 to h8), 
+    12-14 promotion piece (knight 1 to queen 4). castling is encoded as the king taking its own rook"""
+    finish = move[1]
+    if abs(pos.board[move[0]]) == 6 and abs(finish - move[0]) == 2:
+        finish = move[0] + 3 if finish > move[0] else move[0] - 4
+    code = square_index[finish] | square_index[move[0]] << 6
+    if len(move) > 2:
+        code |= (move[2] - 1) << 12
+    return code
+
+def book_move(pos,code):
+    """decodes a move of pos encoded by book_move_code"""
+    start = on_board[(code >> 6) & 63]
+    finish = on_board[code & 63]
+    if abs(pos.board[start]) == 6 and finish - start in (3,-4):
+        finish = start + 2 if finish > start else start - 2
+    return (start,finish,(code >> 12) + 1) if code >> 12 else (start,finish)
+
+#opening book entries: zobrist key, move, weight, learn value, big-endian
+book_entry = struct.Struct(">QHHI")
+
+class OpeningBook(object):
+    """opening book file in the format of this program: 16-byte entries (key, move, weight, learn) sorted by key, 
+    read through mmap so that the book isn't loaded into memory. entries are found by binary search on the key. 
+    the keys are the zobrist hashes of this program, so books are built with build_book, and the books of other 
+    programs can't be read"""
+    def __init__(self,path):
+        self.file = open(path,"rb")
+        self.file.seek(0,2)
+        self.size = self.file.tell() / book_entry.size
+        self.data = mmap.mmap(self.file.fileno(),0,access = mmap.ACCESS_READ) if self.size else ""
+    
+    def entries(self,key):
+        """returns the (move code, weight) pairs stored for key"""
+        data = self.data
+        low, high = 0, self.size
+        while low < high: #first entry with a key not less than key
+            middle = (low + high) / 2
+            if struct.unpack_from(">Q",data,middle * 16)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        entries = []
+        while low < self.size:
+            entry_key, code, weight, learn = book_entry.unpack_from(data,low * 16)
+            if entry_key != key:
+                break
+            entries.append((code,weight))
+            low += 1
+        return entries
+    
+    def moves(self,pos):
+        """returns the legal book moves of pos with their weights"""
+        legal = pos.make_move_list()
+        moves = []
+        for code, weight in self.entries(pos.hash):
+            move = book_move(pos,code)
+            if move in legal:
+                moves.append((move,weight))
+        return moves
+    
+    def choose(self,pos):
+        """returns a book move of pos picked at random in proportion to the weights, or None if pos isn't in the book"""
+        moves = [(move,weight) for move,weight in self.moves(pos) if weight > 0]
+        if not moves:
+            return None
+        pick = random.random() * sum(weight for move,weight in moves)
+        for move, weight in moves:
+            pick -= weight
+            if pick < 0:
+                return move
+        return moves[-1][0]
+    
+    def close(self):
+        if self.size:
+            self.data.close()
+        self.file.close()
+
+def build_book(pgn_lines,path,max_ply = 20):
+    """compiles the first max_ply moves of the games in the lines of a PGN file into an opening book at path. 
+    each move is weighted with 2 points for every game the side making it won and 1 point for every draw or 
+    game without result, so moves that only lost are left out. weights are scaled down to fit into 16 bits"""
+    weights = {}
+    for headers, pos, move, result in replay_pgn(pgn_lines,max_ply):
+        points = {"1-0": {1: 2,-1: 0},"0-1": {1: 0,-1: 2}}.get(result,{1: 1,-1: 1})
+        key = (pos.hash,book_move_code(pos,move))
+        weights[key] = weights.get(key,0) + points[pos.sgn]
+    largest = max(weights.values() + [1])
+    with open(path,"wb") as f:
+        for (key,code) in sorted(weights):
+            weight = weights[key,code] if largest <= 65535 else max(1,weights[key,code] * 65535 / largest)
+            if weights[key,code] > 0:
+                f.write(book_entry.pack(key,code,weight,0))
+
+#endgame tablebases: one file per material signature such as KQvK or KRvKP, named after it, with the stronger side 
+#as white. it has a byte for every position of the signature, from the point of view of the player to move: 0 for 
+#an illegal position, 1 for a draw and 2 + n for a mate in n plies, which is won if n is odd and lost if n is even. 
+#positions are indexed by the player to move and the squares (0-63) of the pieces, white king first, on a board 
+#mirrored so that the white king is on the files a-d and, without pawns, in the triangle a1-d1-d4. a white king 
+#on the diagonal a1-d4 leaves the first piece off the diagonal below it, so that each position has one index. 
+#signatures with pawns on both sides have no table, as the tables don't know e.p. captures
+tb_draw = 1
+tb_undecided = 255 #during generation
+tb_finish = "".join(chr(i) for i in range(255)) + chr(tb_draw) #turns undecided positions into draws
+tablebase_score = 90000 #score of a won tablebase position less its plies to mate, below the checkmate score
+tb_slot_squares = {False: [i for i in range(64) if i % 8 <= 3 and i / 8 <= i % 8],\
+                   True: [i for i in range(64) if i % 8 <= 3]} #white king squares, without and with pawns
+tb_slots = dict((pawns,dict((square,slot) for slot,square in enumerate(squares))) for pawns,squares in tb_slot_squares.items())
+#maps two squares of the 120-square board on a line to its direction and the squares between them
+tb_lines = {}
+for square in on_board:
+    for direction in bishop_directions + rook_directions:
+        for i, target in enumerate(rays[square][direction]):
+            tb_lines[square,target] = (direction,rays[square][direction][:i])
+
+def tb_name(pieces):
+    """returns the material signature of the signed pieces, e.g. KRvKP, with the stronger side as white"""
+    white = sorted((piece for piece in pieces if piece > 0),reverse = True)
+    black = sorted((-piece for piece in pieces if piece < 0),reverse = True)
+    if black > white:
+        white, black = black, white
+    return "".join(piece_dict[piece] for piece in white) + "v" + "".join(piece_dict[piece] for piece in black)
+
+def tb_ep_free(name):
+    """returns True if no e.p. capture is possible with the material signature, i.e. at most one side has pawns"""
+    white, black = name.split("v")
+    return "P" not in white or "P" not in black
+
+def tb_pieces(name):
+    """returns the signed pieces of a material signature in the order of its table"""
+    white, black = name.split("v")
+    return [piece_dict_[letter] for letter in white] + [-piece_dict_[letter] for letter in black]
+
+def tb_key(pieces,sgn):
+    """returns the signature of the table holding the position with pieces, a list of (piece, square) pairs on the 
+    120-square board, and sgn to move, the squares (0-63) of the pieces in the order of the table and the player 
+    to move in it. a position with the stronger side as black is looked up with the colours reversed"""
+    white = sorted((piece for piece,square in pieces if piece > 0),reverse = True)
+    black = sorted((-piece for piece,square in pieces if piece < 0),reverse = True)
+    if black > white:
+        pieces = [(-piece,square_index[square] ^ 56) for piece,square in pieces]
+        sgn = -sgn
+    else:
+        pieces = [(piece,square_index[square]) for piece,square in pieces]
+    pieces.sort(key = lambda entry: (entry[0] < 0,-abs(entry[0])))
+    return tb_name([piece for piece,square in pieces]), [square for piece,square in pieces], sgn
+
+def tb_index(squares,sgn,pawns):
+    """returns the index in its table of the position with pieces on squares (0-63) in the order of the table"""
+    if squares[0] & 7 > 3:
+        squares = [square ^ 7 for square in squares]
+    if not pawns:
+        if squares[0] >> 3 > 3:
+            squares = [square ^ 56 for square in squares]
+        off_diagonal = [square for square in squares if square >> 3 != square & 7]
+        if off_diagonal and off_diagonal[0] >> 3 > off_diagonal[0] & 7:
+            squares = [(square >> 3) | (square & 7) << 3 for square in squares]
+    slots = tb_slots[pawns]
+    index = slots[squares[0]] + (0 if sgn == 1 else len(slots))
+    for square in squares[1:]:
+        index = index << 6 | square
+    return index
+
+def tb_decode(index,n,pawns):
+    """returns the squares (on the 120-square board) of the n pieces and the player to move of a table index"""
+    squares = []
+    for i in range(n - 1):
+        squares.append(on_board[index & 63])
+        index >>= 6
+    slot_squares = tb_slot_squares[pawns]
+    squares.append(on_board[slot_squares[index % len(slot_squares)]])
+    squares.reverse()
+    return squares, 1 if index < len(slot_squares) else -1
+
+def tb_attacked(square,pieces,squares,by):
+    """returns True if square is attacked by a piece of colour by, given all pieces and their squares"""
+    for piece, start in zip(pieces,squares):
+        if piece * by <= 0:
+            continue
+        kind = abs(piece)
+        if kind == 1:
+            if square in pawn_attacks[by][start]:
+                return True
+        elif kind == 2:
+            if square in knight_targets[start]:
+                return True
+        elif kind == 6:
+            if square in king_targets[start]:
+                return True
+        else:
+            line = tb_lines.get((start,square))
+            if line is not None and line[0] in piece_directions[kind] and not any(sq in squares for sq in line[1]):
+                return True
+    return False
+
+def tb_targets(piece,square,squares):
+    """returns the squares a piece on square moves to, given the occupied squares. slides stop at the first 
+    occupied square, pawns only step on empty squares and capture on occupied ones"""
+    kind = abs(piece)
+    if kind == 2:
+        return knight_targets[square]
+    if kind == 6:
+        return king_targets[square]
+    if kind == 1:
+        sgn = 1 if piece > 0 else -1
+        targets = [target for target in pawn_attacks[sgn][square] if target in squares]
+        if square + 10*sgn not in squares:
+            targets.append(square + 10*sgn)
+            if square / 10 == (3 if sgn == 1 else 8) and square + 20*sgn not in squares:
+                targets.append(square + 20*sgn)
+        return targets
+    targets = []
+    for direction in piece_directions[kind]:
+        for target in rays[square][direction]:
+            targets.append(target)
+            if target in squares:
+                break
+    return targets
+
+def tb_predecessors(pieces,squares,sgn,pawns):
+    """yields the table indices of the legal positions from which the player not to move reached the position 
+    with pieces on squares and sgn to move by a move that is neither a capture nor a promotion"""
+    mover = -sgn
+    king = pieces.index(6*sgn)
+    for i, piece in enumerate(pieces):
+        if piece * mover <= 0:
+            continue
+        square = squares[i]
+        if abs(piece) == 1:
+            starts = []
+            back = square - 10*mover
+            if back not in squares and 3 <= back / 10 <= 8: #pawns start from the second to the seventh rank
+                starts.append(back)
+                if square / 10 == (5 if mover == 1 else 6) and back - 10*mover not in squares:
+                    starts.append(back - 10*mover)
+        else:
+            starts = [start for start in tb_targets(piece,square,squares) if start not in squares]
+        for start in starts:
+            before = squares[:]
+            before[i] = start
+            if not tb_attacked(before[king],pieces,before,mover):
+                yield tb_index([square_index[sq] for sq in before],mover,pawns)
+
+def tb_exit_names(name):
+    """returns the signatures reached from name by a capture or a promotion, leaving out those with two kings only"""
+    pieces = tb_pieces(name)
+    names = set()
+    for i, piece in enumerate(pieces):
+        if abs(piece) != 6 and len(pieces) > 3:
+            names.add(tb_name(pieces[:i] + pieces[i+1:]))
+        if abs(piece) == 1:
+            for promotion in (5,4,3,2):
+                names.add(tb_name(pieces[:i] + [promotion*piece] + pieces[i+1:]))
+    return names
+
+def tb_score(code):
+    """returns the score of a tablebase byte for the player to move"""
+    if code == tb_draw:
+        return 0
+    return tablebase_score - (code - 2) if code % 2 else code - 2 - tablebase_score
+
+def castling_possible(pos):
+    """returns True if a castling right of pos has its king and rook still on their squares"""
+    for sgn, rights, king in ((1,pos.wc,25),(-1,pos.bc,95)):
+        for right, rook in zip(rights,(king + 3,king - 4)):
+            if right and pos.board[king] == 6*sgn and pos.board[rook] == 4*sgn:
+                return True
+    return False
+
+class Tablebases(object):
+    """endgame tablebases in a directory, written by generate_tablebase and read through mmap. probe, score and 
+    best_move return None for positions they can't answer: with more pieces than the tables, castling rights, 
+    an e.p. square, pawns on both sides or without a table"""
+    def __init__(self,path):
+        self.path = path
+        self.tables = {}
+        self.max_pieces = max([len(name) - 5 for name in os.listdir(path) if name.endswith(".tbl")] + [2])
+    
+    def table(self,name):
+        """returns the table of a material signature, or None if it hasn't been generated"""
+        if name not in self.tables:
+            file_name = os.path.join(self.path,name + ".tbl")
+            self.tables[name] = None
+            if os.path.exists(file_name):
+                with open(file_name,"rb") as f:
+                    self.tables[name] = mmap.mmap(f.fileno(),0,access = mmap.ACCESS_READ)
+        return self.tables[name]
+    
+    def code(self,pieces,sgn):
+        """returns the tablebase byte of the position with pieces, a list of (piece, square) pairs, and sgn to move"""
+        if len(pieces) == 2:
+            return tb_draw
+        name, squares, sgn = tb_key(pieces,sgn)
+        table = self.table(name) if tb_ep_free(name) else None
+        if table is None:
+            return None
+        return ord(table[tb_index(squares,sgn,"P" in name)])
+    
+    def probe(self,pos):
+        """returns the tablebase byte of pos"""
+        if pos.num_pieces > self.max_pieces or pos.ep is not None or castling_possible(pos):
+            return None
+        return self.code([(pos.board[square],square) for square in pos.piece_squares[1] | pos.piece_squares[-1]],pos.sgn)
+    
+    def score(self,pos):
+        """returns the score of pos for the player to move"""
+        code = self.probe(pos)
+        return tb_score(code) if code else None
+    
+    def best_move(self,pos):
+        """returns the move of pos that mates soonest, draws or gets mated last, with the score of pos"""
+        score = self.score(pos)
+        if score is None:
+            return None
+        best = None
+        for move in pos.make_move_list():
+            pos.make_move(move)
+            code = self.probe(pos)
+            pos.unmake_move()
+            if not code:
+                return None
+            if best is None or -tb_score(code) > best[1]:
+                best = move, -tb_score(code)
+        return (best[0],score) if best is not None else None
+    
+    def close(self):
+        for table in self.tables.values():
+            if table is not None:
+                table.close()
+        self.tables = {}
+
+def generate_tablebase(tablebases,name,verbose = False):
+    """computes the table of a material signature by retrograde analysis and writes it to the directory of 
+    tablebases, first generating missing tables reached by captures and promotions. each legal position starts 
+    undecided, with the number of positions its other moves lead to. mated positions are lost in 0 plies, and positions are then 
+    decided in order of plies to mate: the predecessors of a position lost in n plies win in n + 1, and a position 
+    loses once all its moves lead to won positions, unless a capture or promotion saves it. the rest are draws.
+    raises ValueError for a signature with pawns on both sides, where e.p. captures would be needed"""
+    if not tb_ep_free(name):
+        raise ValueError("no e.p. captures in tablebase " + name)
+    for exit_name in tb_exit_names(name):
+        if tablebases.table(exit_name) is None:
+            generate_tablebase(tablebases,exit_name,verbose)
+    time0 = time.time()
+    pieces = tb_pieces(name)
+    n = len(pieces)
+    pawns = 1 in pieces or -1 in pieces
+    kings = {1: 0,-1: pieces.index(-6)}
+    size = 2 * len(tb_slot_squares[pawns]) * 64 ** (n - 1)
+    result = bytearray(size)
+    counts = bytearray(size) #positions reached by moves within the table that aren't known to be won by the opponent
+    floors = bytearray(size) #plies to mate after the longest lost capture or promotion, 255 if one doesn't lose
+    buckets = [] #positions to be decided by plies to mate
+    longest = 0
+    def add(plies,index):
+        while len(buckets) <= plies:
+            buckets.append([])
+        buckets[plies].append(index)
+    
+    king_squares = [on_board[square] for square in tb_slot_squares[pawns]]
+    for index, squares in enumerate(itertools.product((1,-1),king_squares,*[on_board]*(n - 1))):
+        sgn, squares = squares[0], list(squares[1:])
+        if len(set(squares)) < n or any(abs(piece) == 1 and not 3 <= square / 10 <= 8 for piece,square in zip(pieces,squares))\
+            or tb_attacked(squares[kings[-sgn]],pieces,squares,sgn)\
+            or tb_index([square_index[square] for square in squares],sgn,pawns) != index: #the other index of a position
+            continue
+        result[index] = tb_undecided
+        successors = set()
+        moves = 0
+        exit_win = exit_loss = None
+        exit_draw = False
+        for i, piece in enumerate(pieces):
+            if piece * sgn <= 0:
+                continue
+            for target in tb_targets(piece,squares[i],squares):
+                captured = squares.index(target) if target in squares else None
+                if captured is not None and pieces[captured] * sgn > 0:
+                    continue
+                after = squares[:]
+                after[i] = target
+                others = [j for j in range(n) if j != captured]
+                if tb_attacked(after[kings[sgn]],[pieces[j] for j in others],[after[j] for j in others],-sgn):
+                    continue
+                moves += 1
+                promotions = (5,4,3,2) if abs(piece) == 1 and target / 10 in (2,9) else ()
+                if captured is None and not promotions:
+                    successors.add(tb_index([square_index[square] for square in after],-sgn,pawns))
+                    continue
+                for promotion in promotions or (abs(piece),):
+                    code = tablebases.code([(promotion*sgn if j == i else pieces[j],after[j]) for j in others],-sgn)
+                    if code == tb_draw:
+                        exit_draw = True
+                    elif code % 2 == 0: #the opponent is mated in an even number of plies
+                        exit_win = code - 1 if exit_win is None else min(exit_win,code - 1)
+                    else:
+                        exit_loss = max(exit_loss,code - 1)
+        counts[index] = len(successors)
+        if moves == 0:
+            if tb_attacked(squares[kings[sgn]],pieces,squares,-sgn):
+                add(0,index)
+            else:
+                result[index] = tb_draw
+        elif exit_win is not None or exit_draw:
+            floors[index] = 255
+            if exit_win is not None:
+                add(exit_win,index)
+        else:
+            floors[index] = exit_loss or 0
+            if not successors:
+                add(exit_loss,index)
+    
+    plies = 0
+    while plies < len(buckets):
+        for index in buckets[plies]:
+            if result[index] != tb_undecided:
+                continue
+            result[index] = 2 + plies
+            longest = plies
+            squares, sgn = tb_decode(index,n,pawns)
+            for before in set(tb_predecessors(pieces,squares,sgn,pawns)):
+                if result[before] != tb_undecided:
+                    continue
+                if plies % 2 == 0:
+                    add(plies + 1,before)
+                else:
+                    counts[before] -= 1
+                    if counts[before] == 0 and floors[before] != 255:
+                        add(max(plies + 1,floors[before]),before)
+        plies += 1
+    
+    with open(os.path.join(tablebases.path,name + ".tbl"),"wb") as f:
+        f.write(result.translate(tb_finish))
+    tablebases.tables.pop(name,None)
+    tablebases.max_pieces = max(tablebases.max_pieces,n)
+    if verbose:
+        print name,"generated in",round(time.time() - time0,1),"seconds, longest mate",longest,"plies"
+
+def tablebase_names(max_pieces = 4):
+    """returns the material signatures with three up to max_pieces pieces, leaving out those with pawns on both sides"""
+    names = set()
+    for extra in range(1,max_pieces - 1):
+        for kinds in itertools.combinations_with_replacement((5,4,3,2,1),extra):
+            for sgns in itertools.product((1,-1),repeat = extra):
+                names.add(tb_name([6,-6] + [kind*sgn for kind,sgn in zip(kinds,sgns)]))
+    return sorted((name for name in names if tb_ep_free(name)),key = len)
+
+def generate_tablebases(path,max_pieces = 4,verbose = True):
+    """generates the missing tables with up to max_pieces pieces in the directory path and returns them as Tablebases"""
+    tablebases = Tablebases(path)
+    for name in tablebase_names(max_pieces):
+        if tablebases.table(name) is None:
+            generate_tablebase(tablebases,name,verbose)
+    return tablebases
+
+#openings of tournament games in standard algebraic notation, each played twice with the colours swapped
+tournament_openings = ["e4 e5 Nf3 Nc6 Bb5 a6","e4 e5 Nf3 Nc6 Bc4 Bc5","e4 c5 Nf3 d6 d4 cxd4","e4 e6 d4 d5 Nc3 Nf6",\
+                       "e4 c6 d4 d5 Nc3 dxe4","d4 d5 c4 e6 Nc3 Nf6","d4 Nf6 c4 g6 Nc3 Bg7","d4 Nf6 c4 e6 Nf3 b6",\
+                       "c4 e5 Nc3 Nf6 g3 d5","Nf3 d5 g3 Nf6 Bg2 c6","e4 d5 exd5 Qxd5 Nc3 Qa5","d4 f5 g3 Nf6 Bg2 e6"]
+
+def tournament_game(task):
+    """plays one game of a tournament, in a worker process: the opening, then moves chosen by iterative_deepening 
+    with the keyword arguments of the engines (dicts with a name and e.g. max_depth, movetime or lmr) until the game 
+    ends or its ply max_plies is reached, which counts as a draw. returns the game's record as a dict"""
+    number, opening, white, black, max_plies = task
+    random.seed(number) #a replayed game makes the same random choices
+    pos = Position()
+    for san in opening.split():
+        pos.make_move(parse_san(pos,san))
+    engines = {1: white,-1: black}
+    tts = {1: TranspositionTable(white.get("hash_mb",16)),-1: TranspositionTable(black.get("hash_mb",16))}
+    time0 = time.time()
+    while True:
+        outcome, reason, moves = evaluate_pos(pos)
+        if outcome is None and pos.num > max_plies:
+            outcome, reason = 0.5, "move limit"
+        if outcome is not None:
+            break
+        options = dict((key,value) for key,value in engines[pos.sgn].items() if key not in ("name","hash_mb"))
+        move, score = iterative_deepening(pos,poss_moves = moves,tt = tts[pos.sgn],**options)
+        pos.make_move(move)
+    return {"game": number,"opening": opening,"white": white["name"],"black": black["name"],\
+            "result": pgn_results[outcome],"reason": reason,"plies": len(pos.move_seq),\
+            "seconds": round(time.time() - time0,3)}
+
+def read_results(path):
+    """returns the game records of a tournament's JSONL file, dropping a last line cut off by an interruption"""
+    if not os.path.exists(path):
+        return []
+    with open(path,"rb+") as f:
+        text = f.read()
+        complete = text[:text.rfind("\n") + 1]
+        if complete != text:
+            f.seek(len(complete))
+            f.truncate()
+    return [json.loads(line) for line in complete.splitlines() if line.strip()]
+
+def expected_score(elo):
+    """returns the expected score of a player elo points stronger than its opponent"""
+    return 1 / (1 + 10 ** (-elo / 400.0))
+
+def score_elo(score):
+    """returns the elo difference corresponding to an expected score, the inverse of expected_score"""
+    score = min(max(score,1e-6),1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+def elo_stats(wins,draws,losses,elo0 = 0,elo1 = 5,alpha = 0.05,beta = 0.05):
+    """returns the elo difference of a result with its 95% error margin, the log-likelihood ratio of the sprt of 
+    elo1 against elo0 (normal approximation of the trinomial) and its decision: "pass" if elo1 is accepted, 
+    "fail" if elo0 is, otherwise None"""
+    games = wins + draws + losses
+    if games == 0:
+        return 0.0, float("inf"), 0.0, None
+    score = (wins + 0.5 * draws) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    margin = 1.96 * math.sqrt(variance / games)
+    elo = score_elo(score)
+    error = (score_elo(score + margin) - score_elo(score - margin)) / 2
+    score0, score1 = expected_score(elo0), expected_score(elo1)
+    llr = games * (score1 - score0) * (2 * score - score0 - score1) / (2 * variance) if variance > 0 else 0.0
+    decision = None
+    if llr >= math.log((1 - beta) / alpha):
+        decision = "pass"
+    elif llr <= math.log(beta / (1 - alpha)):
+        decision = "fail"
+    return elo, error, llr, decision
+
+def tournament_summary(results,first,elo0 = 0,elo1 = 5):
+    """returns wins, draws and losses of the engine named first in results, followed by elo_stats"""
+    wins = draws = losses = 0
+    for record in results:
+        points = {"1-0": 1,"0-1": 0,"1/2-1/2": 0.5}[record["result"]]
+        if record["white"] != first:
+            points = 1 - points
+        if points == 1:
+            wins += 1
+        elif points == 0:
+            losses += 1
+        else:
+            draws += 1
+    return (wins,draws,losses) + elo_stats(wins,draws,losses,elo0,elo1)
+
+def tournament(path,first,second,games = 100,workers = 4,max_plies = 200,openings = tournament_openings,\
+               elo0 = 0,elo1 = 5,stop_early = True,verbose = True):
+    """plays games between two engines (see tournament_game) on a pool of worker processes. game 2i and 2i + 1 
+    start from opening i mod len(openings), with first as white in the former and as black in the latter. each 
+    result is appended to the JSONL file at path as soon as the game finishes, and games already in the file are 
+    not played again, so an interrupted tournament resumes where it stopped. with stop_early, no more games are 
+    played once the sprt of elo1 against elo0 is decided. returns the summary of the games in the file"""
+    results = read_results(path)
+    done = set(record["game"] for record in results)
+    tasks = []
+    for number in range(games):
+        if number not in done:
+            opening = openings[number / 2 % len(openings)]
+            white, black = (first,second) if number % 2 == 0 else (second,first)
+            tasks.append((number,opening,white,black,max_plies))
+    summary = tournament_summary(results,first["name"],elo0,elo1)
+    if tasks and not (stop_early and summary[6] is not None):
+        pool = multiprocessing.Pool(workers)
+        try:
+            with open(path,"ab") as f:
+                for record in pool.imap_unordered(tournament_game,tasks):
+                    f.write(json.dumps(record,sort_keys = True) + "\n")
+                    f.flush()
+                    results.append(record)
+                    summary = tournament_summary(results,first["name"],elo0,elo1)
+                    if verbose:
+                        print "game",record["game"],record["white"],"-",record["black"],record["result"],\
+                              "(" + record["reason"] + ")","+%d =%d -%d" % summary[:3]
+                    if stop_early and summary[6] is not None:
+                        break
+        finally:
+            pool.terminate()
     if verbose:
-            seq_string = "All moves"
-            i = 1
-            for move in pos.move_seq:
-                seq_string += (" " + str(i) + "." + printable_moves(move))
-                i += 1
-            print seq_string
+        wins, draws, losses, elo, error, llr, decision = summary
+        print first["name"],"vs",second["name"],"+%d =%d -%d" % (wins,draws,losses),\
+              "elo %.1f +- %.1f" % (elo,error),"llr %.2f" % llr,"sprt",decision or "undecided"
+    return summary
+
+def uci_move(move):
+    """converts a move to UCI notation, e.g. e2e4 or e7e8q"""
+    text = col_dict[move[0] % 10] + str(move[0] / 10 - 1) + col_dict[move[1] % 10] + str(move[1] / 10 - 1)
+    return text + piece_dict[move[2]].lower() if len(move) > 2 else text
+
+def parse_uci_move(text):
+    """converts a move in UCI notation to the internal representation"""
+    start = (int(text[1]) + 1) * 10 + col_dict_[text[0]]
+    finish = (int(text[3]) + 1) * 10 + col_dict_[text[2]]
+    return (start,finish,piece_dict_[text[4].upper()]) if len(text) > 4 else (start,finish)
+
+class UCIEngine(object):
+    """UCI front-end: handle takes one command of the protocol at a time, loop reads them from stdin. searches 
+    run on a background thread, so stop, isready and quit are answered while the engine thinks. output is 
+    a function that sends a line to the GUI"""
+    def __init__(self,output = None):
+        self.output = output if output is not None else self.print_line
+        self.lock = threading.Lock()
+        self.position = Position()
+        self.hash_mb = 16
+        self.threads = 1
+        self.tt = TranspositionTable(self.hash_mb)
+        self.book = None
+        self.tablebases = None
+        self.search = None
+        self.thread = None
+    
+    def print_line(self,line):
+        print line
+        sys.stdout.flush()
+    
+    def send(self,line):
+        with self.lock:
+            self.output(line)
+    
+    def loop(self):
+        """answers commands from stdin until quit"""
+        while True:
+            line = sys.stdin.readline()
+            if not line or not self.handle(line):
+                break
+    
+    def handle(self,line):
+        """carries out one command, returns False for quit"""
+        words = line.split()
+        if not words:
+            return True
+        command = words[0]
+        if command == "uci":
+            self.send("id name chess.py")
+            self.send("id author chess.py authors")
+            self.send("option name Hash type spin default 16 min 1 max 4096")
+            self.send("option name Threads type spin default 1 min 1 max 64")
+            self.send("option name Book type string default <empty>")
+            self.send("option name TablebasePath type string default <empty>")
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "setoption" and "name" in words and "value" in words:
+            name = " ".join(words[words.index("name") + 1:words.index("value")]).lower()
+            value = " ".join(words[words.index("value") + 1:]) #paths may contain spaces
+            if name == "hash":
+                self.hash_mb = int(value)
+                self.tt = TranspositionTable(self.hash_mb)
+            elif name == "threads":
+                self.threads = int(value)
+            elif name == "book":
+                if self.book is not None:
+                    self.book.close()
+                    self.book = None
+                try:
+                    self.book = OpeningBook(value) if value != "<empty>" else None
+                except EnvironmentError as error:
+                    self.send("info string cannot open book " + value + ": " + str(error))
+            elif name == "tablebasepath":
+                if self.tablebases is not None:
+                    self.tablebases.close()
+                    self.tablebases = None
+                try:
+                    self.tablebases = Tablebases(value) if value != "<empty>" else None
+                except EnvironmentError as error:
+                    self.send("info string cannot open tablebases " + value + ": " + str(error))
+        elif command == "ucinewgame":
+            self.stop()
+            self.tt.clear()
+        elif command == "position":
+            self.stop()
+            self.set_position(words[1:])
+        elif command == "go":
+            self.stop()
+            self.go(words[1:])
+        elif command == "stop":
+            self.stop()
+        elif command == "quit":
+            self.stop()
+            return False
+        return True
+    
+    def set_position(self,words):
+        """position startpos|fen <fen> [moves <move> ...]"""
+        moves = words.index("moves") if "moves" in words else len(words)
+        if words[0] == "fen":
+            self.position = Position.from_fen(" ".join(words[1:moves]))
+        else:
+            self.position = Position()
+        for text in words[moves + 1:]:
+            self.position.make_move(parse_uci_move(text))
+    
+    def go(self,words):
+        """go [depth <plies>] [movetime <ms>] [nodes <n>] [wtime <ms>] [btime <ms>] [winc <ms>] [binc <ms>] [movestogo <n>] [infinite]:
+        starts the search thread. with infinite or without a depth, time or node limit the search runs until stop, 
+        and the best move is only sent then, even if the search ends earlier (e.g. with a mate)"""
+        limits = dict((words[i],int(words[i + 1])) for i in range(len(words) - 1) if words[i] in\
+                      ("depth","movetime","nodes","wtime","btime","winc","binc","movestogo"))
+        movetime = limits.get("movetime")
+        time_left = limits.get("wtime" if self.position.sgn == 1 else "btime")
+        if movetime is None and time_left is not None:
+            #an equal share of the time left for the moves to go, plus most of the increment, leaving a margin
+            increment = limits.get("winc" if self.position.sgn == 1 else "binc",0)
+            movetime = max(1,min(time_left / limits.get("movestogo",30) + increment * 3 / 4,time_left / 2))
+        infinite = "infinite" in words or not any(limit in limits for limit in ("depth","movetime","nodes","wtime","btime"))
+        self.search = Search(movetime,limits.get("nodes"),tablebases = self.tablebases)
+        self.thread = threading.Thread(target = self.think,args = (self.position,self.search,limits.get("depth"),infinite))
+        self.thread.start()
+    
+    def think(self,pos,search,depth,infinite = False):
+        """runs on the search thread: searches pos, sends info lines for each completed iteration and the best move,
+        which for an infinite search waits until search is stopped"""
+        time0 = time.time()
+        def send_bestmove(move):
+            while infinite and not search.stopped:
+                time.sleep(0.01)
+            self.send("bestmove " + (uci_move(move) if move is not None else "0000"))
+        def report(search,score):
+            elapsed = max(time.time() - time0,0.001)
+            if abs(score) >= 99999:
+                moves = (len(search.pv_line) + 1) / 2
+                score_text = "mate " + str(moves if score > 0 else -moves)
+            else:
+                score_text = "cp " + str(int(score))
+            self.send("info depth %d score %s nodes %d nps %d time %d pv %s" % (search.depth,score_text,search.nodes,\
+                      search.nodes / elapsed,elapsed * 1000," ".join(uci_move(move) for move in search.pv_line)))
+        moves = pos.make_move_list()
+        if not moves:
+            send_bestmove(None)
+            return
+        move = self.book.choose(pos) if self.book is not None else None
+        if move is not None:
+            send_bestmove(move)
+            return
+        move, score = iterative_deepening(pos,depth,tt = self.tt,search = search,report = report,workers = self.threads)
+        send_bestmove(move)
+    
+    def stop(self):
+        """stops the search, if one is running, and waits for the search thread to send its best move"""
+        if self.thread is not None:
+            self.search.stopped = True
+            self.thread.join()
+            self.thread = None
 
 def setup_position(pos):
     """sets up an arbitrary board position based on user inputs and checks legality.
@@ -1040,6 +3216,50 @@ def count_material(board):
             black_material += value_dict[abs(board[square])]
     return white_material - black_material
 
+def evaluate(pos):
+    """returns the evaluation of pos in centipawns from white's point of view: middlegame and endgame scores, 
+    kept up to date by make_move, interpolated by game phase"""
+    phase = min(pos.phase,max_phase)
+    return (pos.mg*phase + pos.eg*(max_phase - phase)) / max_phase
+
+def eval_terms(board):
+    """computes middlegame score, endgame score and game phase of board from scratch"""
+    mg = 0
+    eg = 0
+    phase = 0
+    for square in on_board:
+        piece = board[square]
+        if piece != 0:
+            mg += eval_mg[piece + 6][square]
+            eg += eval_eg[piece + 6][square]
+            phase += phase_dict[abs(piece)]
+    return mg, eg, phase
+
+def update_eval(pos,move):
+    """returns middlegame score, endgame score and game phase of pos updated for move, which is about to be made"""
+    board = pos.board
+    start = move[0]
+    finish = move[1]
+    piece = board[start]
+    captured = board[finish]
+    placed = piece if len(move) == 2 else (move[2] if piece > 0 else -move[2]) #promotion
+    mg = pos.mg + eval_mg[placed + 6][finish] - eval_mg[piece + 6][start]
+    eg = pos.eg + eval_eg[placed + 6][finish] - eval_eg[piece + 6][start]
+    phase = pos.phase + phase_dict[abs(placed)] - phase_dict[abs(piece)]
+    if captured != 0:
+        mg -= eval_mg[captured + 6][finish]
+        eg -= eval_eg[captured + 6][finish]
+        phase -= phase_dict[abs(captured)]
+    elif abs(piece) == 1 and (finish - start) % 10 != 0: #e.p., pawn taken is behind finish
+        mg -= eval_mg[6 - piece][finish - 10*piece]
+        eg -= eval_eg[6 - piece][finish - 10*piece]
+    elif abs(piece) == 6 and abs(finish - start) == 2: #castling, rook moves as well
+        rook = 4 if piece > 0 else -4
+        rook_start, rook_finish = (start + 3,start + 1) if finish > start else (start - 4,start - 1)
+        mg += eval_mg[rook + 6][rook_finish] - eval_mg[rook + 6][rook_start]
+        eg += eval_eg[rook + 6][rook_finish] - eval_eg[rook + 6][rook_start]
+    return mg, eg, phase
+
 def perft(pos,depth):
     """recursively enumerates all leaf nodes in game tree up to depth. terminal nodes are not counted if they are not at depth "depth"."""
     #ensure perft ignores threefold repetition, 50-move-rule and insufficient material
@@ -1050,131 +3270,393 @@ def perft(pos,depth):
     for i in range(len(moves)):
         pos.make_move(moves[i])
         nodes += perft(pos,depth - 1)
-        pos.rollback(1)
+        pos.unmake_move()
+    return nodes
+    
+def perft_hash_check(pos,depth):
+    """like perft, but asserts at every node that the incrementally updated hash equals zobrist_hash(pos)"""
+    assert pos.hash == zobrist_hash(pos)
+    if depth == 0:
+        return 1
+    nodes = 0
+    for move in pos.make_move_list():
+        pos.make_move(move)
+        nodes += perft_hash_check(pos,depth - 1)
+        pos.unmake_move()
+    return nodes
+
+def perft_movegen_check(pos,depth):
+    """like perft, but asserts at every node that the legal move generator gives the same moves as 
+    filtering pseudo-legal moves with king_hanging"""
+    moves = pos.make_move_list()
+    assert set(moves) == set(move for move in pos.make_move_list(check_for_king_hanging = False) if not pos.king_hanging(move))
+    if depth == 0:
+        return 1
+    nodes = 0
+    for move in moves:
+        pos.make_move(move)
+        nodes += perft_movegen_check(pos,depth - 1)
+        pos.unmake_move()
+    return nodes
+
+def perft_eval_check(pos,depth):
+    """like perft, but asserts at every node that the incrementally updated evaluation terms equal eval_terms(pos.board)"""
+    assert (pos.mg,pos.eg,pos.phase) == eval_terms(pos.board)
+    if depth == 0:
+        return 1
+    nodes = 0
+    for move in pos.make_move_list():
+        pos.make_move(move)
+        nodes += perft_eval_check(pos,depth - 1)
+        pos.unmake_move()
+    return nodes
+
+def hashed_perft(pos,depth,counts,mask):
+    """perft with bulk counting, which counts the legal moves at depth 1 instead of making them, and a hash 
+    table: counts is a list of (hash, depth, nodes) entries or None, indexed by hash and depth & mask, 
+    whose entries are always replaced"""
+    if depth == 0:
+        return 1
+    moves = pos.legal_moves()
+    if depth == 1:
+        return len(moves)
+    i = (pos.hash ^ depth) & mask
+    entry = counts[i]
+    if entry is not None and entry[0] == pos.hash and entry[1] == depth:
+        return entry[2]
+    nodes = 0
+    for move in moves:
+        pos.make_move(move)
+        nodes += hashed_perft(pos,depth - 1,counts,mask)
+        pos.unmake_move()
+    counts[i] = (pos.hash,depth,nodes)
     return nodes
+
+def perft_table(mb):
+    """returns an empty hash table for hashed_perft taking up about mb megabytes, and its mask"""
+    size = 1
+    while size * 2 <= max(1,mb * 2**20 / tt_entry_bytes):
+        size *= 2
+    return [None]*size, size - 1
+
+def init_perft_worker(mb):
+    """runs in each process of the pool of perft_divide and creates the worker's own perft hash table"""
+    global worker_counts, worker_mask
+    worker_counts, worker_mask = perft_table(mb)
+
+def perft_root_move(task):
+    """counts the perft nodes below one root move in a worker process, see search_root_move"""
+    pos, move, depth = task
+    pos.make_move(move)
+    nodes = hashed_perft(pos,depth - 1,worker_counts,worker_mask)
+    pos.unmake_move()
+    return move, nodes
+
+def perft_divide(pos,depth,workers = 1,mb = 64,verbose = False):
+    """returns a dict mapping the legal moves of pos to their perft node counts at depth (depth >= 1), 
+    computed with hashed_perft. with workers > 1 the root moves are split across a pool of that many 
+    processes, each with a hash table of mb megabytes. if verbose, prints the counts like the divide command 
+    of other engines"""
+    moves = pos.legal_moves()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers,init_perft_worker,(mb,))
+        try:
+            divide = dict(pool.imap_unordered(perft_root_move,[(pos,move,depth) for move in moves]))
+        finally:
+            pool.terminate()
+    else:
+        counts, mask = perft_table(mb)
+        divide = {}
+        for move in moves:
+            pos.make_move(move)
+            divide[move] = hashed_perft(pos,depth - 1,counts,mask)
+            pos.unmake_move()
+    if verbose:
+        for move in sorted(divide):
+            print printable_moves(move).split(".")[-1],divide[move]
+        print "moves =",len(divide),"nodes =",sum(divide.values())
+    return divide
+
+def fast_perft(pos,depth,workers = 1,mb = 64):
+    """perft using perft_divide, for depths where perft is too slow"""
+    if depth == 0:
+        return 1
+    return sum(perft_divide(pos,depth,workers,mb).values())
+
+#published perft counts for depths 1, 2, ... of standard test positions
+perft_positions = [("initial position",lambda: Position(),
+                    (20,400,8902,197281,4865609,119060324)),
+    ("Kiwipete",lambda: Position.from_fen("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1"),
+                    (48,2039,97862,4085603,193690690)),
+    ("rook endgame",lambda: Position.from_fen("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1"),
+                    (14,191,2812,43238,674624,11030083)),
+    ("promotions",lambda: Position.from_fen("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1"),
+                    (6,264,9467,422333,15833292)),
+    ("castling rights",lambda: Position.from_fen("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8"),
+                    (44,1486,62379,2103487,89941194)),
+    ("middlegame",lambda: Position.from_fen("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10"),
+                    (46,2079,89890,3894594,164075551))]
+
+def benchmark_fast_perft(max_depth = 5,workers = 1,mb = 64):
+    """runs fast_perft on perft_positions up to max_depth, checking the published counts, and prints the time taken"""
+    for name,make_position,counts in perft_positions:
+        for depth in range(1,min(max_depth,len(counts)) + 1):
+            time0 = time.time()
+            nodes = fast_perft(make_position(),depth,workers,mb)
+            print name,"depth =",depth,"nodes =",nodes,"time =",round(time.time() - time0,2)
+            assert nodes == counts[depth - 1], (name,depth,nodes,counts[depth - 1])
+
+#fixed suite of positions for search benchmarks: the initial position, the middlegame and castling
+#positions from test_suite and Kiwipete. each entry creates a fresh Position
+benchmark_positions = [lambda: Position(),
+    lambda: Position(setup_position(["Kg1,Qd3,Ra1,Re1,Bd2,Nf3,Pa5,Pc2,Pd5,Pe4,Pf4,Pg3,Ph3",\
+                    "Kg8,Qe7,Ra8,Re8,Bb5,Nd7,Nh5,Bg7,Pa6,Pb7,Pc5,Pc4,Pd6,Pf5,Pg6,Ph7"]),sgn = -1),
+    lambda: Position(setup_position(["Ke1,Ra1,Rh1,Nb3,Ng3,Pc2,Pd2,Pe5","Ke8,Bb4,Bf3,Qh4,Pd5"]),\
+                    move_seq = [(84,64)],wc = (True,False),bc = (False,False)),
+    lambda: Position(setup_position(["Ke1,Qf3,Ra1,Rh1,Bd2,Be2,Nc3,Ne5,Pa2,Pb2,Pc2,Pd5,Pe4,Pf2,Pg2,Ph2",\
+                    "Ke8,Qe7,Ra8,Rh8,Ba6,Bg7,Nb6,Nf6,Pa7,Pb4,Pc7,Pd7,Pe6,Pf7,Pg6,Ph3"]),wc = (True,True))]
+
+search_options = (("alpha-beta",{"pvs": False,"null_move": False,"lmr": False},None),
+                  ("pvs",{"null_move": False,"lmr": False},None),
+                  ("pvs + aspiration",{"null_move": False,"lmr": False},50),
+                  ("null move",{"lmr": False},50),
+                  ("lmr",{"null_move": False},50),
+                  ("null move + lmr",{},50))
+
+def benchmark_search(depth = 4,seeds = 2,options = search_options):
+    """prints the nodes searched by iterative_deepening to depth on benchmark_positions for each of options, 
+    given as (name, keyword arguments of Search, aspiration window), averaged over seeds since ties in move 
+    order are broken randomly"""
+    for make_position in benchmark_positions:
+        counts = []
+        for name,kwargs,aspiration in options:
+            nodes = 0
+            for seed in range(seeds):
+                random.seed(seed)
+                search = Search(**kwargs)
+                iterative_deepening(make_position(),depth,search = search,aspiration = aspiration)
+                nodes += search.nodes
+            counts.append("%s = %d" % (name,nodes / seeds))
+        print "depth =",depth,"nodes:",", ".join(counts)
+
+def benchmark_depth(movetime = 2000,options = search_options):
+    """prints the depth iterative_deepening completes on benchmark_positions within movetime milliseconds 
+    for each of options, given as for benchmark_search"""
+    for make_position in benchmark_positions:
+        depths = []
+        for name,kwargs,aspiration in options:
+            random.seed(0)
+            search = Search(movetime,**kwargs)
+            iterative_deepening(make_position(),search = search,aspiration = aspiration)
+            depths.append("%s = %d" % (name,search.depth))
+        print "movetime =",movetime,"depth:",", ".join(depths)
+
+def benchmark_parallel(depth = 5,worker_counts = (1,2,4,8,16)):
+    """prints the time iterative_deepening with workers processes takes to reach depth on benchmark_positions,
+    and the speedup over a single process"""
+    for make_position in benchmark_positions:
+        times = []
+        for workers in worker_counts:
+            random.seed(0)
+            search = Search()
+            time0 = time.time()
+            iterative_deepening(make_position(),depth,search = search,workers = workers)
+            times.append(time.time() - time0)
+            print "workers =",workers,"time =",round(times[-1],2),"nodes =",search.nodes,\
+                "speedup =",round(times[0] / times[-1],2)
+
+def benchmark_lazy_smp(depth = 5,worker_counts = (1,2,4,8,16)):
+    """prints the time to depth of lazy_smp with workers processes on benchmark_positions, and the speedup 
+    over single-threaded iterative_deepening"""
+    for make_position in benchmark_positions:
+        random.seed(0)
+        time0 = time.time()
+        iterative_deepening(make_position(),depth)
+        single = time.time() - time0
+        print "single-threaded time =",round(single,2)
+        for workers in worker_counts:
+            search = Search()
+            time0 = time.time()
+            lazy_smp(make_position(),depth,workers = workers,search = search)
+            print "workers =",workers,"time =",round(time.time() - time0,2),"nodes =",search.nodes,\
+                "speedup =",round(single / (time.time() - time0),2)
+
+def benchmark_tt(depth = 4,mb = 16,seeds = 3):
+    """prints tree_search node counts without and with a transposition table for positions 
+    from test_suite, averaged over seeds since ties in move order are broken randomly"""
+    for make_position in benchmark_positions:
+        counts = [0,0]
+        for seed in range(seeds):
+            for i in range(2):
+                random.seed(seed)
+                search = Search()
+                tree_search(make_position(),depth,q = False,tt = TranspositionTable(mb) if i else None,search = search)
+                counts[i] += search.stats.nodes
+        print "depth =",depth,"nodes without tt =",counts[0] / seeds,"with tt =",counts[1] / seeds
+
+def benchmark_perft(depth = 3,backend = "mailbox"):
+    """prints and returns the number of perft nodes per second from the initial position, 
+    for a position class from backends"""
+    pos = backends[backend]()
+    time0 = time.time()
+    nodes = perft(pos,depth)
+    rate = nodes / (time.time() - time0)
+    print backend,"perft(%d) nodes per second =" % depth,rate
+    return rate
+
+def benchmark_hash(n = 1000000):
+    """prints and returns the number of incremental hash updates per second, cycling through the moves of the initial position"""
+    pos = Position()
+    moves = pos.make_move_list()
+    h = pos.hash
+    time0 = time.time()
+    for i in xrange(n):
+        h = update_hash(pos,h,moves[i % len(moves)])
+    rate = n / (time.time() - time0)
+    print "hash updates per second =",rate
+    return rate
+    
+def benchmark_movegen(n = 20):
+    """prints and returns the number of legal move lists per second generated by legal_moves and by filtering 
+    pseudo-legal moves with king_hanging, over the positions after each move from Kiwipete"""
+    pos = Position(setup_position(["Ke1,Qf3,Ra1,Rh1,Bd2,Be2,Nc3,Ne5,Pa2,Pb2,Pc2,Pd5,Pe4,Pf2,Pg2,Ph2",\
+                    "Ke8,Qe7,Ra8,Rh8,Ba6,Bg7,Nb6,Nf6,Pa7,Pb4,Pc7,Pd7,Pe6,Pf7,Pg6,Ph3"]),wc = (True,True))
+    times = [0,0]
+    moves = pos.make_move_list()
+    for move in moves:
+        pos.make_move(move)
+        time0 = time.time()
+        for i in xrange(n):
+            pos.legal_moves()
+        times[0] += time.time() - time0
+        time0 = time.time()
+        for i in xrange(n):
+            [m for m in pos.make_move_list(check_for_king_hanging = False) if not pos.king_hanging(m)]
+        times[1] += time.time() - time0
+        pos.unmake_move()
+    rates = [n*len(moves) / t for t in times]
+    print "move lists per second: legal_moves =",rates[0],"filtered with king_hanging =",rates[1]
+    return rates
+
+def benchmark_attacks(n = 20):
+    """prints and returns the number of is_attacked queries per second, asking for every square 
+    of the middlegame position from test_suite whether it is attacked by either side"""
+    pos = Position(setup_position(["Kg1,Qd3,Ra1,Re1,Bd2,Nf3,Pa5,Pc2,Pd5,Pe4,Pf4,Pg3,Ph3",\
+                    "Kg8,Qe7,Ra8,Re8,Bb5,Nd7,Nh5,Bg7,Pa6,Pb7,Pc5,Pc4,Pd6,Pf5,Pg6,Ph7"]))
+    time0 = time.time()
+    for i in xrange(n):
+        for sgn in (1,-1):
+            pos.sgn = sgn
+            for square in on_board:
+                pos.is_attacked(square)
+    rate = 2*64*n / (time.time() - time0)
+    pos.sgn = 1
+    print "squares attacked queries per second =",rate
+    return rate
     
-def zobrist_init():
-    """fill a table of random bitstrings"""
+zobrist_seed = 20240607 #fixed, so that hashes are reproducible
+
+def zobrist_init(seed = zobrist_seed):
+    """fill a table of random 64-bit keys. they only depend on seed, so hashes are the same in every process 
+    and every run"""
     
-    global table
+    global table, piece_keys
+    generator = random.Random(seed)
     table = [0]*77
     #indices 0-63 of table hold piece-square pairs, 64 is for black to move, 65-68 for castling rights, 69-76 for e.p. column
     for i in range(64): 
-        table[i] = [0]*12
-        for j in range(12):
-            s = ""
-            for k in range(64):
-                s += str(random.randint(0,1))
-            table[i][j] = s
+        table[i] = [generator.getrandbits(64) for j in range(12)]
     for i in range(64,77):
-        s = ""
-        for k in range(64):
-            s += str(random.randint(0,1))
-        table[i] = s
+        table[i] = generator.getrandbits(64)
+    #the piece-square keys once more, indexed by piece + 6 and square of the 120-square board like eval_mg
+    piece_keys = [[table[square_index[square]][piece_index(piece)] if piece != 0 and square in on_board_set else 0\
+                   for square in range(120)] for piece in range(-6,7)]
     return table
 
+def piece_index(piece):
+    """maps piece representations -6..-1 (black) and 1..6 (white) to indices 0-11 of the zobrist table"""
+    return piece + 6 if piece < 0 else piece + 5
 
-def xor(a,b):
-    c = ""
-    #print "a=",a
-    #print "b=",b
-    #assert len(a) == len(b)
-    for i in range(len(a)):
-        if a[i] != b[i]:
-            c += "1"
-        else:
-            c += "0"
-    return c
+zobrist_init() #zobrist keys are created once, when the module is loaded
+
+def rights_hash(wc,bc,ep):
+    """returns the part of the hash due to castling rights and e.p. column"""
+    h = 0
+    if wc[0]:#white kingside
+        h ^= table[65]
+    if wc[1]:#white queenside
+        h ^= table[66]
+    if bc[0]:#black kingside
+        h ^= table[67]
+    if bc[1]:#black queenside
+        h ^= table[68]
+    if ep is not None: #ep indicates e.p. column (where pawn has just made a double-step)
+        h ^= table[68 + ep]
+    return h
     
 def zobrist_hash(pos):
-    global table
-    
-    h = '0'*64
+    """computes the hash of a position from scratch"""
+    h = 0
     #square-piece pairs
     for i in range(len(on_board)):
-        if pos.board[on_board[i]] != 0:
-            j = pos.board[on_board[i]]
-            if j < 0:
-                j += 6
-            else:
-                j += 5
-                
-            #print i
-            #print j
-            h = xor(h,table[i][j])
+        j = pos.board[on_board[i]]
+        if j != 0:
+            h ^= table[i][piece_index(j)]
     #black to move
     if pos.sgn == -1:
-        h = xor(h,table[65])
-    #castling rights
-    if pos.wc[0]:#white kingside
-        h = xor(h,table[66])
-    if pos.wc[1]:#white queenside
-        h = xor(h,table[67])
-    if pos.bc[0]:#black kingside
-        h = xor(h,table[68])
-    if pos.bc[1]:#black queenside
-        h = xor(h,table[69])
-    #en passant column
-    if pos.ep is not None: #pos.ep indicate e.p. column (where pawn has just made a double-step)
-        h = xor(h,table[69 + pos.ep])
-        
-    return h
+        h ^= table[64]
+    return h ^ rights_hash(pos.wc,pos.bc,pos.ep)
 
 def update_hash(pos,h,move):
-    global ht
+    """returns hash h updated for move: moved, captured and promoted pieces, castling rook and side to move.
+    castling rights and e.p. column are xored in by make_move once update_rights has determined them"""
+    board = pos.board
+    piece = board[move[0]]
+    start_sq = square_index[move[0]]
+    target_sq = square_index[move[1]]
+    start_piece = piece_index(piece)
     
-    start_sq = on_board.index(move[0])
-    start_piece = pos.board[move[0]] + 6 if pos.board[move[0]] < 0 else pos.board[move[0]] + 5
-    
-    target_sq = on_board.index(move[1])
-    h = xor(h,table[start_sq][start_piece]) #piece not on start square
+    h ^= table[start_sq][start_piece] #piece not on start square
     
     if len(move) == 2:    
-        h = xor(h,table[target_sq][start_piece]) #piece on target square
+        h ^= table[target_sq][start_piece] #piece on target square
     else: #if promotion
-        promoted_to = move[2] * -1 + 5 if pos.board[move[0]] < 0 else move[2] + 6
-        h = xor(h,table[target_sq][promoted_to]) 
-    if pos.board[move[1]]:
-        target_piece = pos.board[move[1]] + 5 if pos.board[move[1]] < 0 else pos.board[move[1]] + 6
-        h = xor(h,table[target_sq][target_piece]) #captured piece not on target square
+        promoted_to = piece_index(move[2] if piece > 0 else -move[2])
+        h ^= table[target_sq][promoted_to]
+    if board[move[1]]:
+        h ^= table[target_sq][piece_index(board[move[1]])] #captured piece not on target square
     
     #castling
-    if pos.board[move[0]] == 6:
+    if piece == 6:
         if move[1] - move[0] == 2: #white kingside
-            h = xor(h,table[7][4]) #rook no longer on h1
-            h = xor(h,table[5][4]) #rook on f1
+            h ^= table[7][9] ^ table[5][9] #rook from h1 to f1
         elif move[1] - move[0] == -2: #white queenside
-            h = xor(h,table[0][4]) #rook no longer on a1
-            h = xor(h,table[3][4]) #rook on d1
-    elif pos.board[move[0]] == -6:
+            h ^= table[0][9] ^ table[3][9] #rook from a1 to d1
+    elif piece == -6:
         if move[1] - move[0] == 2: #black kingside
-            h = xor(h,table[63][2]) #rook no longer on h8
-            h = xor(h,table[61][2]) #rook on f8
+            h ^= table[63][2] ^ table[61][2] #rook from h8 to f8
         elif move[1] - move[0] == -2: #black queenside
-            h = xor(h,table[56][2]) #rook no longer on a8
-            h = xor(h,table[59][2]) #rook on d8
+            h ^= table[56][2] ^ table[59][2] #rook from a8 to d8
 
     #en passant
-    elif pos.board[move[0]] == 1:
-        if not pos.board[move[1]]: 
+    elif piece == 1:
+        if not board[move[1]]: 
             if move[1] - move[0] == 9: #white takes e.p. up-left
-                h = xor(h,table[start_sq - 1][5]) #black pawn to the left of start_sq is gone
+                h ^= table[start_sq - 1][5] #black pawn to the left of start_sq is gone
             elif move[1] - move[0] == 11: #white takes e.p. up-right
-                h = xor(h,table[start_sq + 1][5]) #black pawn to the right of start_sq is gone
-    elif pos.board[move[0]] == -1:
-        if not pos.board[move[1]]: 
+                h ^= table[start_sq + 1][5] #black pawn to the right of start_sq is gone
+    elif piece == -1:
+        if not board[move[1]]: 
             if move[1] - move[0] == -9: #black takes e.p. down-right
-                h = xor(h,table[start_sq + 1][6]) #white pawn to the right of start_sq is gone
+                h ^= table[start_sq + 1][6] #white pawn to the right of start_sq is gone
             elif move[1] - move[0] == -11: #black takes e.p. down-left
-                h = xor(h,table[start_sq - 1][6]) #white pawn to the left of start_sq is gone
+                h ^= table[start_sq - 1][6] #white pawn to the left of start_sq is gone
                  
     #other side to move
-    h = xor(h,table[64])
-    
-    #castling rights
-    
-    old_wc = pos.wc[:]
-    old_bc = pos.bc[:]
+    return h ^ table[64]
+
+def update_rights(pos,move):
+    """updates castling rights and e.p. column of pos for move, which is about to be made"""
     
     #print pos.sgn
     if pos.sgn == 1:
@@ -1182,41 +3664,27 @@ def update_hash(pos,h,move):
     else:
         pos.wc = (False,False)
     sq = 95 if pos.sgn == 1 else 25 #if black just moved then update white's castling rights or vice-versa
-    #check that king has not moved, rook has not moved, rook is still there,\
-    #all squares inbetween are empty, king is not in check
+    #check that king has not moved and is still on its square, rook has not moved and is still there
+    #(not captured by move), all squares inbetween are empty after move, king is not in check
     c = abs(pos.board[move[0]]) == 6 and abs(move[1]-move[0]) == 2
-    starts = [m[0] for m in pos.move_seq]
-    if sq not in starts and not pos.check_check(move,c):
-        ks = False
-        #kingside castling
-        if sq + 3 not in starts and abs(pos.board[sq+3]) == 4 and pos.board[sq+1] == 0 and pos.board[sq+2] == 0:
+    starts = pos.moved.union(m[0] for m in pos.move_seq)
+    if sq not in starts and pos.board[sq] == -6*pos.sgn and not pos.check_check(move,c):
+        old_board = pos.board[:]
+        pos.make_move(move,update_in_check = False,just_board = True)
         #check that king wouldn't castle over attacked square
-            
-            old_board = pos.board[:]
-            pos.make_move(move,update_in_check = False,just_board = True)
-     
-            if not pos.king_hanging((sq,sq+1)) and not pos.king_hanging((sq,sq+2)):
-                ks = True       
-            pos.sgn = 1 if pos.sgn == -1 else -1
-            pos.board = old_board[:]
         
-        qs = False
+        #kingside castling
+        ks = sq + 3 not in starts and pos.board[sq+3] == 4*pos.sgn and pos.board[sq+1] == 0 and pos.board[sq+2] == 0\
+            and not pos.king_hanging((sq,sq+1)) and not pos.king_hanging((sq,sq+2))
         #queenside castling
-        if sq - 4 not in starts and abs(pos.board[sq-4]) == 4 and pos.board[sq-1] == 0 and pos.board[sq-2] == 0 and pos.board[sq-3] == 0:              
-            #check that king wouldn't castle over attacked square
-            
-            old_board = pos.board[:]
-            pos.make_move(move,update_in_check = False,just_board = True)
-            
-            if not pos.king_hanging((sq,sq-1)) and not pos.king_hanging((sq,sq-2)):
-                #add castling to offsets
-                qs = True
-            pos.sgn = 1 if pos.sgn == -1 else -1 
-            pos.board = old_board[:]
-            if sq == 25:
-                pos.wc = (ks,qs)
-            else:
-                pos.bc = (ks,qs)
+        qs = sq - 4 not in starts and pos.board[sq-4] == 4*pos.sgn and pos.board[sq-1] == 0 and pos.board[sq-2] == 0\
+            and pos.board[sq-3] == 0 and not pos.king_hanging((sq,sq-1)) and not pos.king_hanging((sq,sq-2))
+        pos.sgn = 1 if pos.sgn == -1 else -1 
+        pos.board = old_board[:]
+        if sq == 25:
+            pos.wc = (ks,qs)
+        else:
+            pos.bc = (ks,qs)
                    
     #if other side made a null move, could player castle?  just do an 
     #in-principle update indicating whether rook or king have already moved. then do full update when sgn changes
@@ -1226,48 +3694,20 @@ def update_hash(pos,h,move):
     else:
         king_sq = 95
         rook_sqs = (98,91)    
-    if king_sq != move[0] and king_sq not in starts:
-        ks = rook_sqs[0] != move[0] and rook_sqs[0] not in starts
-        qs = rook_sqs[1] != move[0] and rook_sqs[1] not in starts
+    if king_sq != move[0] and king_sq not in starts and pos.board[king_sq] == 6*pos.sgn:
+        ks = rook_sqs[0] != move[0] and rook_sqs[0] not in starts and pos.board[rook_sqs[0]] == 4*pos.sgn
+        qs = rook_sqs[1] != move[0] and rook_sqs[1] not in starts and pos.board[rook_sqs[1]] == 4*pos.sgn
         if pos.sgn == 1:
             pos.wc = (ks,qs)
         else:
             pos.bc = (ks,qs)
-    pos.wch.append(pos.wc)
-    pos.bch.append(pos.bc)
-    
-    if pos.wc[0] != old_wc[0]:#white kingside
-        h = xor(h,table[65])
-    if pos.wc[1] != old_wc[1]:#white queenside
-        h = xor(h,table[66])
-    if pos.bc[0] != old_bc[0]:#black kingside
-        h = xor(h,table[67])
-    if pos.bc[1] != old_bc[1]:#black queenside
-        h = xor(h,table[68])        
                                                            
     #ep column
-    old_ep = pos.ep
-    #print abs(pos.board[move[0]]) == 1
-    #print abs(move[1] - move[0]) == 20
-    #print -pos.sgn
-    #print -pos.sgn in (pos.board[move[1] - 1],pos.board[move[1] + 1])
     if abs(pos.board[move[0]]) == 1 and abs(move[1] - move[0]) == 20\
         and -pos.sgn in (pos.board[move[1] - 1],pos.board[move[1] + 1]):
         pos.ep = move[0] % 10
     else:
         pos.ep = None
-    if old_ep != pos.ep:
-        if old_ep is not None:
-            h = xor(h,table[68 + old_ep]) #xor out old pos.ep
-        if pos.ep is not None:
-            h = xor(h,table[68 + pos.ep]) #xor in new pos.ep
-    pos.eph.append(pos.ep)        
-    ht["ordered"].append(h)
-    if h in ht:
-        ht[h]["moves"].append(pos.num + 1)
-    else:
-        ht[h] = {"moves": [pos.num + 1]}
-    return h
 
 def test_suite():
     """tests play_game function"""
@@ -1363,10 +3803,6 @@ def test_suite():
     pos.print_board2()
     
     print "testing hashing"
-    global ht
-    ht = dict()    
-    zobrist_init()
-    
     h = []
     
     pos = Position(initial_board[:])
@@ -1374,134 +3810,199 @@ def test_suite():
     assert pos.bc == (True,True)
     assert pos.ep is None
     h1 = zobrist_hash(pos)
+    assert h1 == pos.hash
     h.append(h1)
-    ht["ordered"].append(h1)
     
     move = (27,46) #Ng1-f3
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     assert pos.wc == (True,True)
     assert pos.bc == (False,False)
     assert pos.ep is None
     
     move = (97,76) #Ng8-f6
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (46,27) #Nf3-g1
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (76,97) #Nf6-g8
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     assert h[0] == h[4]
     
     move = (31,41) #a2-a3
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (84,64) #d7-d5
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (22,43) #b1-c3
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (64,54) #d5-d4
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (35,55) #e2-e4, now ep possible
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     assert pos.ep == 5
     
     move = (94,84) #Qd8-d7
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (26,53) #Bf1-c4, now ep no longer possible
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     assert h[8] != h[10]
     
     move = (84,94) #Qd7-d8
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (53,26) #Bc4-f1
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     assert pos.sgn == -1
     
     assert len(set(h)) == 13
     
     move = (54,43) #d4-c3
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (34,43) #d2-c3
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (94,24) #Qd8-d1
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (25,24) #Ke1-d1
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (93,75) #Bc8-e6
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (24,25) #Kd1-e1
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (92,71) #Nb8-a6
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     assert pos.wc == (False,False)
     
     move = (23,67) #Bc1-g5
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     assert pos.bc == (False,True)
     
     move = (88,68) #h7-h5
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (26,62) #Bf1-b5
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     assert pos.bc == (False,False)
     
     assert len(set(h)) == 23
     
     move = (83,73) #c7-c6
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (62,71) #Bb5-a6
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     assert pos.bc == (False,True)
     
     move = (97,76) #Ng8-f6
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     
     move = (71,82) #Ba6-b7
-    h.append(update_hash(pos,h[-1],move)) 
     pos.make_move(move)
+    h.append(pos.hash)
     assert pos.bc == (False,False)
     assert len(set(h)) == 27
     
+    print "testing incremental hashing against zobrist_hash"
+    position = Position()
+    assert perft_hash_check(position,4) == 197281
+    
+    print "testing unmake_move"
+    board = setup_position(["Ke1,Ra1,Rh1,Pb7,Pe5","Ke8,Rh8,Pd7"])
+    position = Position(board = board,sgn = -1,bc = (True,False))
+    position.make_move((84,64)) #d7-d5, so e5xd6 e.p. is possible
+    before = (position.board[:],position.hash,position.wc,position.bc,position.ep,position.fifty_move_counter)
+    moves = position.make_move_list()
+    assert (65,74) in moves and (25,27) in moves and (25,23) in moves and (82,92,5) in moves
+    for move in moves:
+        position.make_move(move)
+        position.unmake_move()
+        assert (position.board,position.hash,position.wc,position.bc,position.ep,position.fifty_move_counter) == before
+    #castling rights are only used by a king and rook on their initial squares
+    board = setup_position(["Kg1,Rh1,Pa2","Kg8,Rh8,Ra8,Pa7"])
+    position = Position(board = board,sgn = -1,bc = (True,True))
+    assert (97,95) not in position.make_move_list()
+    position.make_move((97,96))
+    position.make_move((31,41))
+    assert position.bc == (False,False)
+    
+    print "testing transposition table"
+    tt = TranspositionTable(1)
+    tt.store(5,3,10,"exact",(31,41))
+    assert tt.probe(5) == (5,3,10,"exact",(31,41))
+    h2 = 5 + tt.mask + 1 #same bucket
+    tt.store(h2,1,0,"upper",None) #shallower, so goes to the always-replace slot
+    assert tt.probe(5)[1] == 3 and tt.probe(h2)[1] == 1
+    tt.store(h2 + tt.mask + 1,2,0,"lower",(32,42))
+    assert tt.probe(h2) is None and tt.probe(5) is not None
+    tt.store(5 + 3*(tt.mask + 1),3,0,"lower",(32,42)) #as deep, so replaces depth-preferred slot
+    assert tt.probe(5) is None
+    position = Position()
+    for move in [(27,46),(97,76),(46,27),(76,97)]*2: #Nf3 Nf6 Ng1 Ng8 twice, so the start repeats three times
+        position.make_move(move)
+    tt.store(position.hash,5,500,"exact",(32,42))
+    assert tree_search(position,2,total_depth = 1,tt = tt) == (None,0) and tt.probe(position.hash)[2] == 500
+    
+    print "testing iterative deepening"
+    position = Position()
+    assert iterative_deepening(position,2,q = False)[1] == tree_search(position,2,q = False)[1]
+    time0 = time.time()
+    move, score = iterative_deepening(position,movetime = 300)
+    assert move in position.make_move_list() and time.time() - time0 < 0.6
+    search = Search(max_nodes = 200)
+    move, score = iterative_deepening(position,search = search)
+    assert move in position.make_move_list() and search.nodes <= 201 and search.depth >= 1
+    
+    print "testing principal variation search"
+    position = Position(setup_position(["Kg1,Qd3,Ra1,Re1,Bd2,Nf3,Pa5,Pc2,Pd5,Pe4,Pf4,Pg3,Ph3",\
+                        "Kg8,Qe7,Ra8,Re8,Bb5,Nd7,Nh5,Bg7,Pa6,Pb7,Pc5,Pc4,Pd6,Pf5,Pg6,Ph7"]),sgn = -1)
+    assert tree_search(position,3,search = Search(null_move = False,lmr = False))[1] ==\
+        tree_search(position,3,search = Search(pvs = False,null_move = False,lmr = False))[1]
+    search = Search()
+    move, score = iterative_deepening(position,4,search = search,aspiration = 10)
+    assert search.pv_line[0] == move and len(search.pv_line) >= 2
+    for pv_move in search.pv_line:
+        assert pv_move in position.make_move_list()
+        position.make_move(pv_move)
+    position.rollback(len(search.pv_line))
+    assert len(position.undo) == 0 and position.sgn == -1 and position.board == setup_position(\
+        ["Kg1,Qd3,Ra1,Re1,Bd2,Nf3,Pa5,Pc2,Pd5,Pe4,Pf4,Pg3,Ph3","Kg8,Qe7,Ra8,Re8,Bb5,Nd7,Nh5,Bg7,Pa6,Pb7,Pc5,Pc4,Pd6,Pf5,Pg6,Ph7"])
+    
     print "testing perft function"
     position = Position()
     assert perft(position,0) == 1
@@ -1511,9 +4012,348 @@ def test_suite():
     assert perft(position,2) == 400
     position = Position()
     assert perft(position,3) == 8902
+    assert position.board == list(initial_board) and position.hash == zobrist_hash(position)
     #assert perft(position,4) == 197281
     #assert perft(position,5) == 4865609
     
+    print "testing bitboard backend against mailbox"
+    kiwipete = ["Ke1,Qf3,Ra1,Rh1,Bd2,Be2,Nc3,Ne5,Pa2,Pb2,Pc2,Pd5,Pe4,Pf2,Pg2,Ph2",\
+                "Ke8,Qe7,Ra8,Rh8,Ba6,Bg7,Nb6,Nf6,Pa7,Pb4,Pc7,Pd7,Pe6,Pf7,Pg6,Ph3"]
+    position = BitboardPosition()
+    assert perft_hash_check(position,3) == 8902
+    assert position.board == list(initial_board) and position.hash == zobrist_hash(position)
+    assert perft(BitboardPosition(setup_position(kiwipete)),2) == perft(Position(setup_position(kiwipete),wc = (True,True)),2) == 2039
+    position = Position(setup_position(kiwipete),wc = (True,True))
+    assert perft(position,3) == 97862
+    assert perft_movegen_check(position,2) == 2039
+    assert perft_movegen_check(Position(setup_position(["Ka5,Rb4,Pb5,Pe2,Pg2","Kh4,Rh5,Pc7,Pd6,Pf4"]),bc = (False,False)),3) == 2812
+    #piece squares, king squares and piece count are restored by unmake_move
+    assert position.piece_squares == Position(setup_position(kiwipete)).piece_squares
+    assert position.kings == {1: 25, -1: 95} and position.num_pieces == 32
+    position = BitboardPosition(setup_position(["Ka5,Rb4,Pb5,Pe2,Pg2","Kh4,Rh5,Pc7,Pd6,Pf4"]))
+    assert perft(position,3) == perft(Position(setup_position(["Ka5,Rb4,Pb5,Pe2,Pg2","Kh4,Rh5,Pc7,Pd6,Pf4"]),\
+                                               bc = (False,False)),3) == 2812
+    assert position.is_attacked(54) and not position.is_attacked(65)
+    
+    print "testing fast perft"
+    position = Position(setup_position(kiwipete),wc = (True,True))
+    divide = perft_divide(position,2,mb = 1)
+    assert len(divide) == 48 and sum(divide.values()) == 2039
+    for move in divide:
+        position.make_move(move)
+        assert divide[move] == perft(position,1)
+        position.unmake_move()
+    assert fast_perft(position,3,workers = 2) == 97862
+    for name,make_position,counts in perft_positions:
+        assert fast_perft(make_position(),4 if name != "Kiwipete" else 3) == counts[3 if name != "Kiwipete" else 2]
+    
+    print "testing fen"
+    fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+    position = Position.from_fen(fen)
+    assert position.castling_pending and position.wc == (True,True) #castling is blocked, but not checked yet
+    assert position.to_fen() == fen and position.hash == Position().hash and position.wc == (False,False)
+    position.make_move((35,55))
+    position.make_move((84,64))
+    position.make_move((55,65))
+    position.make_move((86,66))
+    fen = "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3"
+    position_from_fen = Position.from_fen(fen)
+    assert position.to_fen() == fen and set(position_from_fen.make_move_list()) == set(position.make_move_list())
+    assert position_from_fen.hash == position.hash
+    position = Position.from_fen("r3k2r/8/8/8/8/8/8/R3K2R b Kk - 5 40") #queenside rooks haven't moved, but have no rights
+    assert position.to_fen() == "r3k2r/8/8/8/8/8/8/R3K2R b Kk - 5 40" and position.num == 80
+    assert position.bc == (True,False) and len(position.make_move_list()) == 25
+    position.make_move((91,81))
+    assert position.wc == (True,False) and position.to_fen() == "4k2r/r7/8/8/8/8/8/R3K2R w Kk - 6 41"
+    for name,make_position,counts in perft_positions[1:]:
+        position = make_position()
+        assert position.hash == zobrist_hash(position) and perft_hash_check(position,2) == counts[1]
+        assert Position.from_fen(position.to_fen()).to_fen() == position.to_fen()
+    
+    print "testing concurrent games"
+    position = Position()
+    for move in [(27,46),(97,76),(46,27),(76,97)] * 2:
+        assert evaluate_draw(position)[0] is None
+        position.make_move(move)
+    assert position.repetitions[position.hash] == 3 and evaluate_draw(position) == (0.5,"threefold repetition")
+    random.seed(1)
+    games = [Position() for i in range(1000)]
+    for ply in range(12):
+        for game in games:
+            moves = game.make_move_list()
+            if moves:
+                game.make_move(random.choice(moves))
+    for game in games:
+        replay = Position()
+        for move in game.move_seq:
+            replay.make_move(move)
+        assert game.hash == zobrist_hash(game) == replay.hash and game.board == replay.board
+        assert game.repetitions == replay.repetitions and game.to_fen() == replay.to_fen()
+        game.rollback(len(game.move_seq))
+        assert game.hash == Position().hash and game.repetitions == {game.hash: 1} and game.board == list(initial_board)
+    
+    print "testing uci"
+    assert parse_uci_move("e7e8q") == (85,95,5) and uci_move((85,95,5)) == "e7e8q" and uci_move((35,55)) == "e2e4"
+    lines = []
+    engine = UCIEngine(lines.append)
+    engine.handle("uci")
+    assert lines[-1] == "uciok"
+    engine.handle("setoption name Hash value 1")
+    engine.handle("position startpos moves e2e4 e7e5 g1f3")
+    assert engine.position.to_fen() == "rnbqkbnr/pppp1ppp/8/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 1 2"
+    engine.handle("go depth 2")
+    engine.thread.join()
+    assert lines[-2].startswith("info depth 2 score cp") and lines[-1].startswith("bestmove")
+    assert parse_uci_move(lines[-1].split()[1]) in engine.position.make_move_list()
+    #drawn roots with legal moves: insufficient material and threefold repetition
+    for command in ["position fen 8/8/8/8/8/8/8/K6k w - - 0 1","position startpos moves g1f3 g8f6 f3g1 f6g8 g1f3 g8f6 f3g1 f6g8"]:
+        engine.handle(command)
+        sent = len(lines)
+        engine.handle("go depth 2")
+        engine.thread.join()
+        assert len(lines) > sent and lines[-1].startswith("bestmove") and parse_uci_move(lines[-1].split()[1]) in engine.position.make_move_list()
+    engine.handle("position startpos")
+    engine.handle("go infinite")
+    engine.handle("isready")
+    assert "readyok" in lines and engine.thread.is_alive()
+    engine.handle("stop")
+    assert lines[-1].startswith("bestmove") and engine.thread is None
+    engine.handle("setoption name Threads value 2")
+    engine.handle("go infinite")
+    time.sleep(0.5)
+    time0 = time.time()
+    engine.handle("stop")
+    assert time.time() - time0 < 1 and lines[-1].startswith("bestmove") and engine.thread is None
+    engine.handle("setoption name Threads value 1")
+    for command in ["go infinite","go"]:
+        engine.handle("position fen k7/8/1K6/8/8/8/8/7R w - - 0 1") #mate in one, found at once
+        engine.handle(command)
+        time.sleep(0.2)
+        assert engine.thread.is_alive() and not lines[-1].startswith("bestmove")
+        engine.handle("stop")
+        assert lines[-1] == "bestmove h1h8" and engine.thread is None
+    assert engine.handle("quit") == False
+    
+    print "testing opening book"
+    position = Position()
+    for san in ["d4","d5","Nf3","Nf6"]:
+        position.make_move(parse_san(position,san))
+    assert parse_san(position,"Nbd2") == (22,34) and parse_san(position,"Nfxd2?!") == (46,34)
+    try:
+        parse_san(position,"Nd2")
+        assert False
+    except ValueError:
+        pass
+    pgn = ['[Event "1"]','[Result "1-0"]','','1. e4 e5 2. Nf3 {main line} Nc6 (2... d6) 3. Bb5 a6 4. O-O 1-0','',
+           '[Event "2"]','[Result "1/2-1/2"]','1. e4 c5 ; sicilian','2. Nf3 d6 $1 1/2-1/2',
+           '[Event "3"]','[FEN "rnbqkbnr/pppppppp/8/8/3P4/8/PPP1PPPP/RNBQKBNR b KQkq - 0 1"]','1... d5 0-1']
+    games = list(read_pgn(pgn))
+    assert [moves for headers,moves,result in games] == [["e4","e5","Nf3","Nc6","Bb5","a6","O-O"],["e4","c5","Nf3","d6"],["d5"]]
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    build_book(pgn,path)
+    book = OpeningBook(path)
+    position = Position()
+    assert book.moves(position) == [((35,55),3)] and book.choose(position) == (35,55)
+    for move in [(35,55),(85,65),(27,46),(92,73),(26,62),(81,71)]:
+        assert position.sgn == -1 or book.moves(position) != [] #black's moves of the first game lost
+        position.make_move(move)
+    assert book.moves(position) == [((25,27),2)] #castling, encoded as the king taking the rook
+    position.make_move((25,27))
+    assert book.choose(position) is None
+    book.close()
+    directory = tempfile.mkdtemp()
+    os.rename(path,os.path.join(directory,"opening book.bin"))
+    lines = []
+    engine = UCIEngine(lines.append)
+    engine.handle("setoption name Book value " + os.path.join(directory,"opening book.bin"))
+    assert engine.book is not None and engine.book.choose(Position()) == (35,55)
+    engine.handle("setoption name Book value " + os.path.join(directory,"missing book.bin"))
+    assert engine.book is None and lines[-1].startswith("info string cannot open book")
+    engine.handle("isready")
+    assert lines[-1] == "readyok"
+    os.remove(os.path.join(directory,"opening book.bin"))
+    os.rmdir(directory)
+    
+    print "testing pgn"
+    position = Position(setup_position(kiwipete),wc = (True,True))
+    for move in position.make_move_list():
+        assert parse_san(position,san_move(position,move)) == move
+    assert sorted(san_move(position,move) for move in position.make_move_list() if len(move) == 2 and position.board[move[1]] < 0)\
+        == ["Bxa6","Nxd7","Nxf7","Nxg6","Qxf6","Qxh3","dxe6","gxh3"]
+    position = Position()
+    for text in ["d4","d5","Nf3","Nf6"]:
+        position.make_move(parse_san(position,text))
+    assert san_move(position,(22,34)) == "Nbd2" and san_move(position,(46,34)) == "Nfd2" and san_move(position,(35,55)) == "e4"
+    assert parse_san(Position(),"e4") == (35,55)
+    for text in ["Nb8","e5","--","Zf3"]:
+        try:
+            parse_san(Position(),text)
+            assert False
+        except ValueError:
+            pass
+    fools_mate = [(36,46),(85,65),(37,57),(94,58)]
+    text = pgn_text({"Event": 'the "fool\'s" mate',"Termination": "checkmate"},fools_mate,"0-1")
+    assert text.splitlines()[0] == '[Event "the \\"fool\'s\\" mate"]' and text.splitlines()[1] == '[Site "?"]'
+    assert text.splitlines()[-1] == "1. f3 e5 2. g4 Qh4# 0-1" and text.splitlines()[7] == '[Termination "checkmate"]'
+    headers, moves, result = list(read_pgn(text.splitlines()))[0]
+    assert moves == ["f3","e5","g4","Qh4#"] and result == "0-1" and headers["Termination"] == "checkmate"
+    assert headers["Event"] == 'the "fool\'s" mate'
+    headers, moves, result = list(read_pgn(['[Event]','[Site "a \\\\ b"]','1. e4 *']))[0]
+    assert headers == {"Site": "a \\ b"} and moves == ["e4"]
+    fen = "rnbqkbnr/ppp1pppp/8/8/3pP3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 3"
+    text = pgn_text({"FEN": fen,"SetUp": "1"},[(54,45),(34,45)])
+    assert text.splitlines()[-1] == "3... dxe3 4. dxe3 *"
+    pgn = ['[Event "1"]','1. e4 e5 2. Ke3 Nf6 *','[Event "2"]','[FEN "%s"]' % fen,'','3... dxe3 4. Qh5 *',\
+           '[Event "3"]','[FEN "bogus"]','1. e4 *','[Event "4"]','1. d4 *']
+    replayed = [(headers["Event"],position.to_fen()) for headers,position,move,result in replay_pgn(pgn)]
+    assert replayed[2][1] == fen and [event for event,position_fen in replayed] == ["1","1","2","2","4"]
+    pgn = tempfile.TemporaryFile()
+    play_game(20,"random","random",verbose = False,pgn = pgn)
+    pgn.seek(0)
+    games = list(read_pgn(pgn))
+    assert len(games) == 1 and games[0][0]["White"] == "random" and len(list(replay_pgn(pgn_text({},[]).splitlines()))) == 0
+    pgn.seek(0)
+    assert len(list(replay_pgn(pgn))) == len(games[0][1]) > 0
+    
+    print "testing tablebases"
+    path = os.path.join(tempfile.mkdtemp(),"table bases")
+    os.mkdir(path)
+    tablebases = Tablebases(path)
+    generate_tablebase(tablebases,"KRvK")
+    assert max(bytearray(tablebases.table("KRvK"))) == 2 + 32 #the longest mate takes 16 moves
+    position = Position.from_fen("k7/8/1K6/8/8/8/8/7R w - - 0 1")
+    assert tablebases.probe(position) == 3 and tablebases.best_move(position) == ((28,98),tablebase_score - 1)
+    assert iterative_deepening(position,3,tablebases = tablebases) == ((28,98),tablebase_score - 1)
+    position = Position.from_fen("7r/8/8/8/8/1k6/8/K7 b - - 0 1") #colours reversed
+    assert tablebases.score(position) == tablebase_score - 1
+    position = Position.from_fen("8/8/8/8/8/8/Rk6/7K b - - 0 1")
+    assert tablebases.best_move(position) == ((32,31),0)
+    position = Position.from_fen("8/8/3k4/8/8/8/8/R3K3 w - - 0 1")
+    code = tablebases.probe(position)
+    assert code % 2 == 1 and tablebases.probe(Position.from_fen("8/8/3k4/8/8/8/8/R3K3 w Q - 0 1")) is None
+    move, score = tree_search(position,1,search = Search(tablebases = tablebases))
+    position.make_move(move)
+    assert tablebases.probe(position) == code - 1
+    tablebases.close()
+    lines = []
+    engine = UCIEngine(lines.append)
+    engine.handle("setoption name TablebasePath value " + path)
+    assert engine.tablebases is not None and engine.tablebases.max_pieces == 3
+    assert "KPvKP" not in tablebase_names(4) and "KRvKP" in tablebase_names(4)
+    try:
+        generate_tablebase(tablebases,"KPvKP")
+        assert False
+    except ValueError:
+        pass
+    open(os.path.join(path,"KPvKP.tbl"),"wb").close() #e.g. written by an older version
+    position = Position.from_fen("8/8/4k3/8/3p4/8/4P3/4K3 w - - 0 1")
+    assert Tablebases(path).probe(position) is None
+    engine.handle("position fen k7/8/1K6/8/8/8/8/7R w - - 0 1")
+    engine.handle("go depth 3")
+    engine.thread.join()
+    assert lines[-1] == "bestmove h1h8"
+    engine.handle("setoption name TablebasePath value " + os.path.join(path,"missing"))
+    assert engine.tablebases is None and lines[-1].startswith("info string cannot open tablebases")
+    engine.handle("isready")
+    assert lines[-1] == "readyok"
+    for name in os.listdir(path):
+        os.remove(os.path.join(path,name))
+    os.rmdir(path)
+    os.rmdir(os.path.dirname(path))
+    
+    print "testing tournament"
+    assert abs(score_elo(expected_score(100)) - 100) < 1e-9 and elo_stats(10,5,10)[0] == 0
+    elo, error, llr, decision = elo_stats(600,200,400)
+    assert 58 < elo < 59 and 0 < error < elo and decision == "pass" and elo_stats(400,200,600)[3] == "fail"
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    deep, shallow = {"name": "depth 2","max_depth": 2}, {"name": "depth 1","max_depth": 1}
+    summary = tournament(path,deep,shallow,games = 4,workers = 2,max_plies = 12,verbose = False)
+    assert sum(summary[:3]) == 4 and summary[6] is None
+    with open(path,"ab") as f:
+        f.write('{"game": 5, "opening"') #interrupted while writing a result
+    tournament(path,deep,shallow,games = 6,workers = 2,max_plies = 12,verbose = False)
+    results = sorted(read_results(path),key = lambda record: record["game"])
+    assert [record["game"] for record in results] == range(6)
+    assert [record["white"] for record in results] == ["depth 2","depth 1"] * 3
+    assert results[2]["opening"] == results[3]["opening"] == tournament_openings[1]
+    os.remove(path)
+    
+    print "testing incremental evaluation"
+    assert evaluate(Position()) == 0
+    assert perft_eval_check(Position(setup_position(kiwipete),wc = (True,True)),2) == 2039
+    assert perft_eval_check(Position(setup_position(["Ka5,Rb4,Pb5,Pe2,Pg2","Kh4,Rh5,Pc7,Pd6,Pf4"]),bc = (False,False)),3) == 2812
+    position = Position(setup_position(["Ke1,Pa7","Ke8"])) #promotion
+    assert perft_eval_check(position,3) == perft(position,3)
+    assert evaluate(position) > 0 and position.phase == 0
+    
+    print "testing staged move generation"
+    position = Position(setup_position(kiwipete),wc = (True,True))
+    search = Search()
+    search.killers[1] = [(95,96),(91,92),(95,85)] #Kf8, Rb8 and Ke7, which is blocked by the own queen
+    for move in position.make_move_list():
+        position.make_move(move)
+        legal = position.make_move_list()
+        picked = list(pick_moves(position,legal[-1],1,search))
+        assert len(picked) == len(legal) and set(picked) == set(legal) and picked[0] == legal[-1]
+        captures = list(pick_moves(position,captures_only = True))
+        assert set(captures) == set(m for m in legal if len(m) > 2 or (is_capture(position.board,m) and see(position,m[1],m[0]) >= 0))
+        position.unmake_move()
+    
+    print "testing parallel search"
+    position = Position(setup_position(kiwipete),wc = (True,True))
+    search = Search(null_move = False,lmr = False)
+    move, score = iterative_deepening(position,3,q = False,search = search,aspiration = None,workers = 2)
+    assert score == tree_search(position,3,q = False,search = Search(null_move = False,lmr = False))[1]
+    assert move == search.pv_line[0] and move in position.make_move_list() and search.depth == 3
+    assert position.board == setup_position(kiwipete) and len(position.undo) == 0
+    
+    print "testing search statistics"
+    position = Position(setup_position(kiwipete),wc = (True,True))
+    search = Search(null_move = False,lmr = False)
+    log = tempfile.TemporaryFile()
+    iterative_deepening(position,3,search = search,log = log)
+    stats = search.stats
+    assert [record["depth"] for record in stats.iterations] == [1,2,3] and stats.nodes + stats.qnodes == search.nodes
+    log.seek(0)
+    assert [json.loads(line) for line in log] == stats.iterations
+    assert stats.iterations[-1]["pv"] == [uci_move(move) for move in search.pv_line] and stats.iterations[0]["branching_factor"] is None
+    assert stats.iterations[-1]["branching_factor"] > 1 and stats.iterations[-1]["total_nodes"] == search.nodes
+    assert 0 < stats.tt_hits <= stats.tt_probes and 0 < stats.first_move_cutoffs <= stats.beta_cutoffs
+    assert 0 < stats.first_move_cutoff_rate() <= 1 and stats.null_move_cutoffs == 0
+    assert position.move_list_hits <= position.move_list_calls
+    search = Search(null_move = False,lmr = False)
+    iterative_deepening(position,2,search = search,workers = 2)
+    assert search.stats.nodes > 0 and search.stats.nodes + search.stats.qnodes == search.nodes
+    
+    print "testing lazy smp"
+    tt = SharedTranspositionTable(1)
+    tt.store(5,3,-10,"lower",(31,41))
+    tt.store(7,2,99999,"exact",(82,92,5))
+    tt.store(7 + tt.mask + 1,1,0,"upper",None) #shallower, so goes to the always-replace slot
+    assert tt.probe(5) == (5,3,-10,"lower",(31,41)) and tt.probe(7) == (7,2,99999,"exact",(82,92,5))
+    assert tt.probe(7 + tt.mask + 1) == (7 + tt.mask + 1,1,0,"upper",None)
+    tt.words[4*5 + 1] ^= 1 #torn entry
+    assert tt.probe(5) is None
+    position = Position(setup_position(kiwipete),wc = (True,True))
+    search = Search()
+    move, score = lazy_smp(position,3,workers = 2,search = search)
+    assert move == search.pv_line[0] and move in position.make_move_list() and search.depth == 3
+    
+    print "testing null move pruning and late move reductions"
+    position = Position(setup_position(kiwipete),wc = (True,True))
+    position.make_move((31,51))
+    h, ep = position.hash, position.ep
+    position.make_null_move()
+    assert position.hash == zobrist_hash(position) and position.sgn == 1 and position.ep is None
+    assert perft_hash_check(position,2) == perft(position,2)
+    position.unmake_null_move()
+    assert position.hash == h and position.sgn == -1 and position.ep == ep is not None
+    search = Search()
+    move, score = iterative_deepening(position,4,search = search)
+    assert move in position.make_move_list() and search.depth == 4
+    
     def test(num_games,white,black,depth1 = None, depth2 = None,verbose = False,testing = False):
         print "white =",white," black =",black
         if depth1:
@@ -1546,11 +4386,8 @@ def test_suite():
     #test(1,"random","random",verbose = False)    
     test(1,"random","heuristic",depth1 = None,depth2 = 4,verbose = False) 
     #test(10,"heuristic","random",depth1 = 2,depth2 = None,verbose = False) 
-    #manually check that if depth > 1, ts_calls << total number of nodes
-    #manually check that ts_calls and quiesce_calls are about the same order of magnitude
-    #assert beta_cutoffs != 0
-    print "mml_calls =",mml_calls
-    print "mml_hash_returns =",mml_hash_returns
+    #manually check (with testing = True) that if depth > 1, the nodes searched are << total number of nodes
+    #and that nodes and quiesce nodes are about the same order of magnitude
     
     print "testing see"
     position = Position(board = initial_board[:])
@@ -1564,12 +4401,21 @@ def test_suite():
     assert see(position,56) == 0
     assert see(position,47) == 1
     assert see(position,55) == 1
+    #Qxe4 Rxe4 fxe4 Qxe4 Rxe4 (the rook on e8 x-rays through the queen), white would stop after fxe4
+    assert see(position,55,85) == -3
+    assert see(position,44,53) == 9 and see(position,56,68) == -2
     
     
-ts_calls = 0
-beta_cutoffs = 0
-quiesce_calls = 0
-mml_calls = 0
-mml_hash_returns = 0
+def profile(statement = "test_suite()",sort = "cumulative",limit = 40):
+    """runs statement under cProfile and prints the limit functions that take longest by sort"""
+    profiler = cProfile.Profile()
+    profiler.runctx(statement,globals(),{})
+    pstats.Stats(profiler).sort_stats(sort).print_stats(limit)
 
-cProfile.run("test_suite()")
+if __name__ == "__main__":
+    if sys.argv[1:] == ["uci"]:
+        UCIEngine().loop()
+    elif sys.argv[1:] == ["profile"]:
+        profile()
+    else:
+        test_suite()